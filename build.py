@@ -17,10 +17,54 @@ try:
 except:
 	import sha
 	kUseHashlib= False
+try:
+	memoryview # introduced in python 2.7, lets us reuse one buffer for copying
+	kMemoryViewAvailable= True
+except:
+	kMemoryViewAvailable= False
+
+# smallest and largest blocks transferStream copies with
+kReadBlockSize= 4096
+kLargestReadBlockSize= 1024 * 1024
+
+# added to an export's filename while it downloads, so an interrupted download can be resumed
+kPartialDownloadExtension= ".partial"
 
 global gEnvironment
 gEnvironment= {}
 
+def transferStream(source, destination, size= None):
+	""" copies source to destination in blocks sized for size (None if it is not known)
+		if the source supports readinto, every block is read into the same buffer
+		returns the number of bytes copied
+	"""
+	copied= 0
+	blockSize= kReadBlockSize
+	while (None == size or blockSize < size) and blockSize < kLargestReadBlockSize:
+		blockSize*= 2
+	if kMemoryViewAvailable and hasattr(source, 'readinto'):
+		view= memoryview(bytearray(blockSize))
+		while True:
+			count= source.readinto(view)
+			if not count:
+				break
+			destination.write(view[:count])
+			copied+= count
+	else:
+		while True:
+			block= source.read(blockSize)
+			if not block:
+				break
+			destination.write(block)
+			copied+= len(block)
+	return copied
+
+def contentLength(connection):
+	size= connection.info().getheader('Content-Length')
+	if size:
+		return long(size)
+	return None
+
 def newHasher():
 	if kUseHashlib:
 		return hashlib.sha1()
@@ -131,6 +175,7 @@ def getExports(environment, domain, name, firstOnly= True, minimumVersion= None)
 	found= __getLocalExportArchivePath(environment, domain, name, firstOnly, minimumVersion)
 	if found:
 		return found
+	found= []
 	servers= list(gFallbackServers)
 	try:
 		exportsFile= open(os.path.join(environment['export_path'], "exports.xml"))
@@ -145,22 +190,22 @@ def getExports(environment, domain, name, firstOnly= True, minimumVersion= None)
 	allServers= []
 	goodServers= []
 	while len(servers) > 0:
-		server= pop(servers)
+		server= servers.pop(0)
 		if server not in allServers:
 			allServers.append(server)
 		try:
 			serverConnection= urllib2.urlopen(server)
 			contents= serverConnection.read()
 			serverConnection.close()
-		except:
+		except Exception:
 			contents= None
 		if contents:
 			goodServers.append(server)
 			info= parseServerManifest(contents)
-			for server in info['servers']:
-				if server not in allServers:
-					servers.append(server)
-					allServers.append(server)
+			for newServer in info['servers']:
+				if newServer not in allServers:
+					servers.append(newServer)
+					allServers.append(newServer)
 			remote= __filterArchiveList(
 						environment, info['exports'], domain, name,
 						firstOnly= False, minimumVersion= minimumVersion
@@ -172,18 +217,10 @@ def getExports(environment, domain, name, firstOnly= True, minimumVersion= None)
 				url= baseURL+'/'+item
 				destinationPath= os.path.join(environment['export_path'], item)
 				try:
-					sourceConnection= urllib2.urlopen(url)
-					destinationFile= open(destinationPath, 'w')
-					while True:
-						block= sourceConnection.read(kReadBlockSize)
-						if not block:
-							break
-						destinationFile.write(block)
-					destinationFile.close()
-					sourceConnection.close()
-					return destinationPath
-				except:
-					pass
+					if downloadResumable(destinationPath, url):
+						return destinationPath
+				except Exception:
+					pass # try the next server
 	if firstOnly:
 		return None
 	return (found, goodServers)
@@ -371,19 +408,68 @@ def extractExportArchive(environment, source):
 
 	exportZip.close()
 
+def exportManifestHash(exportPath):
+	""" sha1 of the manifest.xml in an export (with normalized line endings), the hash in its filename
+		None if it is not a zip file with a manifest
+	"""
+	try:
+		exportZip= zipfile.ZipFile(exportPath, "r")
+		try:
+			manifest= readFileInZip(exportZip, "manifest.xml")
+		finally:
+			exportZip.close()
+	except (zipfile.BadZipfile, KeyError, IOError):
+		return None
+	hasher= newHasher()
+	hasher.update(manifest.replace("\r\n", "\n").replace("\r", "\n"))
+	return hasher.hexdigest()
+
+def downloadResumable(destinationPath, url):
+	""" downloads url to destinationPath through destinationPath.partial
+		if the download is interrupted, the next call only asks the server for the rest of the file
+		once it has arrived, the hash at the end of an export's filename is checked (see exportManifestHash)
+		returns False (and removes what was downloaded) if the file is not what it should be
+	"""
+	partialPath= destinationPath + kPartialDownloadExtension
+	received= 0
+	if os.path.isfile(partialPath):
+		received= os.path.getsize(partialPath)
+	request= urllib2.Request(url)
+	if received:
+		request.add_header('Range', 'bytes=%d-'%(received))
+	try:
+		sourceConnection= urllib2.urlopen(request)
+	except urllib2.HTTPError,e:
+		if not received or e.code != 416: # 416 = Requested Range Not Satisfiable, we have it all
+			raise e
+		sourceConnection= None
+	if sourceConnection:
+		contentRange= sourceConnection.info().getheader('Content-Range')
+		if received and (not contentRange or not contentRange.strip().startswith("bytes %d-"%(received))):
+			received= 0 # the server ignored the range and is sending everything
+		size= contentLength(sourceConnection)
+		destinationFile= open(partialPath, received and 'ab' or 'wb')
+		try:
+			copied= transferStream(sourceConnection, destinationFile, size)
+		finally:
+			destinationFile.close()
+			sourceConnection.close()
+		if size and copied < size:
+			raise IOError("Only got %d of %d bytes of %s"%(copied, size, url))
+	expectedHash= os.path.splitext(os.path.split(destinationPath)[1])[0].rsplit('_', 1)[-1]
+	manifestHash= exportManifestHash(partialPath)
+	if not manifestHash or manifestHash.lower() != expectedHash.lower():
+		os.remove(partialPath)
+		return False
+	os.rename(partialPath, destinationPath)
+	return True
+
 def downloadExportArchive(environment, url):
 	(folder, filename)= url.rsplit('/', 1)
 	destinationPath= os.path.join(environment['export_path'], filename)
-	sourceConnection= urllib2.urlopen(url)
-	destinationFile= open(destinationPath, 'w')
-	while True:
-		block= sourceConnection.read(kReadBlockSize)
-		if not block:
-			break
-		destinationFile.write(block)
-	destinationFile.close()
-	sourceConnection.close()
-	if not validExportArchive(path):
+	if not downloadResumable(destinationPath, url):
+		return None
+	if not validExportArchive(destinationPath):
 		os.remove(destinationPath)
 		destinationPath= None
 	return destinationPath
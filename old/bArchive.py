@@ -4,17 +4,32 @@ __all__ = [ # exported symbols from this module
 	"validate", 		# function to validate/repair/restore and archive with/to a directory
 	"generate",			# generate an archive from a directory
 	"ZipArchive",		# A wrapper for ZipArchive files
+	"ArchiveChain",		# reads files from the first of several archives that has them
+	"SkipFilter",		# filters compiled to prune what is skipped while walking a directory
+	#"zipCompressFile",	# used internally, compresses a zip entry on a ZipArchive thread
 	"kStandardCodecs",	# Standard codecs defined by this module
 	"kAllKnownHashes",	# Hash algorithms found by this module
 	"kMD5Hash",			# Just the MD5 hash algorithm
+	"kHashProfiles",	# name -> hashers, sets of hashers exports can be generated with
+	"kDefaultHashProfile",	# name of the hash profile used when none is given
+	"hashProfile",		# get the hashers for a hash profile name
+	"ConcurrentHasher",	# updates a hasher on its own thread
 	"platformEOL",		# The platform's end of line character
 	"platformTempDir",	# The platform's temporary directory
 	"XMLCodec",			# xml encoding &#xXX;
 	"DollarHexCodec",	# codec to convert undesirables to $XX
 	"Base64Codec",		# standard base64 encoding
-	"ManifestCompare",	# xml.sax handler
+	"ManifestCompare",	# reads a manifest, telling a notifier about each entry
+	"ManifestTee",		# writes a manifest, feeding a ManifestCompare as it goes
+	"manifestFiles",	# relative path -> properties of the files in a manifest
+	"manifestAttributes",	# attributes of the manifest element (profile, from)
 	"VerifyHandler",	# For ManifestCompare to handle each file/dir/link as we encounter them
 	"transferAndHash",	# Transfer data from one stream and hash the contents and convert eols
+	"hashFile",			# hash a local file (no text detection)
+	"adaptiveBlockSize",	# pick a transfer block size for the size of a file
+	"BlockReader",		# reads a stream in blocks, into a reused buffer if possible
+	"TextDetector",		# decides if a stream is text as transferAndHash reads it
+	"SampledTextDetector",	# TextDetector that decides from the start of a stream
 	"hashListsMatch",	# compares results of transferAndHash from two transfers
 	"reportException",	# handles reporting exceptions when you catch them
 ]
@@ -37,17 +52,25 @@ import os
 import re
 import sys
 import bDOM
+import mmap
 import stat
 import time
+import zlib
+import Queue
 import base64
-import random
 import string
-import xml.sax
 import zipfile
+import bWalk
+import bWorkers
 import calendar
 import datetime
 import cStringIO
+import _strptime # strptime imports it the first time it is called, which can fail on worker threads
+import threading
 import traceback
+import bCompression
+import bBinaryManifest
+import xml.parsers.expat
 try:
 	import hashlib
 	kHashLibAvailable= True
@@ -59,6 +82,11 @@ try:
 	kXattrAvailable= True
 except:
 	kXattrAvailable= False
+try:
+	memoryview # introduced in python 2.7, lets us reuse one buffer for reading
+	kMemoryViewAvailable= True
+except:
+	kMemoryViewAvailable= False
 
 class StreamHasher:
 	def __init__(self, stream, hashers):
@@ -82,6 +110,8 @@ class StreamHasher:
 		block= self.__stream.readline()
 		self.__updateHashers(block)
 		return block
+	def close(self):
+		self.__stream.close()
 	def __validate(self, reading):
 		if reading != self.__readMode and None != self.__readMode:
 			raise AssertionError("Cannot use StreamHasher for read and write simultaneously")
@@ -103,13 +133,13 @@ class StreamHasher:
 
 class XMLCodec:
 	kCharactersToEscapePattern= re.compile(r"([^a-zA-Z0-9_; /@=:.-])")
-	kEscapePattern= re.compile(r"\&#x([0-9A-Fa-f]);")
+	kEscapePattern= re.compile(r"\&#x([0-9A-Fa-f]+);")
 	def __init__(self):
 		pass
 	def encode(self, text):
 		return self.kCharactersToEscapePattern.sub(lambda m: "&#x%x;"%(ord(m.group(1))), text)
 	def decode(self, encoded):
-		return self.kEscapePattern.sub(lambda m: char(int(m.group(1), 16)), encoded)
+		return self.kEscapePattern.sub(lambda m: chr(int(m.group(1), 16)), encoded)
 	def name(self):
 		return "xml"
 
@@ -121,7 +151,7 @@ class DollarHexCodec:
 	def encode(self, text):
 		return self.kCharactersToEscapePattern.sub(lambda m: "$%02x"%(ord(m.group(1))), text)
 	def decode(self, encoded):
-		return self.kEscapePattern.sub(lambda m: char(int(m.group(1), 16)), encoded)
+		return self.kEscapePattern.sub(lambda m: chr(int(m.group(1), 16)), encoded)
 	def name(self):
 		return "dollarhex"
 
@@ -180,13 +210,18 @@ def pathToList(path):
 	elements= []
 	while True:
 		(path, name)= os.path.split(path)
-		elements.insert(0, name)
+		elements.append(name)
 		if not name:
 			break
+	elements.reverse()
 	return elements
 
 def statWrapper(path):
-	stats= os.lstat(path)
+	return statDetails(os.lstat(path))
+
+def statDetails(stats):
+	""" (stats, isdir, isfile, mods, readonly, executable) from the lstat of something
+	"""
 	isdir= stat.S_ISDIR(stats.st_mode)
 	isfile= stat.S_ISREG(stats.st_mode)
 	mods= stat.S_IMODE(stats.st_mode)
@@ -210,29 +245,54 @@ def fullyDeleteDirectoryHierarchy(path):
 	elif os.path.isfile(path):
 		os.remove(path)
 
-def skip(relativePath, skipPaths, skipExtensions, skipNames):
-	#print "skip(",relativePath,", ",skipPaths,", ",skipExtensions,", ",skipNames,")"
-	relativePathParts= pathToList(relativePath)
-	#print "relativePathParts",relativePathParts,"relativePath",relativePath
-	for part in relativePathParts:
-		#print "part",part
-		if part in skipNames:
-			return True # something in the path is in the skip list
-		for extension in skipExtensions:
-			#print "\t","extension",extension
-			if part.endswith(extension):
-				#print "\t","skipping",relativePath
-				return True # something in the path has this extension
-	for item in skipPaths:
-		itemParts= pathToList(item)
-		#print "item",item,"itemParts",itemParts
-		if len(itemParts) > len(relativePathParts):
-			continue # skipPath has more elements, we can't be in it
-		relativeSubPath= os.path.join(*relativePathParts[:len(itemParts)])
-		#print "relativeSubPath",relativeSubPath
-		if relativeSubPath == item:
-			return True # the first n items match, skip it
-	return False
+class SkipFilter:
+	""" The filters of a package (or manifest) compiled to check names against as directories are walked
+		names and extensions are skipped anywhere, paths are skipped from the base of the walk
+		anything in a skipped directory is skipped
+	"""
+	def __init__(self, skipPaths, skipExtensions, skipNames):
+		self.__skipPaths= list(skipPaths or [])
+		self.__skipExtensions= list(skipExtensions or [])
+		self.__skipNames= list(skipNames or [])
+		self.__names= set(self.__skipNames)
+		self.__extensions= tuple(self.__skipExtensions) # str.endswith checks them all at once
+		self.__paths= {} # path element -> the same for the elements in it, None -> True if skipped
+		for item in self.__skipPaths:
+			node= self.__paths
+			for part in pathToList(item):
+				if part:
+					node= node.setdefault(part, {})
+			if node is not self.__paths:
+				node[None]= True
+	def skipPaths(self):
+		return self.__skipPaths
+	def skipExtensions(self):
+		return self.__skipExtensions
+	def skipNames(self):
+		return self.__skipNames
+	def root(self):
+		""" the node for the base of a walk, nodes keep track of the skip paths as directories are walked
+		"""
+		return self.__paths
+	def within(self, node, name):
+		""" the node for directory name, in the directory node is for
+		"""
+		return node.get(name, {})
+	def skipped(self, name, node):
+		""" True if name, in the directory node is for, is skipped
+		"""
+		return name in self.__names or name.endswith(self.__extensions) or node.get(name, {}).has_key(None)
+	def skip(self, relativePath):
+		""" True if relativePath, or a directory it is in, is skipped
+		"""
+		node= self.root()
+		for part in pathToList(relativePath):
+			if not part:
+				continue
+			if self.skipped(part, node):
+				return True
+			node= self.within(node, part)
+		return False
 
 #kBetterDateFormat= "%Y/%m/%d@%H:%M:%S.%f" # not supported in 2.5.1 (Mac OS X 10.5/ppc)
 kReliableDateFormat= "%Y/%m/%d@%H:%M:%S"
@@ -263,7 +323,23 @@ def getSubPathRelative(base, path):
 	#print "<getSubPathRelative(",base,",",path,")"
 	return relative
 
-class ManifestCompare(xml.sax.handler.ContentHandler):
+# manifests are read in blocks this big
+kManifestBlockSize= 64 * 1024
+
+def parseStream(parser, stream, blockSize= kManifestBlockSize):
+	""" feeds an expat parser everything in stream ( .read(size) -> str ), a block at a time
+	"""
+	while True:
+		block= stream.read(blockSize)
+		if not block:
+			break
+		parser.Parse(block, False)
+	parser.Parse("", True)
+
+class ManifestCompare:
+	""" Reads a manifest with expat, telling notifier about each file, directory and link as it is read
+		only the entry being read is kept, its hash and xattr elements are added to its properties
+	"""
 	kFileTypeItems= ["file", "directory", "link"]
 	def __init__(self, notifier, decoders):
 		"""
@@ -272,82 +348,432 @@ class ManifestCompare(xml.sax.handler.ContentHandler):
 
 			properties
 				path - relative
-				hash - list of (name, hexhash)
+				hash - list of (name, hexhash, isText)
 				xattr - dict of name -> value
 		"""
 		self.__skipPaths= []
 		self.__skipExtensions= []
 		self.__skipNames= []
-		self.__stack= []
+		self.__profile= None
+		self.__base= None
 		self.__notifier= notifier
 		self.__decoders= decoders
+		self.__depth= 0
+		self.__entry= None # (file|link|directory, properties) being read
+		self.__element= None # (name, attributes) of the element in the entry being read
+		self.__text= [] # text of that element, in the pieces expat gave it
+		self.__parser= None
+	def __expat(self):
+		if not self.__parser:
+			self.__parser= xml.parsers.expat.ParserCreate()
+			self.__parser.buffer_text= True # text comes in as few pieces as possible
+			self.__parser.StartElementHandler= self.__startElement
+			self.__parser.EndElementHandler= self.__endElement
+			self.__parser.CharacterDataHandler= self.__characters
+		return self.__parser
+	def parse(self, stream, blockSize= kManifestBlockSize):
+		""" reads the manifest in stream ( .read(size) -> str )
+		"""
+		parseStream(self.__expat(), stream, blockSize)
+	def feed(self, block, final= False):
+		""" reads the next block of a manifest as it is written, final is True after the last block
+		"""
+		self.__expat().Parse(block, final)
 	def skipPaths(self):
 		return self.__skipPaths
 	def skipExtensions(self):
 		return self.__skipExtensions
 	def skipNames(self):
 		return self.__skipNames
-	def startElement(self, name, attrs):
-		#print ">",self.__stack
-		attributes= {}
-		for attribute in attrs.getNames(): # get attributes and put them in the stack
-			attributes[attribute]= attrs.getValue(attribute)
-		self.__stack.append( (name, attributes) )
-		if len(self.__stack) == 1 and name != "manifest":
-			raise SyntaxError("Not a manifest: "+name)
-		elif len(self.__stack) == 2:
-			if name == "filter":
-				stackTop= self.__stack[-1]
-				if stackTop[1].has_key('path'):
-					self.__skipPaths.append(stackTop[1]['path'])
-				if stackTop[1].has_key('name'):
-					self.__skipNames.append(stackTop[1]['name'])
-				if stackTop[1].has_key('extension'):
-					self.__skipExtensions.append(stackTop[1]['extension'])
-	def endElement(self, name):
-		#print "<",self.__stack
-		text= None
-		stackTop= self.__stack[-1]
-		if stackTop[1].has_key('__text__'):
-			text= stackTop[1]['__text__'].rstrip()
-		inFileItem= len(self.__stack) == 3 and self.__stack[-2][0] in self.kFileTypeItems
-		if inFileItem:
-			if name == "xattr":
-				if not self.__stack[-2][1].has_key('xattr'):
-					self.__stack[-2][1]['xattr']= {}
-				decoderNeeded= stackTop[1].has_key('encoding')
+	def skipFilter(self):
+		""" SkipFilter for the manifest's filters
+		"""
+		return SkipFilter(self.__skipPaths, self.__skipExtensions, self.__skipNames)
+	def profile(self):
+		""" name of the hash profile the manifest was generated with (None for older manifests)
+		"""
+		return self.__profile
+	def base(self):
+		""" name of the export this manifest is a delta of (None if it is a full export)
+		"""
+		return self.__base
+	def __startElement(self, name, attributes):
+		self.__depth+= 1
+		if self.__depth == 3:
+			if self.__entry:
+				self.__element= (name, attributes)
+				self.__text= []
+		elif self.__depth == 2:
+			if name in self.kFileTypeItems:
+				self.__entry= (name, attributes)
+			elif name == "filter":
+				if attributes.has_key('path'):
+					self.__skipPaths.append(attributes['path'])
+				if attributes.has_key('name'):
+					self.__skipNames.append(attributes['name'])
+				if attributes.has_key('extension'):
+					self.__skipExtensions.append(attributes['extension'])
+		elif self.__depth == 1:
+			if name != "manifest":
+				raise SyntaxError("Not a manifest: "+name)
+			self.__profile= attributes.get('profile')
+			self.__base= attributes.get('from')
+	def __endElement(self, name):
+		if self.__depth == 3 and self.__element:
+			text= "".join(self.__text).strip() or None
+			attributes= self.__element[1]
+			properties= self.__entry[1]
+			if name == "hash":
+				properties.setdefault('hash', []).append( (
+					attributes['algorithm'],
+					text,
+					attributes.get('text', 'f')[:1].lower() == 't'
+					) )
+			elif name == "xattr":
+				decoderNeeded= attributes.has_key('encoding')
 				if decoderNeeded and self.__decoders:
 					for decoder in self.__decoders:
-						if stackTop[1]['encoding'] == decoder[0]:
+						if attributes['encoding'] == decoder[0]:
 							text= decoder[1].decode(text)
 							decoderNeeded= False
 							break
 				if decoderNeeded:
-					raise SyntaxError("Unknown encoding: "+stackTop[1]['encoding'])
-				self.__stack[-2][1]['xattr'][stackTop[1]['name']]= text
-			elif name == "hash":
-				if not self.__stack[-2][1].has_key('hash'):
-					self.__stack[-2][1]['hash']= []
-				self.__stack[-2][1]['hash'].append( (
-					stackTop[1]['algorithm'],
-					text,
-					stackTop[1].has_key('text') and stackTop[1]['text'][0].lower() == 't'
-					) )
-		elif len(self.__stack) == 2 and stackTop[0] in self.kFileTypeItems:
-			self.__notifier.notify(stackTop)
-		self.__stack= self.__stack[:-1] # pop element off stack
-	def characters(self, text):
-		stackTop= self.__stack[-1]
-		if not stackTop[1].has_key('__text__'):
-			if len(text.strip()) > 0:
-				stackTop[1]['__text__']= text.lstrip()
+					raise SyntaxError("Unknown encoding: "+attributes['encoding'])
+				properties.setdefault('xattr', {})[attributes['name']]= text
+			self.__element= None
+		elif self.__depth == 2 and self.__entry:
+			self.__notifier.notify(self.__entry)
+			self.__entry= None
+		self.__depth-= 1
+	def __characters(self, text):
+		if self.__element:
+			self.__text.append(text)
+
+class ManifestTee:
+	""" Writes a manifest to a stream, feeding a ManifestCompare what is written as it is written
+	"""
+	def __init__(self, stream, comparitor):
+		self.__stream= stream
+		self.__comparitor= comparitor
+	def write(self, block):
+		self.__stream.write(block)
+		self.__comparitor.feed(block)
+	def close(self):
+		self.__stream.close()
+
+class ManifestFiles:
+	""" ManifestCompare notifier that collects the properties of each file, by path
+	"""
+	def __init__(self):
+		self.__files= {}
+	def notify(self, info):
+		if info[0] == "file":
+			self.__files[info[1]['path']]= info[1]
+	def files(self):
+		return self.__files
+
+def manifestFiles(manifestStream, decoders):
+	""" returns relative path -> properties (see ManifestCompare) of the files in a manifest
+	"""
+	collector= ManifestFiles()
+	ManifestCompare(collector, decoders).parse(manifestStream)
+	return collector.files()
+
+class ManifestHeader:
+	""" Reads the attributes of the manifest element and stops
+	"""
+	class Found(Exception):
+		pass
+	def __init__(self):
+		self.attributes= {}
+	def startElement(self, name, attributes):
+		if name != "manifest":
+			raise SyntaxError("Not a manifest: "+name)
+		self.attributes.update(attributes)
+		raise ManifestHeader.Found()
+
+def manifestAttributes(manifestStream):
+	""" returns the attributes of the manifest element (profile, from)
+		without reading the rest of the manifest
+	"""
+	header= ManifestHeader()
+	parser= xml.parsers.expat.ParserCreate()
+	parser.StartElementHandler= header.startElement
+	try:
+		parseStream(parser, manifestStream)
+	except ManifestHeader.Found:
+		pass
+	return header.attributes
+
+# blocks at least this big are hashed by all algorithms at once (see ConcurrentHasher)
+kConcurrentHashMinimumBlock= 64 * 1024
+
+# adaptiveBlockSize will not grow blocks beyond this
+kLargestBlockSize= 1024 * 1024
+
+def adaptiveBlockSize(size, blockTransferSize):
+	""" size is the number of bytes that will be transferred (None if unknown)
+		blockTransferSize is the smallest block to use
+		returns a block size that reads small files in one block and large files in large blocks
+	"""
+	blockSize= blockTransferSize
+	while (None == size or blockSize < size) and blockSize < kLargestBlockSize:
+		blockSize*= 2
+	return max(blockSize, blockTransferSize)
+
+class BlockReader:
+	""" Reads a stream in blocks
+		If the stream supports readinto, every block is read into the same buffer
+			and read() returns a memoryview that is only valid until the next read()
+		otherwise read() returns a new string every time
+		A block that ends in \r is extended by one byte so \r\n is never split between blocks
+	"""
+	def __init__(self, stream, blockSize):
+		self.__stream= stream
+		self.__size= blockSize
+		self.__block= ""
+		self.__buffer= None
+		if kMemoryViewAvailable and hasattr(stream, 'readinto'):
+			self.__buffer= bytearray(blockSize + 1) # room for the byte after a \r
+			self.__view= memoryview(self.__buffer)
+			self.__count= 0
+	def reusesBuffer(self):
+		return None != self.__buffer
+	def read(self):
+		if None == self.__buffer:
+			self.__block= self.__stream.read(self.__size)
+			if self.__block and self.__block[-1] == "\r": # handle chunk split in the middle of eol
+				nextByte= self.__stream.read(1)
+				if len(nextByte) == 1:
+					self.__block+= nextByte
+			return self.__block
+		self.__count= self.__stream.readinto(self.__view[:self.__size])
+		if not self.__count:
+			self.__count= 0
+			return ""
+		if self.__buffer[self.__count - 1] == 13: # \r, handle chunk split in the middle of eol
+			self.__count+= self.__stream.readinto(self.__view[self.__count:self.__count + 1]) or 0
+		return self.__view[:self.__count]
+	def find(self, text):
+		""" find text in the last block read without copying it
+		"""
+		if None == self.__buffer:
+			return self.__block.find(text)
+		return self.__buffer.find(text, 0, self.__count)
+	def string(self):
+		""" the last block read, as a string (copied if we are reusing a buffer)
+		"""
+		if None == self.__buffer:
+			return self.__block
+		return self.__view[:self.__count].tobytes()
+
+def hashFile(path, hashers):
+	""" hashes a local file, without text detection, by mapping it into memory
+		returns the same list of hashes as transferAndHash
+	"""
+	hashes= []
+	fileHashers= []
+	for hasher in hashers:
+		fileHashers.append( (hasher[0], hasher[1].copy()) )
+	sourceFile= open(path, 'rb')
+	try:
+		size= os.fstat(sourceFile.fileno()).st_size
+		if size > 0:
+			mapped= mmap.mmap(sourceFile.fileno(), size, access= mmap.ACCESS_READ)
+			try:
+				offset= 0
+				while offset < size:
+					blockSize= min(kLargestBlockSize, size - offset)
+					for hasher in fileHashers:
+						hasher[1].update(buffer(mapped, offset, blockSize))
+					offset+= blockSize
+			finally:
+				mapped.close()
+	finally:
+		sourceFile.close()
+	for hasher in fileHashers:
+		hashes.append( (hasher[0], hasher[1].hexdigest(), False) )
+	return hashes
+
+class ConcurrentHasher:
+	""" Updates a hasher on its own thread so several algorithms can digest the same block at once
+		(hashlib releases the GIL while it hashes large blocks)
+	"""
+	def __init__(self, hasher):
+		self.__hasher= hasher
+		self.__error= None # sys.exc_info() of the update that failed, raised on this thread
+		self.__blocks= Queue.Queue(4) # bound the blocks we hold on to
+		self.__thread= threading.Thread(target= self.__run)
+		self.__thread.setDaemon(True)
+		self.__thread.start()
+	def __run(self):
+		while True:
+			block= self.__blocks.get()
+			try:
+				if None == block:
+					break
+				if None == self.__error: # after a failure, blocks are only drained
+					try:
+						self.__hasher.update(block)
+					except: # raised from update, wait or hexdigest
+						self.__error= sys.exc_info()
+			finally:
+				self.__blocks.task_done()
+	def __raiseError(self):
+		if self.__error:
+			raise self.__error[0], self.__error[1], self.__error[2]
+	def update(self, block):
+		self.__raiseError()
+		self.__blocks.put(block)
+	def wait(self):
+		""" waits for every block given to update to be hashed (so its buffer can be reused)
+		"""
+		if self.__thread:
+			self.__blocks.join()
+		self.__raiseError()
+	def stop(self):
+		if self.__thread:
+			self.__blocks.put(None)
+			self.__thread.join()
+			self.__thread= None
+	def hexdigest(self):
+		self.stop()
+		self.__raiseError()
+		return self.__hasher.hexdigest()
+
+def __makeConcurrent(hashers):
+	concurrent= []
+	for hasher in hashers:
+		concurrent.append( (hasher[0], ConcurrentHasher(hasher[1])) )
+	return concurrent
+
+def __stopConcurrent(hashers):
+	for hasher in hashers:
+		if isinstance(hasher[1], ConcurrentHasher):
+			hasher[1].stop()
+
+# how much of a file SampledTextDetector looks at to decide if it is text
+kTextSampleSize= 64 * 1024
+
+class TextDetector:
+	""" Decides if a stream looks like text from the blocks transferAndHash reads
+		text has no NUL characters, less than 10% non-printable characters
+			and an average line length between 0.0001 and 20000 characters
+		update(reader) is called with the BlockReader after each block is read
+		updateText(unixText) is called with each block converted to unix eols while wantsText()
+			(once it is False, transferAndHash stops converting and text hashing)
+	"""
+	def __init__(self):
+		self.__size= 0
+		self.__lines= 0
+		self.__nonPrintable= 0
+		self.__binary= False
+	def isBinary(self):
+		""" True once we are sure this is not text
+		"""
+		return self.__binary
+	def setBinary(self):
+		self.__binary= True
+	def deciding(self):
+		""" True while what has been read may still turn out to be text or not
+			transferAndHash holds back output until then, so line endings are converted all or nothing
+			(TextDetector decides as it reads, a NUL only makes the rest binary)
+		"""
+		return False
+	def wantsText(self):
+		return not self.__binary
+	def update(self, reader):
+		if not self.__binary and reader.find("\0") >= 0:
+			self.__binary= True
+	def updateText(self, unixText):
+		self.__size+= len(unixText)
+		self.__lines+= unixText.count("\n")
+		self.__nonPrintable+= len(unixText.translate(None, string.printable)) # what's left is not printable
+	def sampled(self):
+		""" number of bytes of unix text seen so far
+		"""
+		return self.__size
+	def isText(self):
+		if self.__binary:
+			return False
+		if self.__size > 0:
+			percentNonPrintable= float(self.__nonPrintable) / self.__size
+		else:
+			percentNonPrintable= 1.0
+		if self.__lines > 0:
+			averageLineLength= float(self.__size) / self.__lines
 		else:
-			stackTop[1]['__text__']+= text
+			averageLineLength= 0.0
+		isProbablyText= averageLineLength > 0.0001 and averageLineLength < 20000.0
+		return isProbablyText and percentNonPrintable < 0.10
+	def lines(self):
+		""" number of lines if this is text, otherwise -1
+		"""
+		if self.isText():
+			return self.__lines
+		return -1
+
+class SampledTextDetector(TextDetector):
+	""" Decides if a stream is text from the first kTextSampleSize bytes (for very large files)
+		after the sample it only counts lines (of text) and stops checking for NULs or non-printables
+	"""
+	def __init__(self):
+		TextDetector.__init__(self)
+		self.__decided= False
+		self.__lines= 0
+	def deciding(self):
+		return not self.__decided
+	def update(self, reader):
+		if not self.__decided:
+			TextDetector.update(self, reader)
+	def updateText(self, unixText):
+		if self.__decided:
+			self.__lines+= unixText.count("\n")
+			return
+		TextDetector.updateText(self, unixText)
+		if self.sampled() >= kTextSampleSize:
+			self.__decided= True
+			if not TextDetector.isText(self):
+				self.setBinary()
+	def lines(self):
+		sampledLines= TextDetector.lines(self)
+		if sampledLines < 0:
+			return sampledLines
+		return sampledLines + self.__lines
+
+def newTextDetector(detectText):
+	""" detectText is True (TextDetector), False or None (no detection),
+			or a callable that returns a new detector (a TextDetector class)
+	"""
+	if not detectText:
+		return None
+	if callable(detectText):
+		return detectText()
+	return TextDetector()
+
+def __writesBuffers(output):
+	""" text mode files (and most file-like objects) only write strings
+	"""
+	return isinstance(output, file) and 'b' in output.mode
+
+def __writePending(output, pending, changeLineEndingsTo):
+	""" writes the blocks held back while a detector decided, with eols changed if changeLineEndingsTo
+	"""
+	for block in pending:
+		if changeLineEndingsTo:
+			block= block.replace("\n", changeLineEndingsTo)
+		output.write(block)
+	del pending[:]
 
 def transferAndHash(input, hashers, output, detectText, changeLineEndingsTo, blockTransferSize):
 	""" changeLineEndingsTo if None, no line ending change
 			otherwise if detectText then lineEndings will only be changed if it looks like text
 			otherwise if not detectText and changeLineEndingsTo then all eols will be changed
+		detectText see newTextDetector
+			text hashes are only returned if it looks like text
+			(once a detector is sure it's binary, text hashing stops)
+		if there is more than one hasher and blocks are large (kConcurrentHashMinimumBlock)
+			each algorithm hashes on its own thread
 	"""
 	if not hashers:
 		hashers= []
@@ -357,69 +783,96 @@ def transferAndHash(input, hashers, output, detectText, changeLineEndingsTo, blo
 		fileHashers.append( (hasher[0], hasher[1].copy()) )
 		if detectText:
 			textHashers.append( (hasher[0], hasher[1].copy()) )
-	isProbablyText= True
-	unixTextSize= 0.0
-	unixTextNoEOLSize= 0.0
-	unixTextNoPrintableSize= 0.0
+	try:
+		return __transferAndHash(input, fileHashers, textHashers, output, newTextDetector(detectText),
+									changeLineEndingsTo, blockTransferSize)
+	finally:
+		__stopConcurrent(fileHashers)
+		__stopConcurrent(textHashers)
+
+def __transferAndHash(input, fileHashers, textHashers, output, detector, changeLineEndingsTo, blockTransferSize):
+	firstBlock= True
+	concurrent= False
+	pending= [] # blocks read while the detector is deciding (see TextDetector.deciding)
+	reader= BlockReader(input, blockTransferSize)
 	while True:
-		block= input.read(blockTransferSize)
+		block= reader.read()
 		if not block:
 			break
-		if block[-1] == "\r": # handle chunk split in the middle of eol
-			nextByte= input.read(1)
-			if len(nextByte) == 1:
-				block+= nextByte
-		if isProbablyText and block.find("\0") >= 0:
-			isProbablyText= False
+		if firstBlock:
+			firstBlock= False
+			manyHashers= len(fileHashers) + len(textHashers) > 1
+			if manyHashers and len(block) >= kConcurrentHashMinimumBlock: # there's a lot to hash
+				fileHashers[:]= __makeConcurrent(fileHashers)
+				textHashers[:]= __makeConcurrent(textHashers)
+				concurrent= True
+		if detector:
+			detector.update(reader)
 		for hasher in fileHashers:
 			hasher[1].update(block)
-		if textHashers:
-			unixText= block.replace("\r\n", "\n").replace("\r", "\n")
+		if detector and detector.wantsText():
+			unixText= reader.string().replace("\r\n", "\n").replace("\r", "\n")
 			for hasher in textHashers:
 				hasher[1].update(unixText)
-			unixTextSize+= len(unixText)
-			unixTextNoEOLSize+= len(unixText.replace("\n", ""))
-			unixTextNoPrintableSize+= len(filter(lambda x: x in string.printable, unixText))
-		if output:
-			convertEOLOnDetectionOfText= changeLineEndingsTo and detectText and isProbablyText
-			askedToConvertEOLRegardless= changeLineEndingsTo and not detectText
+			detector.updateText(unixText)
+		if output and changeLineEndingsTo and detector and detector.deciding():
+			pending.append(reader.string())
+		elif output:
+			convertEOLOnDetectionOfText= changeLineEndingsTo and detector and not detector.isBinary()
+			askedToConvertEOLRegardless= changeLineEndingsTo and not detector
+			if pending:
+				__writePending(output, pending, convertEOLOnDetectionOfText and changeLineEndingsTo)
 			if convertEOLOnDetectionOfText or askedToConvertEOLRegardless:
-				block= block.replace("\n", changeLineEndingsTo)
+				block= reader.string().replace("\n", changeLineEndingsTo)
+			elif reader.reusesBuffer() and not __writesBuffers(output):
+				block= reader.string()
 			output.write(block)
-	numberOfLines= unixTextSize - unixTextNoEOLSize
-	if unixTextSize > 0.0:
-		percentNonPrintable= (unixTextSize - unixTextNoPrintableSize) / unixTextSize
-	else:
-		percentNonPrintable= 1.0
-	if numberOfLines > 0.0:
-		averageLineLength= unixTextSize / numberOfLines
-	else:
-		averageLineLength= 0.0
-	isProbablyText= isProbablyText and averageLineLength > 0.0001 and averageLineLength < 20000.0
-	isProbablyText= isProbablyText and percentNonPrintable < 0.10
+		if concurrent and reader.reusesBuffer():
+			for hasher in fileHashers:
+				hasher[1].wait() # the next read will overwrite the block they are hashing
+	if pending: # it ended before the detector decided
+		__writePending(output, pending, detector.isText() and changeLineEndingsTo)
 	hashes= []
 	for hasher in fileHashers:
 		hashes.append( (hasher[0], hasher[1].hexdigest(), False ))
-	for hasher in textHashers:
-		hashes.append( (hasher[0], hasher[1].hexdigest(), True) )
-	if not isProbablyText:
+	if detector:
+		numberOfLines= detector.lines()
+	else:
 		numberOfLines= -1
+	if numberOfLines >= 0: # text hashing stops early for binary files
+		for hasher in textHashers:
+			hashes.append( (hasher[0], hasher[1].hexdigest(), True) )
 	return (numberOfLines, hashes)
 
 class VerifyHandler:
 	kExecutableFlags= stat.S_IEXEC | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
 	kWriteFlags= stat.S_IWRITE | stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
-	def __init__(self, base, fixLevel, archive, hashers, convertEOL, blockTransferSize):
+	def __init__(self, base, fixLevel, archive, hashers, convertEOL, blockTransferSize, workers= 1,
+					blobs= None, changed= None):
 		"""
 			archive ( .open(relpath, 'r') ->  .close() .read(size) -> str )
+				with workers > 1, open must be callable from several threads at once
 			fixLevel
 				-1 = do not fix, just throw exception
 				 0 = do not fix, just keep list of problems
 				 1 = fix, but don't hash unless timestamp or size is off
 				 2 = fully validate all contents
+			workers is the number of threads to check/restore files with
+				directories and links are handled as they are notified,
+				files are queued to the workers, finish waits for them
+			blobs a bBlobStore.BlobStore to link restored files from, and add them to
+				( .link(key, path, matches) -> bool, .add(key, path) )
+				files are keyed on their sha256, eol, permissions and modification time
+				blobs are checked against the manifest before they are linked, and linked files
+					are replaced instead of having their permissions or modification time changed
+			changed the set of relative paths to check (None to check everything)
+				the rest are taken to be as they were restored (see bSnapshot.Snapshot.changed)
+				finish only removes what is in it, instead of walking the whole directory
 		"""
 		self.__base= base
-		self.__exist= []
+		self.__blobs= blobs
+		self.__changed= changed
+		self.__exist= set()
 		if hashers:
 			self.__hashers= hashers
 		else:
@@ -429,17 +882,29 @@ class VerifyHandler:
 		self.__fix= fixLevel
 		self.__archive= archive
 		self.__eol= convertEOL
-		self.__problems= []
+		self.__problemsLock= threading.Lock() # problems are found on the worker threads
+		self.__problems= {} # relative path -> [description, ...]
+		self.__problemOrder= [] # (relative path, description) in the order they were found
 		self.__directoryModDates= []
 		self.__readOnlyDirectories= []
+		self.__pool= bWorkers.Pool(workers, processes= False)
+		self.__pending= bWorkers.OrderedResults(lambda info, value: None, 4 * self.__pool.workers())
 	def found(self):
 		return self.__exist
-	def finish(self, skipPaths, skipExtensions, skipNames):
+	def __expected(self, relativePath):
+		return relativePath in self.__exist
+	def finish(self, skipFilter):
 		""" patches up all the stuff that has to be done at the end, like:
-				* remove items that don't belong
+				* remove items that don't belong (that skipFilter, a SkipFilter, doesn't skip)
 				* create symlinks (target must exist to create it)
 				* set directory modification times (make sure all mods are done first)
 		"""
+		try:
+			self.__pending.drain()
+			self.__pool.close()
+		except:
+			self.__pool.terminate()
+			raise
 		for link in self.__links:
 			try:
 				if not os.path.isdir(os.path.split(link[0])[0]):
@@ -455,17 +920,17 @@ class VerifyHandler:
 					"Could not create symlink to "+link[1]['target']
 				)
 		toDelete= []
-		#print skipPaths, skipExtensions, skipNames
-		for (directory, dirs, files) in os.walk(self.__base):
-			baseRelativePath= getSubPathRelative(self.__base, directory)
-			items= list(dirs)
-			items.extend(files)
-			for item in items:
-				relativePath= os.path.join(baseRelativePath, item)
-				doSkip= skip(relativePath, skipPaths, skipExtensions, skipNames)
-				#print relativePath, doSkip
-				if not doSkip and relativePath not in self.__exist:
-					toDelete.append(os.path.join(directory, item))
+		if None != self.__changed:
+			for relativePath in sorted(self.__changed):
+				fullPath= os.path.join(self.__base, relativePath)
+				if not os.path.lexists(fullPath) or relativePath in self.__exist:
+					continue
+				if not skipFilter.skip(relativePath):
+					toDelete.append(fullPath)
+		else:
+			for (relativePath, entry, stats) in bWalk.walk(self.__base, skipFilter, descend= self.__expected):
+				if not self.__expected(relativePath):
+					toDelete.append(entry.path) # directories go with everything in them
 		for item in toDelete:
 			self.__addProblem((None, {'path': item}),"Should not exist: "+item)
 			if self.__fix > 0:
@@ -476,16 +941,17 @@ class VerifyHandler:
 		for directory in self.__readOnlyDirectories:
 			#print "3",directory[0],"%o"%(directory[1])
 			os.chmod(directory[0], directory[1])
-		return self.__problems
+		return self.__problemOrder
 	def problems(self):
-		return self.__problems
+		""" [(relative path, description), ...] in the order they were found
+		"""
+		return self.__problemOrder
 	def __create(self, fullPath, info, report= True):
 		if report:
 			self.__addProblem(info, info[0]+" does not exist: "+fullPath)
 		if info[0] == 'link':
 			if self.__fix > 0:
-				if not os.path.isdir(os.path.split(fullPath)[0]):
-					os.makedirs(os.path.split(fullPath)[0])
+				self.__makeParentDirectory(fullPath)
 				try:
 					os.symlink(info[1]['target'], fullPath)
 				except:
@@ -496,6 +962,11 @@ class VerifyHandler:
 			if self.__fix > 0:
 				os.makedirs(fullPath)
 		else:
+			blobKey= self.__blobKey(info)
+			if blobKey and self.__fix > 0:
+				self.__makeParentDirectory(fullPath)
+				if self.__blobs.link(blobKey, fullPath, lambda blobPath: self.__blobMatches(info, blobPath)):
+					return (info[1].has_key('lines'), None)
 			if self.__archive and self.__fix > 0:
 				archiveFile= self.__archive.open(info[1]['path'], 'r')
 				isText= info[1].has_key('lines')
@@ -503,24 +974,90 @@ class VerifyHandler:
 					useEOL= self.__eol
 				else:
 					useEOL= None
-				if not os.path.isdir(os.path.split(fullPath)[0]):
-					os.makedirs(os.path.split(fullPath)[0])
-				localFile= open(os.path.join(fullPath), 'w')
+				self.__makeParentDirectory(fullPath)
+				localFile= open(os.path.join(fullPath), 'wb')
 				(numberOfLines, hashes)= transferAndHash(
 											archiveFile,
 											self.__hashers,
 											localFile,
 											False,
 											useEOL,
-											self.__size
+											self.__blockSize(info)
 										)
 				localFile.close()
 				archiveFile.close()
 				return (numberOfLines >= 0, hashes)
 		return (None, None)
+	def __blobKey(self, info):
+		""" the key of a file in the blob store (None if there is no store or no sha256 for it)
+			hard links share permissions and modification times, so they are part of the key
+		"""
+		if not self.__blobs or not info[1].has_key('hash'):
+			return None
+		for hash in info[1]['hash']:
+			if hash[0] == "sha256" and not hash[2]:
+				key= hash[1].lower()
+				if info[1].has_key('lines') and self.__eol:
+					key+= "_"+self.__eol.encode('hex') # text files are restored with our eols
+				for flag in ('readonly', 'executable'):
+					if info[1].has_key(flag) and info[1][flag][0].lower() == 't':
+						key+= "_"+flag[0]
+				if info[1].has_key('modified'):
+					key+= "_%x"%(long(parseDate(info[1]['modified'])))
+				return key
+		return None
+	def __blobMatches(self, info, blobPath):
+		""" True if a blob still has the size, permissions and modification time info says it has
+			(and its sha256, for full validation)
+			they are shared by every file linked to it, any of which may have been changed in place
+		"""
+		(stats, isdir, isfile, mods, readonly, executable)= statWrapper(blobPath)
+		expectedExecutable= info[1].has_key('executable') and info[1]['executable'][0].lower() == 't'
+		expectedReadonly= info[1].has_key('readonly') and info[1]['readonly'][0].lower() == 't'
+		if not isfile or expectedExecutable != executable or expectedReadonly != readonly:
+			return False
+		if not self.__sizeMatches(info, stats) or not self.__mtimeMatches(info, stats):
+			return False
+		if self.__fix < 2: # linking is only metadata, like validating without full validation
+			return True
+		hashersToUse= [hasher for hasher in self.__hashers if hasher[0] == "sha256"]
+		return self.__hashOfFileMatches(info, blobPath, hashersToUse or None)
+	def __sizeMatches(self, info, stats):
+		""" True if the size of a file is what info says (give or take a byte a line for text)
+		"""
+		if not info[1].has_key('size'):
+			return True
+		delta= 0
+		if info[1].has_key('lines'):
+			delta= long(info[1]['lines'])
+		size= long(info[1]['size'])
+		return size == stats.st_size or abs(size - stats.st_size) == delta
+	def __mtimeMatches(self, info, stats):
+		if not info[1].has_key('modified'):
+			return True
+		return abs(stats.st_mtime - parseDate(info[1]['modified'])) < 0.1
+	def __blockSize(self, info):
+		size= None
+		if info[1].has_key('size'):
+			size= long(info[1]['size'])
+		return adaptiveBlockSize(size, self.__size)
+	def __makeParentDirectory(self, fullPath):
+		parent= os.path.split(fullPath)[0]
+		if not os.path.isdir(parent):
+			try:
+				os.makedirs(parent)
+			except OSError:
+				if not os.path.isdir(parent): # another worker may have just created it
+					raise
 	def __addProblem(self, info, description):
-		if info[1]['path'] not in self.__problems:
-			self.__problems.append( (info[1]['path'], description) )
+		self.__problemsLock.acquire()
+		try:
+			descriptions= self.__problems.setdefault(info[1]['path'], [])
+			if description not in descriptions:
+				descriptions.append(description)
+				self.__problemOrder.append( (info[1]['path'], description) )
+		finally:
+			self.__problemsLock.release()
 		if self.__fix < 0:
 			raise SyntaxError(description)
 	def __stat(self, fullPath, info, isText, hashes):
@@ -556,9 +1093,10 @@ class VerifyHandler:
 				#print "\t","Using"
 				hashersToUse.append(hasher)
 		return hashersToUse
-	def __hashOfFileMatches(self, info, fullPath):
+	def __hashOfFileMatches(self, info, fullPath, hashersToUse= None):
 		#print "__hashOfFileMatches(",info,",",fullPath,")"
-		hashersToUse= self.__commonHashers(info)
+		if not hashersToUse:
+			hashersToUse= self.__commonHashers(info)
 		#print "\t",hashersToUse
 		existingFile= open(fullPath, 'r')
 		(numberOfLines, hashes)= transferAndHash(
@@ -567,7 +1105,7 @@ class VerifyHandler:
 									None,
 									info[1].has_key('lines'), # is text
 									None, # no eol to replace, we're not writing
-									self.__size
+									self.__blockSize(info)
 								)
 		isText= (numberOfLines >= 0) and info[1].has_key('lines')
 		#print "\t",isText,numberOfLines,hashes
@@ -609,9 +1147,16 @@ class VerifyHandler:
 						pass
 	def notify(self, info):
 		#print "info",info
+		self.__exist.add(info[1]['path']) # keep track of all paths
+		if None != self.__changed and info[1]['path'] not in self.__changed:
+			return # as it was restored
+		if info[0] == "file" and self.__pool.workers() > 1:
+			self.__pending.append(info, self.__pool.submit(self.__verify, (info,)))
+		else:
+			self.__verify(info)
+	def __verify(self, info):
 		looksLikeText= None
 		hashes= None
-		self.__exist.append(info[1]['path']) # keep track of all paths
 		fullPath= os.path.join(self.__base, info[1]['path'])
 		#print "1",fullPath,os.path.exists(fullPath),os.path.isfile(fullPath),os.path.isdir(fullPath),os.path.islink(fullPath)
 		#print "fullPath",fullPath
@@ -654,11 +1199,7 @@ class VerifyHandler:
 			if info[0] != "link":
 				self.__addProblem(info, "Unable to create %s at %s"%(info[0], fullPath))
 			return
-		mtimeMatches= True
-		if info[1].has_key('modified'):
-			expectedmtime= parseDate(info[1]['modified'])
-			#print info
-			mtimeMatches= abs(stats.st_mtime - expectedmtime) < 0.1
+		mtimeMatches= self.__mtimeMatches(info, stats)
 		sizeMatches= True
 		if info[1].has_key('size'):
 			delta= 0
@@ -696,6 +1237,15 @@ class VerifyHandler:
 							(looksLikeText, hashes)= self.__create(fullPath, info, report= False)
 							#print "a",fullPath,os.path.exists(fullPath),os.path.isfile(fullPath),os.path.isdir(fullPath),os.path.islink(fullPath)
 							wasCreated= True
+		if isfile and not wasCreated and self.__blobs and stats.st_nlink > 1 and self.__fix > 0 and self.__archive and (
+				expectedExecutable != executable or expectedReadonly != readonly or not mtimeMatches):
+			self.__addProblem(info, "Permissions or modification date were not correct: "+fullPath)
+			#print "7 fullyDeleteDirectoryHierarchy ",fullPath
+			fullyDeleteDirectoryHierarchy(fullPath) # linked to the blob store, changing it would change every copy
+			(looksLikeText, hashes)= self.__create(fullPath, info, report= False)
+			(stats, isdir, isfile, mods, readonly, executable)= statWrapper(fullPath)
+			mtimeMatches= self.__mtimeMatches(info, stats)
+			wasCreated= True
 		# full validation validates files just created
 		if isfile and wasCreated and self.__fix > 1:
 			if not self.__hashOfFileMatches(info, fullPath):
@@ -753,6 +1303,10 @@ class VerifyHandler:
 					#print "utime", (fullPath, info)
 					#print (stats, isdir, isfile, mods, readonly, executable, looksLikeText, hashes, wasCreated)
 					os.utime(fullPath, (stats.st_atime, parseDate(info[1]['modified'])) )
+		if isfile and wasCreated:
+			blobKey= self.__blobKey(info)
+			if blobKey:
+				self.__blobs.add(blobKey, fullPath) # finished, with its permissions and times
 
 def __copyHashers(hashers):
 	copy= []
@@ -761,33 +1315,175 @@ def __copyHashers(hashers):
 		copy.append( (hasher[0], hasher[1].copy(), True) )
 	return copy
 
-def validate(manifest, path, fixLevel, hashers, decoders, key, signatures, platformEOL, archive, blockTransferSize):
+def __validateBinaryManifest(data, hashers, key, binarySignatures):
+	""" raises AssertionError unless data is signed by key with one of binarySignatures we have a hasher for
+	"""
+	checked= False
+	for hasher in hashers:
+		for signature in binarySignatures:
+			if hasher[0] == signature[0]:
+				digest= hasher[1].copy()
+				digest.update(data)
+				if not key.validate(long(signature[1], 16), long(digest.hexdigest(), 16)):
+					raise AssertionError("Invalid Signature: "+hasher[0])
+				checked= True
+	if not checked:
+		raise AssertionError("Binary manifest is not signed")
+
+def validate(manifest, path, fixLevel, hashers, decoders, key, signatures, platformEOL, archive, blockTransferSize, workers= 1,
+				blobs= None, changed= None, binaryManifest= None, binarySignatures= None):
 	""" signatures is a list of tuples of (algorithm, signature, isText)
+		workers is the number of threads to check/restore files with (see VerifyHandler)
+		blobs is a bBlobStore.BlobStore to share restored files through (see VerifyHandler)
+		changed is the set of relative paths to check, None for all (see VerifyHandler)
+		binaryManifest is a stream ( .read() ) of the binary manifest to use instead of manifest
+			(see bBinaryManifest), only the entries of changed paths are looked up in it
+		binarySignatures is a list of (algorithm, signature) the binary manifest must be signed with (if key)
 	"""
+	if binaryManifest:
+		data= binaryManifest.read()
+		if key and archive and hashers:
+			__validateBinaryManifest(data, hashers, key, binarySignatures or [])
+		reader= bBinaryManifest.BinaryManifest(data)
+		verifier= VerifyHandler(path, fixLevel, archive, hashers, platformEOL, blockTransferSize, workers, blobs,
+								changed)
+		if None == changed:
+			for entry in reader.entries():
+				verifier.notify(entry)
+		else:
+			for relativePath in sorted(changed):
+				entry= reader.find(relativePath)
+				if entry:
+					verifier.notify(entry)
+		return verifier.finish(SkipFilter(reader.skipPaths(), reader.skipExtensions(), reader.skipNames()))
 	if key and archive and hashers and signatures:
 		manifestHashers= __copyHashers(hashers)
 	else:
 		manifestHashers= []
 	manifestStream= StreamHasher(manifest, manifestHashers)
-	verifier= VerifyHandler(path, fixLevel, archive, hashers, platformEOL, blockTransferSize)
+	verifier= VerifyHandler(path, fixLevel, archive, hashers, platformEOL, blockTransferSize, workers, blobs,
+							changed)
 	comparitor= ManifestCompare(verifier, decoders)
-	parser= xml.sax.make_parser()
-	parser.setContentHandler(comparitor)
-	parser.parse(manifestStream)
+	comparitor.parse(manifestStream)
 	for hash in manifestHashers:
 		for signature in signatures:
 			if hash[0] == signature[0] and hash[2] == signature[2]:
 				expected= long(hash[1].hexdigest(), 16)
 				if not key.validate(long(signature[1], 16), expected):
 					raise AssertionError("Invalid Signature: "+hash[0])
-	return verifier.finish(
-		comparitor.skipPaths(),
-		comparitor.skipExtensions(),
-		comparitor.skipNames()
-	)
+	return verifier.finish(comparitor.skipFilter())
+
+def __writeEntryStart(hashedOut, xmlencoder, fullPath, relativePath, stats, isdir, isfile, readonly, executable):
+	""" writes the opening of a manifest tag for a file, link or directory
+		returns the tag type or None if it is not something we put in a manifest
+	"""
+	tagType= None
+	if isdir:
+		tagType= "directory"
+		hashedOut.write("\t<%s"%(tagType))
+	elif stat.S_ISLNK(stats.st_mode):
+		tagType= "link"
+		hashedOut.write("\t<%s target='%s'"%(tagType, xmlencoder.encode(os.readlink(fullPath))))
+	elif isfile:
+		tagType= "file"
+		hashedOut.write("\t<%s size='%d'"%(tagType, stats.st_size))
+	else:
+		return None # not a file/link/directory, skip it
+	if readonly:
+		hashedOut.write(" readonly='true'")
+	if executable:
+		hashedOut.write(" executable='true'")
+	hashedOut.write(" path='%s' modified='%s'"%(
+		xmlencoder.encode(relativePath),
+		formatDate(stats.st_mtime),
+	))
+	return tagType
+
+def __writeEntryHashes(hashedOut, numberOfLines, hashes, detectText):
+	if numberOfLines >= 0 and detectText:
+		hashedOut.write(" lines='%d'"%(numberOfLines))
+	hashedOut.write(">\n") # close on file tag
+	for hash in hashes:
+		if hash[2]:
+			isText= " text='true'"
+		else:
+			isText= ""
+		hashedOut.write("\t\t<hash algorithm='%s'%s>%s</hash>\n"%(hash[0], isText, hash[1]))
+
+def __writeEntryEnd(hashedOut, fullPath, tagType, encoders):
+	if kXattrAvailable:
+		try:
+			attrs= xattr.listxattr(fullPath)
+			for attr in attrs:
+				try:
+					value= xattr.getxattr(fullPath, attr, True)
+					bestEncoding= None
+					bestEncodingName= None
+					for encoder in encoders:
+						encoded= encoder[1].encode(value)
+						if not bestEncoding or len(encoded) < len(bestEncoding):
+							bestEncoding= encoded
+							bestEncodingName= encoder[0]
+					if bestEncodingName:
+						encoding= " encoding='%s'"%(bestEncodingName)
+						value= bestEncoding
+					else:
+						encoding= ""
+					hashedOut.write("\t\t<xattr name='%s'%s>%s</xattr>\n"%(attr, encoding, value))
+				except KeyboardInterrupt,e:
+					raise e
+				except: # can't read this attribute
+					reportException()
+					pass
+		except KeyboardInterrupt,e:
+			raise e
+		except: # something went wrong
+			reportException()
+			pass
+	hashedOut.write("\t</%s>\n"%(tagType))
+
+def __archiveOnly(fullPath, relativePath, archive, blockTransferSize):
+	""" puts a file in the archive without hashing it (we already know its hashes)
+	"""
+	__archiveAndHash(fullPath, relativePath, None, archive, False, blockTransferSize)
+
+def __archiveAndHash(fullPath, relativePath, hashers, archive, detectText, blockTransferSize):
+	""" reads the file once, streaming it into the archive while calculating the hashes
+	"""
+	archiveFile= None
+	if archive:
+		archiveFile= archive.open(relativePath, 'w', stats= os.stat(fullPath)) # same as archive.store
+	sourceFile= open(fullPath, 'r')
+	(numberOfLines, hashes)= transferAndHash(
+								sourceFile,
+								hashers,
+								archiveFile,
+								detectText,
+								None, # no line ending change when archiving
+								blockTransferSize
+							)
+	sourceFile.close()
+	if archiveFile:
+		archiveFile.close()
+	return (numberOfLines, hashes)
+
+def __hashFileInWorker(fullPath, hasherNames, detectText, blockTransferSize):
+	""" Runs in a worker process for generate(workers > 1)
+		hashers cannot be sent between processes, so they are recreated by name
+	"""
+	hashers= []
+	for name in hasherNames:
+		hashers.append( (name, hashlib.new(name)) )
+	sourceFile= open(fullPath, 'r')
+	try:
+		return transferAndHash(sourceFile, hashers, None, detectText, None, blockTransferSize)
+	finally:
+		sourceFile.close()
 
 def generate(path, out, hashers, encoders, key, signature, archive, detectText,
-				skipPaths, skipExtensions, skipNames, blockTransferSize):
+				skipPaths, skipExtensions, skipNames, blockTransferSize, workers= 1, cache= None,
+				profile= None, textSampleThreshold= None, previous= None, skipFilter= None, prefetch= 0,
+				binaryManifest= None):
 	""" generates an XML manifest from a location
 		path is location to start generating
 		out the stream to write the xml manfifest to ( .write(block) )
@@ -797,11 +1493,31 @@ def generate(path, out, hashers, encoders, key, signature, archive, detectText,
 			also will generate text hashes (if hashers passed in)
 		archive a place to stream files as we check them
 			( .open(relpath, 'w') -> .write(block) .close()  )
-			or ( .open(relpath, 'w') -> store(filePath, archivePath) .close() )
+			each file is read once, streamed into the archive as it is hashed
+			parallel hashing adds files with .store(filePath, archivePath) instead
 		skipPaths, skipNames, skipExtensions lists of things to not add to the manifest
+		skipFilter the SkipFilter of them (compiled from them if None), skipped directories aren't walked
+		prefetch the number of threads to list directories ahead of the walk with (see bWalk.walk)
+		workers is the number of processes to hash files with
+			1 hashes on this process, 0 or None uses one process per processor
+			manifest entries are written in the same order regardless of workers
+			parallel hashing requires archive to support store(filePath, archivePath)
+		cache is a bHashCache.HashCache to reuse hashes of unchanged files from
+			( .lookup(relpath, stats) -> result or None, .store(relpath, stats, result) )
+		profile is the name of the hash profile hashers came from, recorded in the manifest
+			if hashers is None, the profile's hashers are used
+		textSampleThreshold if not None, files larger than this many bytes (with detectText)
+			are judged text or binary from their first kTextSampleSize bytes (SampledTextDetector)
+		previous is (name, files) to generate a delta of a previous export
+			files is relative path -> properties from the previous manifest (see manifestFiles)
+			files with the same size and hashes as before are not archived, they are marked from='name'
+		binaryManifest a stream to write a binary manifest of the same entries to ( .write(block) )
+			(see bBinaryManifest), it is signed in signature with <signedbinary> elements
 	"""
 	if isinstance(out, basestring): # if out was a path instead of a stream
 		out= open(out, 'w')
+	if None == hashers and profile:
+		hashers= hashProfile(profile)
 	if not hashers:
 		hashers= []
 	if not encoders:
@@ -812,119 +1528,104 @@ def generate(path, out, hashers, encoders, key, signature, archive, detectText,
 		skipNames= []
 	if not skipExtensions:
 		skipExtensions= []
+	if not skipFilter:
+		skipFilter= SkipFilter(skipPaths, skipExtensions, skipNames)
 	if key and not key.isPrivate():
 		raise AssertionError("key must be a private key to sign")
 	if key and archive and hashers and signature:
 		manifestHashers= __copyHashers(hashers)
 	else:
 		manifestHashers= []
+	binaryHashers= []
+	if binaryManifest:
+		binaryWriter= bBinaryManifest.BinaryManifestWriter()
+		binaryReader= ManifestCompare(binaryWriter, encoders) # read back what is written, to write it again
+		out= ManifestTee(out, binaryReader)
+		binaryHashers= [hash for hash in manifestHashers if not hash[2]]
+		binaryHashers= [(hash[0], hash[1].copy(), False) for hash in binaryHashers]
 	hashedOut= StreamHasher(out, manifestHashers)
-	hashedOut.write("<manifest>\n")
 	xmlencoder= XMLCodec()
+	hashedOut.write("<manifest")
+	if profile:
+		hashedOut.write(" profile='%s'"%(xmlencoder.encode(profile)))
+	if previous and archive:
+		hashedOut.write(" from='%s'"%(xmlencoder.encode(previous[0])))
+	hashedOut.write(">\n")
 	for item in skipPaths:
 		hashedOut.write("\t<filter path='%s'/>\n"%(xmlencoder.encode(item)))
 	for item in skipNames:
 		hashedOut.write("\t<filter name='%s'/>\n"%(xmlencoder.encode(item)))
 	for item in skipExtensions:
 		hashedOut.write("\t<filter extension='%s'/>\n"%(xmlencoder.encode(item)))
-	for (directory, dirs, files) in os.walk(path, topdown= True):
-		baseRelativePath= getSubPathRelative(path, directory)
-		if skip(baseRelativePath, skipPaths, skipExtensions, skipNames):
-			continue # don't bother walking all items if this path is skipped
-		#print "working in",path,baseRelativePath
-		items= list(dirs)
-		items.extend(files)
-		for item in items:
-			fullPath= os.path.join(directory, item)
-			relativePath= os.path.join(baseRelativePath, item)
+	pool= bWorkers.Pool(workers, processes= True)
+	hasherNames= []
+	for hasher in hashers:
+		hasherNames.append(hasher[0])
+	def writeEntry(entry, hashResult):
+		(fullPath, relativePath, stats, isdir, isfile, readonly, executable, previousFile)= entry
+		tagType= __writeEntryStart(hashedOut, xmlencoder, fullPath, relativePath,
+									stats, isdir, isfile, readonly, executable)
+		if hashResult:
+			if cache:
+				cache.store(relativePath, stats, hashResult)
+			if previousFile and previousFile.has_key('hash') and hashListsMatch(
+											hashResult[1], previousFile['hash'], valueIfNotFound= False):
+				hashedOut.write(" from='%s'"%(xmlencoder.encode(previous[0])))
+			elif previousFile: # changed, so it goes in the delta after all
+				__archiveOnly(fullPath, relativePath, archive, adaptiveBlockSize(stats.st_size, blockTransferSize))
+			__writeEntryHashes(hashedOut, hashResult[0], hashResult[1], detectText)
+		else:
+			hashedOut.write(">\n") # close on directory, link and file tags (files we didn't open)
+		__writeEntryEnd(hashedOut, fullPath, tagType, encoders)
+	entries= bWorkers.OrderedResults(writeEntry, maximumInFlight= 4 * pool.workers())
+	try:
+		for (relativePath, item, stats) in bWalk.walk(path, skipFilter, prefetch= prefetch):
+			fullPath= item.path
 			#print "looking at",fullPath,relativePath
-			if skip(relativePath, skipPaths, skipExtensions, skipNames):
-				continue
-			(stats, isdir, isfile, mods, readonly, executable)= statWrapper(fullPath)
-			tagType= None
-			if isdir:
-				tagType= "directory"
-				hashedOut.write("\t<%s"%(tagType))
-			elif stat.S_ISLNK(stats.st_mode):
-				tagType= "link"
-				hashedOut.write("\t<%s target='%s'"%(tagType, xmlencoder.encode(os.readlink(fullPath))))
-			elif isfile:
-				tagType= "file"
-				hashedOut.write("\t<%s size='%d'"%(tagType, stats.st_size))
-			else:
+			(stats, isdir, isfile, mods, readonly, executable)= statDetails(stats)
+			if not isdir and not isfile and not stat.S_ISLNK(stats.st_mode):
 				continue # not a file/link/directory, skip it
-			if readonly:
-				hashedOut.write(" readonly='true'")
-			if executable:
-				hashedOut.write(" executable='true'")
-			hashedOut.write(" path='%s' modified='%s'"%(
-				xmlencoder.encode(relativePath),
-				formatDate(stats.st_mtime),
-			))
+			previousFile= None
+			if previous and archive and isfile:
+				previousFile= previous[1].get(relativePath)
+				if previousFile and long(previousFile.get('size', -1)) != stats.st_size:
+					previousFile= None # changed, no need to hash it before archiving it
+			entry= (fullPath, relativePath, stats, isdir, isfile, readonly, executable, previousFile)
+			fileArchive= archive
+			if previousFile:
+				fileArchive= None # only archived if it changed, once we have its hashes
+			hashResult= None
 			if (archive or hashers or detectText) and isfile:
-				archiveFile= None
-				if archive:
-					try: # if the archive doesn't support streaming, just store the file
-						archive.store(fullPath, relativePath)
-					except KeyboardInterrupt,e:
-						raise e
-					except: # does support streaming, store the file while calculating the hashes
-						reportException()
-						archiveFile= archive.open(relativePath, 'w')
-				sourceFile= open(fullPath, 'r')
-				(numberOfLines, hashes)= transferAndHash(
-											sourceFile,
-											hashers,
-											archiveFile,
-											detectText,
-											None, # no line ending change when archiving
-											blockTransferSize
-										)
-				sourceFile.close()
-				if archiveFile:
-					archiveFile.close()
-				if numberOfLines >= 0 and detectText:
-					hashedOut.write(" lines='%d'"%(numberOfLines))
-				hashedOut.write(">\n") # close on file tag
-				for hash in hashes:
-					if hash[2]:
-						isText= " text='true'"
-					else:
-						isText= ""
-					hashedOut.write("\t\t<hash algorithm='%s'%s>%s</hash>\n"%(hash[0], isText, hash[1]))
-			else:
-				hashedOut.write(">\n") # close on directory, link and file tags (files we didn't open)
-			if kXattrAvailable:
-				try:
-					attrs= xattr.listxattr(fullPath)
-					for attr in attrs:
-						try:
-							value= xattr.getxattr(fullPath, attr, True)
-							bestEncoding= None
-							bestEncodingName= None
-							for encoder in encoders:
-								encoded= encoder[1].encode(value)
-								if not bestEncoding or len(encoded) < len(bestEncoding):
-									bestEncoding= encoded
-									bestEncodingName= encoder[0]
-							if bestEncodingName:
-								encoding= " encoding='%s'"%(bestEncodingName)
-								value= bestEncoding
-							else:
-								encoding= ""
-							hashedOut.write("\t\t<xattr name='%s'%s>%s</xattr>\n"%(attr, encoding, value))
-						except KeyboardInterrupt,e:
-							raise e
-						except: # can't read this attribute
-							reportException()
-							pass
-				except KeyboardInterrupt,e:
-					raise e
-				except: # something went wrong
-					reportException()
-					pass
-			hashedOut.write("\t</%s>\n"%(tagType))
+				blockSize= adaptiveBlockSize(stats.st_size, blockTransferSize)
+				fileDetectText= detectText
+				if detectText and None != textSampleThreshold and stats.st_size > textSampleThreshold:
+					fileDetectText= SampledTextDetector
+				cached= None
+				if cache:
+					cached= cache.lookup(relativePath, stats)
+				if cached:
+					if fileArchive:
+						__archiveOnly(fullPath, relativePath, fileArchive, blockSize)
+					hashResult= bWorkers.CompletedResult(cached)
+				elif pool.workers() > 1 and (not archive or hasattr(archive, 'store')):
+					if fileArchive:
+						fileArchive.store(fullPath, relativePath)
+					hashResult= pool.submit(__hashFileInWorker,
+								(fullPath, hasherNames, fileDetectText, blockSize))
+				else:
+					hashResult= bWorkers.ImmediateResult(__archiveAndHash,
+								(fullPath, relativePath, hashers, fileArchive, fileDetectText, blockSize))
+			entries.append(entry, hashResult)
+		entries.drain()
+		pool.close()
+	except:
+		pool.terminate()
+		raise
 	hashedOut.write("</manifest>\n")
+	if binaryManifest:
+		binaryReader.feed("", True)
+		binaryWriter.write(StreamHasher(binaryManifest, binaryHashers), binaryReader.profile(),
+							binaryReader.base(), skipPaths, skipNames, skipExtensions)
 	if manifestHashers:
 		signature.write("<signature key='%s'>\n"%(key.public()))
 		for hash in manifestHashers:
@@ -936,6 +1637,11 @@ def generate(path, out, hashers, encoders, key, signature, archive, detectText,
 				hash[0], hash[1].hexdigest(), isText,
 				key.sign(long(hash[1].hexdigest(), 16))
 			))
+		for hash in binaryHashers:
+			signature.write("\t<signedbinary algorithm='%s' hash='%s'>%x</signedbinary>\n"%(
+				hash[0], hash[1].hexdigest(),
+				key.sign(long(hash[1].hexdigest(), 16))
+			))
 		signature.write("</signature>\n")
 
 if kHashLibAvailable:
@@ -947,54 +1653,343 @@ if kHashLibAvailable:
 	for algorithm in __knownAlgorithms:
 		kAllKnownHashes.append( (algorithm, hashlib.new(algorithm)) )
 	kMD5Hash= ( ("md5", hashlib.new("md5")), )
+	kSHA256Hash= ( ("sha256", hashlib.new("sha256")), )
 else:
 	kMD5Hash= ( ('md5', md5.new()), )
 	kAllKnownHashes= kMD5Hash
+	kSHA256Hash= kMD5Hash
+
+""" Hash profiles are the sets of hashers an export can be generated with
+		compat - every algorithm we know (what all exports used to have)
+		fast - one strong digest
+	validate uses whatever algorithms a manifest has in common with the hashers it is given,
+	so validating with kAllKnownHashes works for every profile
+"""
+kHashProfiles= {
+	'compat': kAllKnownHashes,
+	'fast': kSHA256Hash,
+}
+kDefaultHashProfile= 'compat'
+
+def hashProfile(name):
+	""" returns the hashers for a profile name (None for the default profile)
+	"""
+	if not name:
+		name= kDefaultHashProfile
+	if not kHashProfiles.has_key(name):
+		raise SyntaxError("Unknown hash profile: "+name)
+	return kHashProfiles[name]
+
+# files larger than this are compressed on the calling thread, as they are added to the archive
+kLargestParallelZipEntry= 16 * 1024 * 1024
+
+def zipInfo(archivePath, stats= None):
+	""" ZipInfo for a file in the archive, with the times and permissions from stats if given
+	"""
+	if stats:
+		info= zipfile.ZipInfo(archivePath, time.localtime(stats.st_mtime)[:6])
+		info.external_attr= (stats.st_mode & 0xFFFF) << 16
+	else:
+		info= zipfile.ZipInfo(archivePath, time.localtime(time.time())[:6])
+		info.external_attr= 0600 << 16
+	info.file_size= 0
+	info.compress_size= 0
+	info.CRC= 0
+	return info
+
+def zipStartEntry(zipFile, info):
+	""" writes the local header of a new entry (the same way zipfile.ZipFile.write does)
+	"""
+	info.header_offset= zipFile.fp.tell()
+	zipFile._writecheck(info)
+	zipFile._didModify= True
+	zipFile.fp.write(info.FileHeader())
+
+def zipFinishEntry(zipFile, info):
+	""" rewrites the local header now that the crc and sizes are known and adds the entry
+	"""
+	if info.file_size > zipfile.ZIP64_LIMIT or info.compress_size > zipfile.ZIP64_LIMIT:
+		raise zipfile.LargeZipFile(info.filename+" is too large for the header already written")
+	position= zipFile.fp.tell()
+	zipFile.fp.seek(info.header_offset, 0)
+	zipFile.fp.write(info.FileHeader())
+	zipFile.fp.seek(position, 0)
+	zipFile.filelist.append(info)
+	zipFile.NameToInfo[info.filename]= info
+
+def zipCompress(contents, compressType, level):
+	""" returns (crc, compressed contents, seconds spent compressing)
+	"""
+	crc= zlib.crc32(contents) & 0xffffffff
+	if compressType != zipfile.ZIP_DEFLATED:
+		return (crc, contents, 0.0)
+	start= time.time()
+	compressor= zlib.compressobj(level, zlib.DEFLATED, -15)
+	compressed= compressor.compress(contents) + compressor.flush()
+	return (crc, compressed, time.time() - start)
+
+def zipCompressFile(filePath, archivePath, size, policy):
+	""" Runs on a ZipArchive compression thread (zlib releases the GIL while it works)
+		returns (compressType, crc, size, compressed contents, seconds spent compressing)
+	"""
+	sourceFile= open(filePath, 'rb')
+	try:
+		contents= sourceFile.read()
+	finally:
+		sourceFile.close()
+	(compressType, level)= policy.method(archivePath, size, contents[:policy.sampleSize()])
+	(crc, compressed, seconds)= zipCompress(contents, compressType, level)
+	return (compressType, crc, len(contents), compressed, seconds)
 
 class ZipArchiveWriteFile:
-	def __init__(self, path, archive):
-		likelyUniquePrefix= "ZIP_ARCHIVE_FILE_%x-%x-%x_"%(
-			time.time(),
-			random.randrange(0,100000),
-			os.getpid()
-		)
+	""" Collects a file in memory and adds it to the archive when closed
+		(for small files written while other entries are being added, like the manifest)
+	"""
+	def __init__(self, path, archive, stats= None):
 		self.__path= path
 		self.__archive= archive
-		self.__tmpPath= os.path.join(platformTempDir(), likelyUniquePrefix+os.path.split(path)[1])
-		self.__file= open(self.__tmpPath, 'w')
+		self.__stats= stats
+		self.__file= cStringIO.StringIO()
 	def write(self, block):
 		self.__file.write(block)
 	def close(self):
+		self.__archive.writeString(self.__path, self.__file.getvalue(), self.__stats)
 		self.__file.close()
-		self.__archive.store(self.__tmpPath, self.__path)
-		os.remove(self.__tmpPath)
+
+class ZipArchiveStreamFile:
+	""" Compresses a file directly into the zip as it is written
+		only one can be open on a ZipFile at a time, and nothing else may be added until it is closed
+		the local header is written with the first block and rewritten with the crc and sizes on close
+	"""
+	def __init__(self, info, zipFile, compression, finished):
+		""" info the zipfile.ZipInfo for the entry (see zipInfo)
+			compression( first block ) -> (zipfile compression type, deflate level)
+			finished( info, seconds spent compressing ) is called when the file is closed
+		"""
+		self.__info= info
+		self.__zip= zipFile
+		self.__compression= compression
+		self.__finished= finished
+		self.__compressor= None
+		self.__started= False
+		self.__seconds= 0.0
+	def __start(self, sample):
+		(self.__info.compress_type, level)= self.__compression(sample)
+		if self.__info.compress_type == zipfile.ZIP_DEFLATED:
+			self.__compressor= zlib.compressobj(level, zlib.DEFLATED, -15)
+		zipStartEntry(self.__zip, self.__info)
+		self.__started= True
+	def write(self, block):
+		if not self.__started:
+			self.__start(block)
+		self.__info.file_size+= len(block)
+		self.__info.CRC= zlib.crc32(block, self.__info.CRC) & 0xffffffff
+		if self.__compressor:
+			start= time.time()
+			block= self.__compressor.compress(block)
+			self.__seconds+= time.time() - start
+		self.__info.compress_size+= len(block)
+		self.__zip.fp.write(block)
+	def close(self):
+		if not self.__finished:
+			return
+		if not self.__started:
+			self.__start("")
+		if self.__compressor:
+			compressed= self.__compressor.flush()
+			self.__info.compress_size+= len(compressed)
+			self.__zip.fp.write(compressed)
+		zipFinishEntry(self.__zip, self.__info)
+		finished= self.__finished
+		self.__finished= None
+		finished(self.__info, self.__seconds)
 
 class ZipArchive:
-	def __init__(self, path, mode):
+	def __init__(self, path, mode, policy= None, workers= 1):
+		""" policy a bCompression.CompressionPolicy that decides how each file is compressed
+				None for the default policy
+			workers the number of threads to compress files added with store() on
+				entries are still added to the archive in the order they were stored
+				0 or None means one per processor
+		"""
 		self.__path= path
 		self.__mode= mode
+		self.__owner= threading.currentThread()
+		self.__readers= threading.local()
+		self.__openReaders= []
+		self.__streaming= None
+		self.__policy= policy
+		if not self.__policy:
+			self.__policy= bCompression.CompressionPolicy()
+		self.__pool= None
+		self.__pending= None
+		self.__statistics= {
+			'archive entries stored': 0,
+			'archive entries deflated': 0,
+			'archive bytes stored without compressing': 0,
+			'archive bytes saved by compressing': 0,
+			'archive seconds compressing': 0.0,
+		}
 		if 'r' == mode:
 			self.__file= zipfile.ZipFile(path, mode)
 		elif 'w' == mode or 'a' == mode:
 			self.__file= zipfile.ZipFile(path, mode, zipfile.ZIP_DEFLATED)
+			self.__pool= bWorkers.Pool(workers, processes= False)
+			self.__pending= bWorkers.OrderedResults(self.__addStored, 2 * self.__pool.workers())
 			mode= 'w'
+	def statistics(self):
+		""" what compressing the entries written so far cost and saved
+		"""
+		return self.__statistics
 	def store(self, filePath, archivePath):
-		self.__file.write(filePath, archivePath, zipfile.ZIP_DEFLATED)
-	def open(self, path, mode):
+		""" adds a file from disk, compressed on a worker thread if there are workers
+		"""
+		self.__checkNotStreaming(archivePath)
+		stats= os.stat(filePath)
+		result= None
+		if self.__pool.workers() > 1 and stats.st_size <= kLargestParallelZipEntry:
+			result= self.__pool.submit(zipCompressFile, (filePath, archivePath, stats.st_size, self.__policy))
+		self.__pending.append( (filePath, archivePath, stats), result )
+	def writeString(self, archivePath, contents, stats= None):
+		""" stats the os.stat of the file contents came from (its times and permissions are kept)
+		"""
+		self.__checkNotStreaming(archivePath)
+		self.__pending.drain()
+		info= zipInfo(archivePath, stats)
+		(info.compress_type, level)= self.__policy.method(archivePath, len(contents),
+															contents[:self.__policy.sampleSize()])
+		(info.CRC, compressed, seconds)= zipCompress(contents, info.compress_type, level)
+		self.__writeEntry(info, len(contents), compressed, seconds)
+	def open(self, path, mode, buffered= False, stats= None):
+		""" mode 'w' streams the file into the archive as it is written
+				buffered if True, the file is kept in memory until closed
+					use this for files written while other entries are added (manifest, signature)
+					files are also buffered if another file is being streamed
+				stats the os.stat of the file being written, its times and permissions are kept like store()
+					(None for the current time and 0600)
+		"""
 		if self.__mode != mode:
 			raise SyntaxError("Archive opened with mode "+self.__mode+" but now using "+mode)
 		if mode == 'w':
-			return ZipArchiveWriteFile(path, self)
+			if buffered or self.__streaming:
+				return ZipArchiveWriteFile(path, self, stats)
+			self.__pending.drain()
+			self.__streaming= path
+			size= None
+			if stats:
+				size= stats.st_size
+			return ZipArchiveStreamFile(zipInfo(path, stats), self.__file,
+				lambda sample: self.__policy.method(path, size, sample),
+				self.__streamFinished
+			)
 		elif mode == 'r':
+			reader= self.__reader()
 			try:
-				return self.__file.open(path, mode)
+				return reader.open(path, mode)
 			except:
 				#reportException() ZipFile.open not in this version
-				return cStringIO.StringIO(self.__file.read(path))
+				return cStringIO.StringIO(reader.read(path))
+	def has(self, path):
+		try:
+			self.__reader().getinfo(path)
+			return True
+		except KeyError:
+			return False
+	def __addStored(self, payload, value):
+		""" adds a file given to store(), in the order they were stored
+			value is the result of zipCompressFile or None to compress the file now
+		"""
+		(filePath, archivePath, stats)= payload
+		info= zipInfo(archivePath, stats)
+		if value:
+			(info.compress_type, info.CRC, size, compressed, seconds)= value
+			self.__writeEntry(info, size, compressed, seconds)
+			return
+		self.__streaming= archivePath
+		archiveFile= ZipArchiveStreamFile(info, self.__file,
+			lambda sample: self.__policy.method(archivePath, stats.st_size, sample),
+			self.__streamFinished
+		)
+		sourceFile= open(filePath, 'rb')
+		try:
+			while True:
+				block= sourceFile.read(kLargestBlockSize)
+				if not block:
+					break
+				archiveFile.write(block)
+		finally:
+			sourceFile.close()
+		archiveFile.close()
+	def __writeEntry(self, info, size, compressed, seconds):
+		info.file_size= size
+		info.compress_size= len(compressed)
+		zipStartEntry(self.__file, info)
+		self.__file.fp.write(compressed)
+		zipFinishEntry(self.__file, info)
+		self.__entryAdded(info, seconds)
+	def __streamFinished(self, info, seconds):
+		self.__streaming= None
+		self.__entryAdded(info, seconds)
+	def __entryAdded(self, info, seconds):
+		if info.compress_type == zipfile.ZIP_DEFLATED:
+			self.__statistics['archive entries deflated']+= 1
+			self.__statistics['archive bytes saved by compressing']+= info.file_size - info.compress_size
+		else:
+			self.__statistics['archive entries stored']+= 1
+			self.__statistics['archive bytes stored without compressing']+= info.file_size
+		self.__statistics['archive seconds compressing']+= seconds
+	def __checkNotStreaming(self, archivePath):
+		if self.__streaming:
+			raise SyntaxError("Cannot add "+archivePath+" while "+self.__streaming+" is being written")
+	def __reader(self):
+		""" ZipFile members share the file position, so other threads read through their own ZipFile
+		"""
+		if threading.currentThread() is self.__owner:
+			return self.__file
+		try:
+			return self.__readers.file
+		except AttributeError:
+			self.__readers.file= zipfile.ZipFile(self.__path, 'r')
+			self.__openReaders.append(self.__readers.file)
+			return self.__readers.file
 	def close(self):
+		if self.__pending:
+			try:
+				self.__pending.drain()
+				self.__pool.close()
+			except:
+				self.__pool.terminate()
+				raise
+		for reader in self.__openReaders:
+			reader.close()
 		self.__file.close()
 
-def getSignatures(signatureFile):
+class ArchiveChain:
+	""" Reads each file from the first archive that has it
+		(a delta export followed by the exports it is a delta of)
+	"""
+	def __init__(self, archives):
+		self.__archives= archives
+	def has(self, path):
+		for archive in self.__archives:
+			if archive.has(path):
+				return True
+		return False
+	def open(self, path, mode):
+		if mode != 'r':
+			raise SyntaxError("Archive chains can only be read, not opened with mode "+mode)
+		for archive in self.__archives[:-1]:
+			if archive.has(path):
+				return archive.open(path, mode)
+		return self.__archives[-1].open(path, mode)
+	def close(self):
+		for archive in self.__archives:
+			archive.close()
+
+def getSignatures(signatureFile, binary= False):
+	""" (key, [(algorithm, signature, isText), ...]) from a signature.xml
+		binary if True, also returns the [(algorithm, signature), ...] of the binary manifest (empty if none)
+	"""
 	dom= bDOM.link(signatureFile)
 	key= dom.documentElement.getAttribute('key')
 	signatures= []
@@ -1003,7 +1998,12 @@ def getSignatures(signatureFile):
 		value= bDOM.extractTextFromTagContents(signature)
 		isText= signature.hasAttribute('text') and signature.getAttribute('text')[0].lower() == 't'
 		signatures.append( (algorithm, value, isText) )
+	binarySignatures= []
+	for signature in dom.documentElement.getElementsByTagName('signedbinary'):
+		binarySignatures.append( (signature.getAttribute('algorithm'), bDOM.extractTextFromTagContents(signature)) )
 	dom.unlink()
+	if binary:
+		return (key, signatures, binarySignatures)
 	return (key, signatures)
 
 if __name__ == "__main__":
@@ -1013,13 +2013,21 @@ if __name__ == "__main__":
 		fixLevel= int(sys.argv[3])
 	else:
 		fixLevel= -1
+	if len(sys.argv) > 4:
+		workers= int(sys.argv[4]) # 0 = one per processor
+	else:
+		workers= 1
 	if os.path.exists(archivePath):
 		archiveMode= 'r'
 	else:
 		archiveMode= 'w'
 	archive= ZipArchive(archivePath, archiveMode)
-	manifestStream= archive.open("manifest.xml", archiveMode)
-	signatureFile= archive.open("signature.xml", archiveMode)
+	if archiveMode == 'w':
+		manifestStream= archive.open("manifest.xml", archiveMode, buffered= True)
+		signatureFile= archive.open("signature.xml", archiveMode, buffered= True)
+	else:
+		manifestStream= archive.open("manifest.xml", archiveMode)
+		signatureFile= archive.open("signature.xml", archiveMode)
 	import bRSA
 	if archiveMode == 'r':
 		signatures= getSignatures(signatureFile)
@@ -1032,7 +2040,8 @@ if __name__ == "__main__":
 			key, signatures[1],
 			platformEOL(), #"\r\n", #platformEOL(), # eol to convert text files to
 			archive,
-			4096 # size of transfer blocks
+			4096, # size of transfer blocks
+			workers
 		)
 	else:
 		key= bRSA.Key(-512) # large enough to handle a sha512
@@ -1043,7 +2052,8 @@ if __name__ == "__main__":
 			key, signatureFile, archive,
 			True, # detect text
 			['old'], ['.pyc'], ['.DS_Store'], # skip paths, extensions and names
-			4096 # size of transfer blocks
+			4096, # size of transfer blocks
+			workers
 		)
 	signatureFile.close()
 	manifestStream.close()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+
+__all__ = [ 				# exported symbols from this module
+	"BinaryManifest",		# reads a binary manifest, entries can be looked up by path
+	"BinaryManifestWriter",	# notifier that collects manifest entries and writes them as a binary manifest
+]
+
+""" A binary manifest has the same entries as manifest.xml, sorted by path, so it can be binary searched
+	header, hash kinds, metadata, records (fixed width), strings
+	all numbers are little endian, strings are utf-8 and referenced by (offset, length) into the strings
+	each record ends with the raw digest of each hash kind (zeros if the entry doesn't have it)
+"""
+import time
+import struct
+import calendar
+
+kMagic= "bMAN"
+kFormat= 1
+
+# magic, format, reserved, entries, record size, hash kinds, metadata, size of strings
+kHeader= struct.Struct("<4sHHIIIII")
+# name offset, name length, digest length, is text, reserved
+kHashKind= struct.Struct("<IIHBB")
+# kind, reserved, reserved, offset, length
+kMetadata= struct.Struct("<BBHII")
+# path offset, path length, type, flags, reserved, modified, size, lines,
+#	target offset, target length, from offset, from length, more offset, more length, hash kinds present
+kRecord= struct.Struct("<IIBBHqQQIIIIIII")
+# length of a string in the more block
+kLength= struct.Struct("<I")
+
+kTypes= ["file", "directory", "link"]
+
+# record flags
+kReadonly= 0x01
+kExecutable= 0x02
+kHasSize= 0x04
+kHasLines= 0x08
+kHasModified= 0x10
+
+# metadata kinds
+kProfile= 1
+kFrom= 2
+kFilterPath= 3
+kFilterName= 4
+kFilterExtension= 5
+
+# kinds of things in the more block
+kMoreAttribute= 0
+kMoreXattr= 1 # value is a str
+kMoreUnicodeXattr= 2
+
+# the format of the modified attribute (bArchive.kReliableDateFormat)
+kDateFormat= "%Y/%m/%d@%H:%M:%S"
+
+def formatDate(timestamp):
+	return unicode(time.strftime(kDateFormat, time.gmtime(timestamp)))
+
+def parseDate(timestampString):
+	return calendar.timegm(time.strptime(timestampString, kDateFormat))
+
+class BinaryManifestWriter:
+	""" bArchive.ManifestCompare notifier that collects the entries of a manifest to write()
+	"""
+	def __init__(self):
+		self.__entries= []
+		self.__kinds= [] # (algorithm, is text, digest length)
+		self.__kindIndex= {} # (algorithm, is text) -> index in kinds
+	def notify(self, info):
+		for hash in info[1].get('hash', []):
+			kind= (hash[0], hash[2])
+			if not self.__kindIndex.has_key(kind):
+				if not hash[1] or len(self.__kinds) == 32:
+					raise SyntaxError("Cannot store %s hash of %s"%(hash[0], info[1]['path']))
+				self.__kindIndex[kind]= len(self.__kinds)
+				self.__kinds.append( (hash[0], hash[2], len(hash[1]) / 2) )
+		self.__entries.append(info)
+	def write(self, stream, profile= None, base= None, skipPaths= None, skipNames= None, skipExtensions= None):
+		""" writes the binary manifest of the entries notified to stream ( .write(block) )
+			profile, base and the skip lists are the attributes and filters of the manifest
+		"""
+		strings= StringTable()
+		kinds= ""
+		for (algorithm, isText, digestLength) in self.__kinds:
+			kinds+= kHashKind.pack(*(strings.add(algorithm) + (digestLength, isText, 0)))
+		metadata= []
+		if profile:
+			metadata.append( (kProfile, profile) )
+		if base:
+			metadata.append( (kFrom, base) )
+		metadata.extend([(kFilterPath, item) for item in skipPaths or []])
+		metadata.extend([(kFilterName, item) for item in skipNames or []])
+		metadata.extend([(kFilterExtension, item) for item in skipExtensions or []])
+		metadataBlock= ""
+		for (kind, value) in metadata:
+			metadataBlock+= kMetadata.pack(*((kind, 0, 0) + strings.add(value)))
+		digestsLength= sum([kind[2] for kind in self.__kinds])
+		entries= [(info[1]['path'].encode('utf-8'), info) for info in self.__entries]
+		entries.sort()
+		records= []
+		for (path, info) in entries:
+			records.append(self.__record(strings, info, digestsLength))
+		stream.write(kHeader.pack(kMagic, kFormat, 0, len(records), kRecord.size + digestsLength,
+									len(self.__kinds), len(metadata), strings.size()))
+		stream.write(kinds)
+		stream.write(metadataBlock)
+		for record in records:
+			stream.write(record)
+		strings.write(stream)
+	def __record(self, strings, info, digestsLength):
+		properties= info[1]
+		flags= 0
+		(modified, size, lines)= (0, 0, 0)
+		(target, source)= ((0, 0), (0, 0))
+		more= []
+		for (name, value) in properties.items():
+			if name in ('path', 'hash', 'xattr'):
+				continue
+			elif name == 'readonly' and value[:1].lower() == 't':
+				flags|= kReadonly
+			elif name == 'executable' and value[:1].lower() == 't':
+				flags|= kExecutable
+			elif name == 'size' and value.isdigit() and unicode(long(value)) == value:
+				(flags, size)= (flags | kHasSize, long(value))
+			elif name == 'lines' and value.isdigit() and unicode(long(value)) == value:
+				(flags, lines)= (flags | kHasLines, long(value))
+			elif name == 'modified' and formatDate(parseDate(value)) == value:
+				(flags, modified)= (flags | kHasModified, parseDate(value))
+			elif name == 'target':
+				target= strings.add(value)
+			elif name == 'from':
+				source= strings.add(value)
+			else:
+				more.append( (kMoreAttribute, name, value) )
+		for (name, value) in properties.get('xattr', {}).items():
+			if isinstance(value, unicode):
+				more.append( (kMoreUnicodeXattr, name, value) )
+			else:
+				more.append( (kMoreXattr, name, value) )
+		moreBlock= ""
+		for (kind, name, value) in more:
+			name= name.encode('utf-8')
+			if kind != kMoreXattr:
+				value= value.encode('utf-8')
+			moreBlock+= chr(kind) + kLength.pack(len(name)) + name + kLength.pack(len(value)) + value
+		present= 0
+		digests= ["\0" * kind[2] for kind in self.__kinds]
+		for hash in properties.get('hash', []):
+			index= self.__kindIndex[(hash[0], hash[2])]
+			digest= hash[1].decode('hex')
+			if present & (1 << index) or len(digest) != self.__kinds[index][2] or digest.encode('hex') != hash[1]:
+				raise SyntaxError("Cannot store %s hash of %s"%(hash[0], properties['path']))
+			present|= 1 << index
+			digests[index]= digest
+		return kRecord.pack(*(
+			strings.add(properties['path'])
+			+ (kTypes.index(info[0]), flags, 0, modified, size, lines)
+			+ target + source + strings.add(moreBlock, encode= False) + (present,)
+		)) + "".join(digests)
+
+class StringTable:
+	""" the strings of a binary manifest, each stored once
+	"""
+	def __init__(self):
+		self.__offsets= {} # string -> (offset, length)
+		self.__strings= []
+		self.__size= 0
+	def add(self, value, encode= True):
+		""" returns (offset, length) of value (encoded as utf-8 if encode)
+		"""
+		if encode:
+			value= value.encode('utf-8')
+		if not value:
+			return (0, 0)
+		if not self.__offsets.has_key(value):
+			self.__offsets[value]= (self.__size, len(value))
+			self.__strings.append(value)
+			self.__size+= len(value)
+		return self.__offsets[value]
+	def size(self):
+		return self.__size
+	def write(self, stream):
+		for value in self.__strings:
+			stream.write(value)
+
+class BinaryManifest:
+	""" Reads a binary manifest from a string or memory map, without reading all of it
+		entries are (file|link|directory, properties) like bArchive.ManifestCompare notifies
+	"""
+	def __init__(self, data):
+		self.__data= data
+		if len(data) < kHeader.size:
+			raise SyntaxError("Not a binary manifest")
+		(magic, format, reserved, self.__count, self.__recordSize, kindCount, metadataCount,
+			stringsSize)= kHeader.unpack_from(data, 0)
+		if magic != kMagic or format != kFormat:
+			raise SyntaxError("Not a binary manifest")
+		self.__kindsStart= kHeader.size
+		metadataStart= self.__kindsStart + kindCount * kHashKind.size
+		self.__recordsStart= metadataStart + metadataCount * kMetadata.size
+		self.__stringsStart= self.__recordsStart + self.__count * self.__recordSize
+		if self.__stringsStart + stringsSize != len(data):
+			raise SyntaxError("Binary manifest is the wrong size")
+		self.__kinds= [] # (algorithm, is text, digest length)
+		for index in range(kindCount):
+			(offset, length, digestLength, isText, reserved)= kHashKind.unpack_from(
+				data, self.__kindsStart + index * kHashKind.size
+			)
+			self.__kinds.append( (self.__string(offset, length), isText != 0, digestLength) )
+		self.__metadata= {}
+		for index in range(metadataCount):
+			(kind, reserved, reserved, offset, length)= kMetadata.unpack_from(
+				data, metadataStart + index * kMetadata.size
+			)
+			self.__metadata.setdefault(kind, []).append(self.__string(offset, length))
+	def __len__(self):
+		return self.__count
+	def __bytes(self, offset, length):
+		return self.__data[self.__stringsStart + offset:self.__stringsStart + offset + length]
+	def __string(self, offset, length):
+		return self.__bytes(offset, length).decode('utf-8')
+	def __path(self, index):
+		(offset, length)= struct.unpack_from("<II", self.__data, self.__recordsStart + index * self.__recordSize)
+		return self.__bytes(offset, length)
+	def entry(self, index):
+		start= self.__recordsStart + index * self.__recordSize
+		(pathOffset, pathLength, type, flags, reserved, modified, size, lines,
+			targetOffset, targetLength, fromOffset, fromLength, moreOffset, moreLength,
+			present)= kRecord.unpack_from(self.__data, start)
+		properties= {'path': self.__string(pathOffset, pathLength)}
+		if flags & kReadonly:
+			properties['readonly']= u'true'
+		if flags & kExecutable:
+			properties['executable']= u'true'
+		if flags & kHasSize:
+			properties['size']= unicode(size)
+		if flags & kHasLines:
+			properties['lines']= unicode(lines)
+		if flags & kHasModified:
+			properties['modified']= formatDate(modified)
+		if targetLength:
+			properties['target']= self.__string(targetOffset, targetLength)
+		if fromLength:
+			properties['from']= self.__string(fromOffset, fromLength)
+		more= self.__bytes(moreOffset, moreLength)
+		while more:
+			kind= ord(more[0])
+			nameLength= kLength.unpack_from(more, 1)[0]
+			name= more[1 + kLength.size:1 + kLength.size + nameLength].decode('utf-8')
+			more= more[1 + kLength.size + nameLength:]
+			valueLength= kLength.unpack_from(more, 0)[0]
+			value= more[kLength.size:kLength.size + valueLength]
+			more= more[kLength.size + valueLength:]
+			if kind == kMoreAttribute:
+				properties[name]= value.decode('utf-8')
+			elif kind == kMoreUnicodeXattr:
+				properties.setdefault('xattr', {})[name]= value.decode('utf-8')
+			else:
+				properties.setdefault('xattr', {})[name]= value
+		if present:
+			hashes= []
+			digestStart= start + kRecord.size
+			for (algorithm, isText, digestLength) in self.__kinds:
+				if present & 1:
+					digest= self.__data[digestStart:digestStart + digestLength]
+					hashes.append( (algorithm, unicode(digest.encode('hex')), isText) )
+				present>>= 1
+				digestStart+= digestLength
+			properties['hash']= hashes
+		return (kTypes[type], properties)
+	def entries(self):
+		""" every entry, sorted by path
+		"""
+		for index in range(self.__count):
+			yield self.entry(index)
+	def find(self, path):
+		""" the entry for a relative path (None if there isn't one)
+			binary searches the records
+		"""
+		if isinstance(path, unicode):
+			path= path.encode('utf-8')
+		(low, high)= (0, self.__count)
+		while low < high:
+			middle= (low + high) / 2
+			if self.__path(middle) < path:
+				low= middle + 1
+			else:
+				high= middle
+		if low < self.__count and self.__path(low) == path:
+			return self.entry(low)
+		return None
+	def profile(self):
+		return self.__metadata.get(kProfile, [None])[0]
+	def base(self):
+		return self.__metadata.get(kFrom, [None])[0]
+	def skipPaths(self):
+		return self.__metadata.get(kFilterPath, [])
+	def skipNames(self):
+		return self.__metadata.get(kFilterName, [])
+	def skipExtensions(self):
+		return self.__metadata.get(kFilterExtension, [])
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+__all__ = [ 				# exported symbols from this module
+	"kHardLinksAvailable",	# True if this platform can hard link files (BlobStore needs it)
+	"BlobStore",			# content addressed store of files, shared between directories by hard links
+]
+
+import os
+import stat
+import threading
+
+""" Python 2 has no os.link on Windows, there is no blob store there
+"""
+kHardLinksAvailable= hasattr(os, 'link')
+
+class BlobStore:
+	""" Files are kept by key in path/ab/abcdef...
+		directories get their files by hard linking to the blobs, so a file in many
+			directories is only stored once
+		a linked file shares its contents, permissions and modification time with the blob
+			so the key has to cover all three, and linked files must be replaced, not modified
+		where files cannot be hard linked (no support, another device, too many links)
+			blobs are not available, and files are restored the usual way
+	"""
+	def __init__(self, path):
+		self.__path= path
+		self.__lock= threading.Lock()
+		self.__linked= 0
+		self.__added= 0
+	def linked(self):
+		""" number of files linked from the store instead of restored
+		"""
+		return self.__linked
+	def added(self):
+		return self.__added
+	def __blobPath(self, key):
+		return os.path.join(self.__path, key[:2], key)
+	def link(self, key, destination, matches= None):
+		""" links destination to the blob for key
+			matches( blob path ) -> False if the blob is not what key says it is
+				(a file linked to it was changed in place), the blob is dropped so it can be added again
+			returns False if there is no such blob (or it did not match or could not be linked)
+		"""
+		blobPath= self.__blobPath(key)
+		try:
+			if matches and os.path.isfile(blobPath) and not matches(blobPath):
+				try:
+					os.remove(blobPath)
+				except OSError:
+					pass # another thread may have just dropped it
+				return False
+			os.link(blobPath, destination)
+		except (OSError, IOError):
+			return False
+		self.__lock.acquire()
+		self.__linked+= 1
+		self.__lock.release()
+		return True
+	def add(self, key, source):
+		""" makes source (a finished file, permissions and times set) the blob for key
+			source becomes the blob (they are the same file), so it must not be changed in place
+				once added; anything restored from a blob later would see the change
+				(validate finds it and replaces the files, but only those it validates)
+			nothing is done if there is already a blob for key
+			returns False if source could not be added (the store cannot hard link to it)
+		"""
+		blobPath= self.__blobPath(key)
+		if os.path.exists(blobPath):
+			return True
+		directory= os.path.split(blobPath)[0]
+		temporaryPath= blobPath+".%x-%x"%(os.getpid(), id(threading.currentThread()))
+		try:
+			if not os.path.isdir(directory):
+				try:
+					os.makedirs(directory)
+				except OSError:
+					if not os.path.isdir(directory): # another thread may have just created it
+						raise
+			os.link(source, temporaryPath)
+			os.rename(temporaryPath, blobPath)
+		except OSError: # EPERM, EXDEV, EMLINK, ENOTSUP ... there is just no blob for key
+			try:
+				os.remove(temporaryPath)
+			except OSError:
+				pass
+			return False
+		self.__lock.acquire()
+		self.__added+= 1
+		self.__lock.release()
+		return True
+	def collect(self):
+		""" removes blobs no directory links to any more
+			returns (number of blobs removed, bytes freed)
+		"""
+		removed= 0
+		freed= 0
+		if not os.path.isdir(self.__path):
+			return (removed, freed)
+		for (directory, dirs, files) in os.walk(self.__path):
+			for name in files:
+				blobPath= os.path.join(directory, name)
+				stats= os.lstat(blobPath)
+				if stat.S_ISREG(stats.st_mode) and stats.st_nlink == 1:
+					os.remove(blobPath)
+					removed+= 1
+					freed+= stats.st_size
+		return (removed, freed)
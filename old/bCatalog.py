@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+__all__ = [ 			# exported symbols from this module
+	"ExportCatalog",	# index of the exports in a directory, by full name and version
+	"versionKey",		# sortable key for a version string
+]
+
+import os
+import bisect
+import cPickle
+import threading
+import bConstants
+
+# bump this if the layout of what is pickled changes
+kExportCatalogFormat= 1
+
+def versionKey(version):
+	""" (major, minor, patch, phase, build) that sorts the way bID.ID.compareVersions does
+		None if version is not a version
+	"""
+	if not version:
+		return None
+	parts= bConstants.kVersionPattern.match(version)
+	if not parts:
+		return None
+	return (
+		int(parts.group(1)), int(parts.group(2)), int(parts.group(3)),
+		bConstants.kBuildPhaseOrder.find(parts.group(4)), int(parts.group(5)),
+	)
+
+class ExportCatalog:
+	""" The export zips in a directory, indexed by full name and version
+		the directory is only listed again when its modification time changes
+		full name -> list of (versionKey, filename) sorted by version
+	"""
+	def __init__(self, directory, path):
+		""" directory is where the exports are
+			path is the file the catalog is kept in (not in directory, saving it would change its mtime)
+		"""
+		self.__directory= directory
+		self.__path= path
+		self.__exports= None
+		self.__modified= None
+		self.__lock= threading.RLock() # exports may be looked up on many threads at once
+	def __directoryModified(self):
+		try:
+			return os.stat(self.__directory).st_mtime
+		except OSError:
+			return None
+	def __load(self):
+		""" makes sure __exports matches the directory, scanning it only if it changed
+		"""
+		modified= self.__directoryModified()
+		if None != self.__exports and modified == self.__modified:
+			return
+		if None == self.__exports and os.path.isfile(self.__path):
+			try:
+				catalogFile= open(self.__path, 'rb')
+				try:
+					(format, savedModified, exports)= cPickle.load(catalogFile)
+				finally:
+					catalogFile.close()
+				if format == kExportCatalogFormat and savedModified == modified:
+					self.__exports= exports
+					self.__modified= modified
+					return
+			except KeyboardInterrupt,e:
+				raise e
+			except: # corrupt or unreadable catalog, scan again
+				pass
+		self.__scan(modified)
+	def __scan(self, modified):
+		self.__exports= {}
+		if None != modified:
+			for name in os.listdir(self.__directory):
+				self.__insert(name)
+		self.__modified= modified
+		self.__save()
+	def __insert(self, name):
+		parts= bConstants.kExportNamePattern.match(name)
+		if not parts:
+			return False
+		entry= (versionKey(parts.group(2)), name)
+		versions= self.__exports.setdefault(parts.group(1), [])
+		index= bisect.bisect_left(versions, entry)
+		if index < len(versions) and versions[index] == entry:
+			return False # already have it
+		versions.insert(index, entry)
+		return True
+	def __save(self):
+		if None == self.__modified:
+			return
+		temporaryPath= self.__path+".%x-%x"%(os.getpid(), id(threading.currentThread()))
+		try:
+			directory= os.path.split(self.__path)[0]
+			if directory and not os.path.isdir(directory):
+				os.makedirs(directory)
+			catalogFile= open(temporaryPath, 'wb')
+			try:
+				cPickle.dump((kExportCatalogFormat, self.__modified, self.__exports),
+							catalogFile, cPickle.HIGHEST_PROTOCOL)
+			finally:
+				catalogFile.close()
+			os.rename(temporaryPath, self.__path)
+		except (IOError, OSError): # can't write the catalog, we'll just scan again next time
+			pass
+	def add(self, name):
+		""" records an export that was just put in the directory
+		"""
+		self.__lock.acquire()
+		try:
+			self.__load()
+			if self.__insert(name):
+				self.__save()
+		finally:
+			self.__lock.release()
+	def names(self):
+		self.__lock.acquire()
+		try:
+			self.__load()
+			return self.__exports.keys()
+		finally:
+			self.__lock.release()
+	def find(self, fullName, version= None, newerThan= None):
+		""" export filenames for fullName, oldest version first
+			version only exports of this version
+			newerThan only exports of versions after this version
+		"""
+		self.__lock.acquire()
+		try:
+			self.__load()
+			versions= list(self.__exports.get(fullName, []))
+		finally:
+			self.__lock.release()
+		start= 0
+		end= len(versions)
+		if version:
+			key= versionKey(version)
+			start= bisect.bisect_left(versions, (key,))
+			end= bisect.bisect_left(versions, (key, chr(255)), start)
+		elif newerThan:
+			start= bisect.bisect_left(versions, (versionKey(newerThan), chr(255)))
+		return [entry[1] for entry in versions[start:end]]
+	def latest(self, fullName):
+		""" filename of the newest export of fullName (None if there are none)
+		"""
+		found= self.find(fullName)
+		if not found:
+			return None
+		return found[-1]
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+__all__ = [ 						# exported symbols from this module
+	"CompressionPolicy",			# decides how each file is compressed in an archive
+	"kCompressionMethods",			# name -> zipfile compression type
+	"kAlreadyCompressedExtensions",	# extensions that are stored without compressing by default
+]
+
+import os
+import zlib
+import zipfile
+
+""" zipfile in Python 2 can only store or deflate entries
+	(bzip2 and lzma entries need Python 3.3)
+"""
+kCompressionMethods= {
+	'store': zipfile.ZIP_STORED,
+	'deflate': zipfile.ZIP_DEFLATED,
+}
+
+# formats that are already compressed, deflating them again costs time and saves nothing
+kAlreadyCompressedExtensions= [
+	'.zip', '.jar', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.dmg', '.sit', '.sitx',
+	'.jpg', '.jpeg', '.png', '.gif', '.mp3', '.m4a', '.aac', '.mp4', '.m4v', '.mov',
+]
+
+# files smaller than this are not worth the deflate stream overhead
+kMinimumCompressSize= 128
+
+# how much of a file to try compressing to see if it is worth compressing
+kSampleSize= 16 * 1024
+
+# if a sample deflates to more than this fraction of its size, the file is stored
+kIncompressibleRatio= 0.95
+
+class CompressionPolicy:
+	def __init__(self, rules= None, level= zlib.Z_DEFAULT_COMPRESSION, minimumSize= kMinimumCompressSize,
+					sampleSize= kSampleSize):
+		""" rules is a list of (extension, method, level) from the package
+				extension of None sets the method and level for files no other rule matches
+				method is a name in kCompressionMethods
+				level is the deflate level (1-9) or None for level
+			minimumSize files smaller than this are stored
+			sampleSize how much of the start of a file to deflate to decide if it compresses
+				0 to not sample
+		"""
+		self.__extensions= {}
+		self.__default= None
+		self.__level= level
+		self.__minimumSize= minimumSize
+		self.__sampleSize= sampleSize
+		if not rules:
+			rules= []
+		for (extension, method, ruleLevel) in rules:
+			if not kCompressionMethods.has_key(method):
+				raise SyntaxError("Unknown compression method: "+str(method))
+			if None == ruleLevel:
+				ruleLevel= level
+			if extension:
+				self.__extensions[extension.lower()]= (kCompressionMethods[method], ruleLevel)
+			else:
+				self.__default= (kCompressionMethods[method], ruleLevel)
+	def sampleSize(self):
+		return self.__sampleSize
+	def method(self, path, size, sample):
+		""" returns (zipfile.ZIP_STORED or zipfile.ZIP_DEFLATED, deflate level)
+			path the name of the file in the archive
+			size the size of the file, None if it is not known yet
+			sample the start of the file (up to sampleSize() bytes)
+		"""
+		extension= os.path.splitext(path)[1].lower()
+		if self.__extensions.has_key(extension):
+			return self.__extensions[extension]
+		if self.__default and self.__default[0] == zipfile.ZIP_STORED:
+			return self.__default
+		if extension in kAlreadyCompressedExtensions:
+			return (zipfile.ZIP_STORED, None)
+		if None == size:
+			size= len(sample)
+		if size < self.__minimumSize:
+			return (zipfile.ZIP_STORED, None)
+		if self.__default:
+			level= self.__default[1]
+		else:
+			level= self.__level
+		sample= sample[:self.__sampleSize]
+		if sample and len(zlib.compress(sample, 1)) > len(sample) * kIncompressibleRatio:
+			return (zipfile.ZIP_STORED, None)
+		return (zipfile.ZIP_DEFLATED, level)
@@ -37,9 +37,33 @@ kExportMetaDataDir= "_._metadata_._"
 # Name of directory metadata file
 kMetaDataFilename= "_._metadata_._"
 
+# Name of the directory in the dependencies directory that restored files are shared from
+kBlobStoreDirectoryName= "_._blobs_._"
+
+# Name of the file in the dependencies directory that indexes the exports directory
+kExportCatalogFileName= "_._exports_._"
+
+# Name of the file in the dependencies directory that remembers how export servers have done
+kServerScoreboardFileName= "_._servers_._"
+
+# Name of the file in the dependencies directory that keeps the exports lists servers sent
+kServerListCacheFileName= "_._lists_._"
+
+# Name of the directory in the dependencies directory that has each package's lockfile
+kLockfileDirectoryName= "_._locks_._"
+
+# Name of the directory in the dependencies directory that has a snapshot of each restored export
+kSnapshotDirectoryName= "_._snapshots_._"
+
+# Added to an export's filename while it is downloading, so an interrupted download can be resumed
+kPartialDownloadExtension= ".partial"
+
 # Name of the manifest file in the exports
 kManifestFileNameInExport= "manifest.xml"
 
+# Name of the binary manifest in the exports that have one (see bBinaryManifest)
+kBinaryManifestFileNameInExport= "manifest.bin"
+
 # Name of the signature file in the exports
 kSignatureFileNameInExport= "signature.xml"
 
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+__all__ = [ 				# exported symbols from this module
+	"Dependency",			# one export in a DependencyGraph
+	"DependencyGraph",		# every export a package needs, directly or through the exports it needs
+]
+
+import sys
+import time
+import Queue
+import bWorkers
+
+# how many dependencies are downloaded or restored at once
+kDefaultWorkers= 4
+
+class Dependency:
+	def __init__(self, requested, identifier, dependencies, fetchTime):
+		""" requested the ID that was asked for
+			identifier the ID of the export found for it
+			dependencies the IDs its package.xml lists
+			fetchTime seconds it took to find (and download) the export
+		"""
+		self.__requested= requested
+		self.__identifier= identifier
+		self.__dependencies= dependencies
+		self.__fetchTime= fetchTime
+		self.__restoreTime= 0.0
+		self.__path= None
+	def __repr__(self):
+		return "Dependency(identifier=%s,fetchTime=%0.3f,restoreTime=%0.3f,path=%s)"%(
+			self.__identifier.filename(), self.__fetchTime, self.__restoreTime, self.__path
+		)
+	def requested(self):
+		return self.__requested
+	def identifier(self):
+		return self.__identifier
+	def fullName(self):
+		return self.__identifier.fullName()
+	def dependencies(self):
+		return self.__dependencies
+	def dependencyNames(self):
+		names= []
+		for dependency in self.__dependencies:
+			if dependency.fullName() not in names:
+				names.append(dependency.fullName())
+		return names
+	def fetchTime(self):
+		return self.__fetchTime
+	def restoreTime(self):
+		return self.__restoreTime
+	def setupTime(self):
+		""" seconds it took to fetch and restore
+		"""
+		return self.__fetchTime + self.__restoreTime
+	def path(self):
+		""" where it was restored (None until it is)
+		"""
+		return self.__path
+	def restored(self, path, seconds):
+		self.__path= path
+		self.__restoreTime= seconds
+
+def fetchDependency(exports, identifier):
+	""" Runs on a worker thread, finds the newest export of identifier and reads what it depends on
+		returns (ID of the export, IDs it depends on, seconds it took)
+	"""
+	start= time.time()
+	found= exports.get(identifier)
+	found.sort(lambda x,y: x.compare(y))
+	if not found:
+		raise SyntaxError("Unable to find "+str(identifier))
+	package= exports.package(found[-1])
+	return (found[-1], package['dependencies'], time.time() - start)
+
+def restoreDependency(exports, dependency, ensure, finished):
+	""" Runs on a worker thread, restores dependency and puts (dependency, path, seconds, error) in finished
+		error is the sys.exc_info() of whatever stopped the restore (even KeyboardInterrupt)
+			the thread waiting for restores raises it, it would wait forever if nothing was put
+	"""
+	start= time.time()
+	try:
+		path= exports.pathTo(dependency.identifier(), ensure= ensure)
+	except: # reported on the thread waiting for restores
+		finished.put( (dependency, None, time.time() - start, sys.exc_info()) )
+		return
+	finished.put( (dependency, path, time.time() - start, None) )
+
+class DependencyGraph:
+	""" The exports a package depends on, and the exports they depend on, and so on
+		each full name is resolved to one version:
+			the version the package asks for, if it asks for that full name itself
+			otherwise the newest version any of the exports asks for
+		requests for other versions are reported by conflicts()
+	"""
+	def __init__(self, package, exports, workers= kDefaultWorkers):
+		""" package is the bPackage.Package whose dependencies to resolve
+			exports is the bExport.Store to get the exports from
+			workers is the number of exports to download or restore at once (0 for one per processor)
+		"""
+		self.__package= package
+		self.__exports= exports
+		self.__workers= workers
+		self.__dependencies= {} # full name -> Dependency
+		self.__pinned= [identifier.fullName() for identifier in package['dependencies']]
+		self.__resolve()
+		self.__order= self.__sort()
+	def __preferred(self, name, requiredBy, identifier, chosen):
+		""" True if identifier should be used for name instead of chosen
+		"""
+		if not chosen:
+			return True
+		if requiredBy and name in self.__pinned:
+			return False # the package asked for a version itself
+		return identifier.compareVersions(chosen) > 0
+	def __resolve(self):
+		""" finds the exports a level at a time, the exports in a level are fetched at once
+		"""
+		pending= [(None, identifier) for identifier in self.__package['dependencies']]
+		pool= bWorkers.Pool(self.__workers, processes= False)
+		try:
+			while pending:
+				wanted= {}
+				for (requiredBy, identifier) in pending:
+					name= identifier.fullName()
+					chosen= wanted.get(name)
+					if not chosen and self.__dependencies.has_key(name):
+						chosen= self.__dependencies[name].requested()
+					if self.__preferred(name, requiredBy, identifier, chosen):
+						wanted[name]= identifier
+				results= []
+				for name in wanted:
+					results.append( (name, pool.submit(fetchDependency, (self.__exports, wanted[name]))) )
+				pending= []
+				for (name, result) in results:
+					(found, dependencies, seconds)= result.get()
+					self.__dependencies[name]= Dependency(wanted[name], found, dependencies, seconds)
+					pending.extend([(name, dependency) for dependency in dependencies])
+		finally:
+			pool.close()
+		self.__prune()
+	def __prune(self):
+		""" drops exports only an older version of another export needed
+		"""
+		reachable= []
+		pending= list(self.__pinned)
+		while pending:
+			name= pending.pop()
+			if name not in reachable:
+				reachable.append(name)
+				pending.extend(self.__dependencies[name].dependencyNames())
+		for name in self.__dependencies.keys():
+			if name not in reachable:
+				del self.__dependencies[name]
+	def __sort(self):
+		""" full names, each after the ones it depends on
+		"""
+		order= []
+		visiting= []
+		def visit(name):
+			if name in order:
+				return
+			if name in visiting:
+				cycle= visiting[visiting.index(name):] + [name]
+				raise SyntaxError("Dependency cycle: "+" -> ".join(cycle))
+			visiting.append(name)
+			for dependency in self.__dependencies[name].dependencyNames():
+				visit(dependency)
+			visiting.pop()
+			order.append(name)
+		for name in sorted(self.__dependencies.keys()):
+			visit(name)
+		return order
+	def names(self):
+		""" full names of every dependency, each after the ones it depends on
+		"""
+		return list(self.__order)
+	def dependency(self, name):
+		return self.__dependencies[name]
+	def conflicts(self):
+		""" [(full name, ID used, [(full name of what asked or None for the package, ID asked for), ...]), ...]
+			for every dependency something asked for a different version of
+		"""
+		requests= {}
+		for identifier in self.__package['dependencies']:
+			requests.setdefault(identifier.fullName(), []).append( (None, identifier) )
+		for name in self.__order:
+			for identifier in self.__dependencies[name].dependencies():
+				requests.setdefault(identifier.fullName(), []).append( (name, identifier) )
+		conflicts= []
+		for name in self.__order:
+			used= self.__dependencies[name].identifier()
+			different= [request for request in requests[name] if request[1].version() != used.version()]
+			if different:
+				conflicts.append( (name, used, requests[name]) )
+		return conflicts
+	def restore(self, ensure= False):
+		""" restores every dependency, each once the ones it depends on are restored
+			up to workers are restored at once
+			ensure if True, use hashes to validate files (otherwise size and modification time)
+			returns full name -> path it was restored to
+		"""
+		finished= Queue.Queue()
+		started= []
+		paths= {}
+		pool= bWorkers.Pool(self.__workers, processes= False)
+		try:
+			while len(paths) < len(self.__order):
+				for name in self.__order:
+					if name in started:
+						continue
+					dependency= self.__dependencies[name]
+					if [needed for needed in dependency.dependencyNames() if not paths.has_key(needed)]:
+						continue # waiting on something it depends on
+					started.append(name)
+					pool.submit(restoreDependency, (self.__exports, dependency, ensure, finished))
+				(dependency, path, seconds, error)= finished.get()
+				if error:
+					raise error[0], error[1], error[2]
+				dependency.restored(path, seconds)
+				paths[dependency.fullName()]= path
+		finally:
+			pool.close()
+		return paths
+	def criticalPath(self):
+		""" (seconds, [Dependency, ...]) the chain of dependencies, each depending on the next,
+			that took the longest to fetch and restore (the most setup time could be cut to)
+		"""
+		longest= {} # full name -> (seconds, [full name, ...])
+		for name in self.__order:
+			(seconds, chain)= (0.0, [])
+			for needed in self.__dependencies[name].dependencyNames():
+				if longest[needed][0] > seconds:
+					(seconds, chain)= longest[needed]
+			longest[name]= (seconds + self.__dependencies[name].setupTime(), [name] + chain)
+		if not longest:
+			return (0.0, [])
+		(seconds, chain)= max(longest.values())
+		return (seconds, [self.__dependencies[name] for name in chain])
@@ -8,21 +8,120 @@ import os
 import bID
 import sys
 import bRSA
-import glob
 import time
+import bHTTP
 import random
 import zipfile
 import urllib2
 import bArchive
 import bPackage
+import bCatalog
+import bMirrors
+import bSnapshot
+import threading
+import bHashCache
 import bConstants
+import bBlobStore
+import bCompression
+
+class HashingWriter:
+	""" writes to a file, hashing what is written and counting how much made it to the file
+	"""
+	def __init__(self, file, hasher, written= 0):
+		self.__file= file
+		self.__hasher= hasher
+		self.__written= written
+	def write(self, block):
+		self.__file.write(block)
+		self.__hasher.update(block)
+		self.__written+= len(block)
+	def written(self):
+		return self.__written
+	def close(self):
+		self.__file.close()
 
 class Store:
-	def __init__(self, exportDir, dependencyDir):
+	def __init__(self, exportDir, dependencyDir, servers= None, opener= None, download= None):
+		""" servers the exports lists to search first (bConstants.kBootStrapServers by default)
+			opener( url, timeout= seconds ) -> stream to download with (bHTTP.urlopen by default)
+				url may be a urllib2.Request (downloads are resumed with a Range header)
+			download how to download exports, one of bMirrors.kDownloadStrategies
+				(bMirrors.kChunkedDownload by default)
+		"""
+		if None == download:
+			download= bMirrors.kChunkedDownload
+		if download not in bMirrors.kDownloadStrategies:
+			raise SyntaxError("Unknown download strategy: "+str(download))
+		if None == servers:
+			servers= bConstants.kBootStrapServers
+		if not opener:
+			opener= bHTTP.urlopen
+		self.__servers= servers
+		self.__opener= opener
+		self.__downloadStrategy= download
+		self.__scoreboard= bMirrors.ServerScoreboard(
+			os.path.join(dependencyDir, bConstants.kServerScoreboardFileName)
+		)
+		self.__serverLists= bMirrors.ServerListCache(
+			os.path.join(dependencyDir, bConstants.kServerListCacheFileName)
+		)
 		self.__exportDir= exportDir
 		self.__dependencyDir= dependencyDir
+		self.__lock= threading.Lock() # exports are found and restored on many threads at once
 		self.__locationCache= {}
-	def create(self, package, preferences):
+		self.__partialDownloads= {}
+		self.__exportStatistics= {}
+		self.__catalog= bCatalog.ExportCatalog(exportDir,
+			os.path.join(dependencyDir, bConstants.kExportCatalogFileName)
+		)
+		self.__blobs= None
+		if bBlobStore.kHardLinksAvailable:
+			self.__blobs= bBlobStore.BlobStore(os.path.join(dependencyDir, bConstants.kBlobStoreDirectoryName))
+	def exportStatistics(self):
+		""" dictionary of description -> value about the last export created
+		"""
+		return self.__exportStatistics
+	def __hashCache(self, package, preferences):
+		""" cache of hashes of files in the package from previous exports (in scratch)
+		"""
+		if not preferences['scratch']:
+			return None
+		configuration= {
+			'hashers': [hasher[0] for hasher in bArchive.hashProfile(package['hashProfile'])],
+			'detectText': True,
+			'filterPaths': package['filterPaths'],
+			'filterExtensions': package['filterExtensions'],
+			'filterNames': package['filterNames'],
+		}
+		return bHashCache.HashCache(
+			os.path.join(preferences['scratch'], package['full_name']+".hashcache"),
+			configuration
+		)
+	def __deltaBase(self, identifier):
+		""" (export filename, relative path -> file properties) of the export to make a delta of
+			package.xml is left out so it is always in the delta (__download reads it)
+		"""
+		found= self.get(identifier)
+		found.sort(lambda x,y: x.compare(y))
+		if not found:
+			raise SyntaxError("Unable to find "+str(identifier)+" to make a delta export of")
+		baseFile= bArchive.ZipArchive(os.path.join(self.__exportDir, found[-1].filename()), 'r')
+		manifestFile= baseFile.open(bConstants.kManifestFileNameInExport, 'r')
+		files= bArchive.manifestFiles(manifestFile, bArchive.kStandardCodecs)
+		manifestFile.close()
+		baseFile.close()
+		if files.has_key(bConstants.kPackageFileName):
+			del files[bConstants.kPackageFileName]
+		return (found[-1].filename(), files)
+	def create(self, package, preferences, workers= 1, deltaFrom= None):
+		""" workers is the number of processes to hash with (0 for one per processor)
+			deltaFrom the identifier of a previous export to only export changes from
+				(None for a full export)
+		"""
+		if deltaFrom:
+			previous= self.__deltaBase(deltaFrom)
+		else:
+			previous= None
 		identifier= package.asID()
 		filename= "%s_%s_%x-%x-%x.zip"%(
 			identifier.fullName(),
@@ -32,25 +131,42 @@ class Store:
 			os.getpid(),
 		)
 		intermedeateExportPath= os.path.join(preferences['exports'], filename)
-		intermedeateExportFile= bArchive.ZipArchive(intermedeateExportPath, 'w')
-		manifestFile= intermedeateExportFile.open(bConstants.kManifestFileNameInExport, 'w')
-		signatureFile= intermedeateExportFile.open(bConstants.kSignatureFileNameInExport, 'w')
+		intermedeateExportFile= bArchive.ZipArchive(intermedeateExportPath, 'w',
+			bCompression.CompressionPolicy(package['compress']), workers
+		)
+		manifestFile= intermedeateExportFile.open(bConstants.kManifestFileNameInExport, 'w', buffered= True)
+		signatureFile= intermedeateExportFile.open(bConstants.kSignatureFileNameInExport, 'w', buffered= True)
+		binaryManifestFile= None
+		if package['binaryManifest']:
+			binaryManifestFile= intermedeateExportFile.open(bConstants.kBinaryManifestFileNameInExport, 'w',
+															buffered= True)
+		hashCache= self.__hashCache(package, preferences)
 		bArchive.generate(
-			package.directory(), manifestFile, bArchive.kAllKnownHashes, bArchive.kStandardCodecs,
+			package.directory(), manifestFile, None, bArchive.kStandardCodecs,
 			preferences['key'], signatureFile,
 			intermedeateExportFile, detectText= True, blockTransferSize= bConstants.kReadBlockSize,
 			skipPaths= package['filterPaths'],
 			skipExtensions= package['filterExtensions'],
-			skipNames= package['filterNames']
+			skipNames= package['filterNames'],
+			skipFilter= package.skipFilter(),
+			workers= workers, cache= hashCache,
+			profile= package['hashProfile'] or bArchive.kDefaultHashProfile,
+			previous= previous, binaryManifest= binaryManifestFile
 		)
+		self.__exportStatistics= {}
+		if hashCache:
+			hashCache.save()
+			self.__exportStatistics['hash cache hits']= hashCache.hits()
+			self.__exportStatistics['hash cache misses']= hashCache.misses()
+			self.__exportStatistics['bytes not re-hashed']= hashCache.bytesAvoided()
+		if binaryManifestFile:
+			binaryManifestFile.close()
 		signatureFile.close()
 		manifestFile.close()
 		intermedeateExportFile.close()
-		intermedeateContents= open(intermedeateExportPath, 'r')
-		hash= bArchive.transferAndHash(
-			intermedeateContents, bArchive.kMD5Hash, blockTransferSize= bConstants.kReadBlockSize,
-			output= None, detectText= False, changeLineEndingsTo= None
-		)[1][0][1] # 1 = hashes (instead of number of lines), 0 = 1st, 1 = digest (instead of algorithm or is text)
+		self.__exportStatistics.update(intermedeateExportFile.statistics())
+		hash= bArchive.hashFile(intermedeateExportPath, bArchive.kMD5Hash
+		)[0][1] # 0 = 1st, 1 = digest (instead of algorithm or is text)
 		finalExportPath= os.path.join(preferences['exports'], identifier.fullName()+"_"+identifier.filenameVersion()+"_"+hash+".zip")
 		os.rename(intermedeateExportPath, finalExportPath)
 		#print "finalExportPath",finalExportPath,os.path.isfile(finalExportPath)
@@ -77,44 +193,131 @@ class Store:
 	def addExport(self, name):
 		if not os.path.isfile(os.path.join(self.__exportDir, name)):
 			raise SyntaxError(name+" not in "+self.__exportDir)
+		self.__addToExportList([name])
+		self.__catalog.add(name)
+	def __addToExportList(self, lines):
+		""" appends the lines that are not in the exports list yet
+		"""
 		exportListPath= os.path.join(self.__exportDir, bConstants.kExportsFile)
-		exportListFile= open(exportListPath, 'a')
-		exportListFile.write(name+"\n")
-		exportListFile.close()
+		self.__lock.acquire()
+		try:
+			listed= set()
+			if os.path.isfile(exportListPath):
+				exportListFile= open(exportListPath, 'r')
+				listed.update([line.strip() for line in exportListFile])
+				exportListFile.close()
+			exportListFile= open(exportListPath, 'a')
+			for line in lines:
+				if line not in listed:
+					exportListFile.write(line+"\n")
+					listed.add(line)
+			exportListFile.close()
+		finally:
+			self.__lock.release()
+	def __serversWith(self, identifier):
+		""" the servers whose exports lists have identifier
+		"""
+		self.__lock.acquire()
+		try:
+			return list(self.__locationCache.get(identifier.filename(), []))
+		finally:
+			self.__lock.release()
+	def __forgetPartialDownload(self, partialPath):
+		self.__lock.acquire()
+		try:
+			if self.__partialDownloads.has_key(partialPath):
+				del self.__partialDownloads[partialPath]
+		finally:
+			self.__lock.release()
 	def has(self, identifier):
 		return self.__haveLocal(identifier)
 	def get(self, identifier, upgrade= False):
 		return self.__find(identifier, upgrade)
-	def pathTo(self, identifier, ensure= True):
+	def pathTo(self, identifier, ensure= True, workers= 1):
+		""" ensure if True, use hashes to validate every file
+				otherwise only what changed since the last restore is checked (see bSnapshot)
+				or, without a snapshot, what has the wrong size or modification time
+			workers is the number of threads to restore with (0 for one per processor)
+		"""
 		allFound= self.get(identifier)
 		allFound.sort(lambda x,y: x.compare(y))
 		#print "allFound",allFound
 		if not allFound:
 			raise SyntaxError("Unable to find "+str(identifier))
-		pathToZip= os.path.join(self.__exportDir, allFound[-1].filename())
 		localPath= os.path.join(
 			self.__dependencyDir,
 			allFound[-1].fullName(),
 			allFound[-1].filenameVersion()
 		)
-		exportFile= bArchive.ZipArchive(pathToZip, 'r')
+		snapshot= bSnapshot.Snapshot(os.path.join(
+			self.__dependencyDir, bConstants.kSnapshotDirectoryName, allFound[-1].filename()
+		))
+		changedPaths= None
+		if not ensure:
+			changedPaths= snapshot.changed(localPath, allFound[-1].filename())
+			if None != changedPaths and not changedPaths:
+				return localPath # nothing changed since it was restored
+		exportFile= self.__openExport(allFound[-1])
 		manifestFile= exportFile.open(bConstants.kManifestFileNameInExport, 'r')
 		signatureFile= exportFile.open(bConstants.kSignatureFileNameInExport, 'r')
-		if ensure:
-			fixLevel= 2 # use hashes to validate the contents of the files
+		if ensure or None != changedPaths:
+			fixLevel= 2 # use hashes to validate the contents of the files (just the changed ones with a snapshot)
 		else:
 			fixLevel= 1 # quick fix, rely on filesize and mod time
-		signatures= bArchive.getSignatures(signatureFile)
+		signatures= bArchive.getSignatures(signatureFile, binary= True)
+		binaryManifestFile= None
+		if signatures[2] and exportFile.has(bConstants.kBinaryManifestFileNameInExport):
+			binaryManifestFile= exportFile.open(bConstants.kBinaryManifestFileNameInExport, 'r')
+		snapshot.remove()
 		changed= bArchive.validate(
 					manifestFile, localPath, fixLevel= fixLevel, archive= exportFile,
 					key= bRSA.Key(signatures[0]), signatures= signatures[1],
 					hashers= bArchive.kAllKnownHashes, decoders= bArchive.kStandardCodecs,
-					platformEOL= bArchive.platformEOL(), blockTransferSize= bConstants.kReadBlockSize
+					platformEOL= bArchive.platformEOL(), blockTransferSize= bConstants.kReadBlockSize,
+					workers= workers, blobs= self.__blobs, changed= changedPaths,
+					binaryManifest= binaryManifestFile, binarySignatures= signatures[2]
 				)
+		if binaryManifestFile:
+			binaryManifestFile.close()
 		signatureFile.close()
 		manifestFile.close()
 		exportFile.close()
+		snapshot.take(localPath, allFound[-1].filename())
 		return localPath
+	def package(self, identifier):
+		""" the bPackage.Package in the newest export of identifier
+		"""
+		allFound= self.get(identifier)
+		allFound.sort(lambda x,y: x.compare(y))
+		if not allFound:
+			raise SyntaxError("Unable to find "+str(identifier))
+		exportFile= bArchive.ZipArchive(os.path.join(self.__exportDir, allFound[-1].filename()), 'r')
+		packageFile= exportFile.open(bConstants.kPackageFileName, 'r') # delta exports always have it
+		contents= packageFile.read()
+		packageFile.close()
+		exportFile.close()
+		return bPackage.Package(contents)
+	def __openExport(self, identifier):
+		""" opens an export, chained to the exports it is a delta of
+		"""
+		exportFile= bArchive.ZipArchive(os.path.join(self.__exportDir, identifier.filename()), 'r')
+		manifestFile= exportFile.open(bConstants.kManifestFileNameInExport, 'r')
+		base= bArchive.manifestAttributes(manifestFile).get('from')
+		manifestFile.close()
+		if not base:
+			return exportFile
+		baseFound= self.get(bID.ID(base))
+		if not baseFound:
+			exportFile.close()
+			raise SyntaxError("Unable to find "+base+" which "+identifier.filename()+" is a delta of")
+		return bArchive.ArchiveChain([exportFile, self.__openExport(baseFound[0])])
+	def collectGarbage(self):
+		""" removes files from the blob store that no dependency directory uses any more
+			returns (number of files removed, bytes freed)
+		"""
+		if not self.__blobs:
+			return (0, 0)
+		return self.__blobs.collect()
 	def __matchesIdentifier(self, name, identifier= None, upgrade= False):
 		#print ">__matchesIdentifier(",name,",",identifier,",",upgrade,")"
 		if bConstants.kExportNamePattern.match(name):
@@ -135,35 +338,38 @@ class Store:
 	def __haveLocal(self, identifier= None, upgrade= False):
 		#print ">__haveLocal(",identifier,",",upgrade,")"
 		exportsToFind= []
-		possibleExports= glob.glob(os.path.join(self.__exportDir, "*.zip"))
-		for possibleExport in possibleExports:
-			#print "\t","possibleExport",possibleExport
-			filename= os.path.split(possibleExport)[1]
+		if not identifier:
+			possibleExports= []
+			for fullName in self.__catalog.names():
+				possibleExports.extend(self.__catalog.find(fullName))
+		elif upgrade:
+			possibleExports= self.__catalog.find(identifier.fullName(), newerThan= identifier.version())
+		else:
+			possibleExports= self.__catalog.find(identifier.fullName(), version= identifier.version())
+		for filename in possibleExports:
 			#print "\t\t","filename",filename
 			thisIdentifier= self.__matchesIdentifier(filename, identifier, upgrade)
 			#print "\t\t","thisIdentifier",thisIdentifier
 			if thisIdentifier:
 				#print "\t\tMatch!"
-				thisIdentifier.merge(bID.ID(possibleExport))
+				thisIdentifier.merge(bID.ID(os.path.join(self.__exportDir, filename)))
 				exportsToFind.append(thisIdentifier)
 		#print "<__haveLocal(",identifier,",",upgrade,")"
 		return exportsToFind
 	def __downloadFromCache(self, identifier):
-		if self.__locationCache.has_key(identifier.filename()):
-			for server in self.__locationCache[identifier.filename()]:
-				found= self.__download(identifier, server)
-				if found:
-					return found
+		for server in self.__serversWith(identifier):
+			found= self.__download(identifier, server)
+			if found:
+				return found
 		return None
-	def __findInStream(self, readlines, servers= None, identifier= None, upgrade= False, listAll= False, onServer= None):
-		#print "__findInStream(readlines,",servers,",",identifier,",",upgrade,",",listAll,")"
+	def __findInStream(self, lines, servers= None, identifier= None, upgrade= False, listAll= False, onServer= None):
+		""" lines is an exports list, an open file or a list of its lines
+		"""
+		#print "__findInStream(lines,",servers,",",identifier,",",upgrade,",",listAll,")"
 		found= []
 		if None == servers:
 			servers= []
-		while True:
-			line= readlines.readline()
-			if not line:
-				break
+		for line in lines:
 			line= line.strip()
 			if line.startswith("http://"):
 				if line not in servers:
@@ -172,10 +378,11 @@ class Store:
 				#print "\t","line:",line.strip()
 				if onServer and bConstants.kExportNamePattern.match(line):
 					identifierForCache= bID.ID(line).filename()
-					if not self.c.has_key(identifierForCache.filename()):
-						self.__locationCache[identifierForCache]= [onServer]
-					else:
-						self.__locationCache[identifierForCache].append(onServer)
+					self.__lock.acquire()
+					try:
+						self.__locationCache.setdefault(identifierForCache, []).append(onServer)
+					finally:
+						self.__lock.release()
 				thisIdentifier= self.__matchesIdentifier(line, identifier, upgrade)
 				if thisIdentifier:
 					#print "\t","match"
@@ -186,37 +393,139 @@ class Store:
 						break # we found what we were looking for
 		#print "\t","found all",found
 		return (found, servers)
+	def __partialDownload(self, partialPath):
+		""" (bytes already downloaded to partialPath, md5 hasher that has hashed them)
+			hash objects can't be saved, so the hasher is only remembered between attempts
+				in this process, otherwise what was already downloaded is hashed again from disk
+		"""
+		try:
+			received= os.path.getsize(partialPath)
+		except OSError:
+			received= 0
+		self.__lock.acquire()
+		try:
+			(hashed, hasher)= self.__partialDownloads.pop(partialPath, (None, None))
+		finally:
+			self.__lock.release()
+		if hashed == received:
+			return (received, hasher.copy())
+		hasher= bArchive.kMD5Hash[0][1].copy()
+		if received:
+			partialFile= open(partialPath, 'rb')
+			try:
+				while True:
+					block= partialFile.read(bConstants.kReadBlockSize * 64)
+					if not block:
+						break
+					hasher.update(block)
+			finally:
+				partialFile.close()
+		return (received, hasher)
+	def __openRange(self, url, start):
+		""" opens url from byte start
+			returns (stream, start) where start is 0 if the server sent the whole file
+				stream is None if there is nothing after start
+		"""
+		request= urllib2.Request(url)
+		if start:
+			request.add_header('Range', 'bytes=%d-'%(start))
+		try:
+			source= self.__opener(request)
+		except urllib2.HTTPError,e:
+			if start and e.code == 416: # Requested Range Not Satisfiable, we already have it all
+				return (None, start)
+			raise e
+		contentRange= source.info().getheader('Content-Range')
+		if start and (not contentRange or not contentRange.strip().startswith("bytes %d-"%(start))):
+			return (source, 0) # server ignored the range and is sending everything
+		return (source, start)
+	def __downloadChunks(self, identifier, server, partialPath):
+		""" downloads ranges from every server known to have identifier at once
+			returns True if the whole export is in partialPath
+			False if only one server has it, or not all of it could be downloaded
+				(what could be is left in partialPath to resume from)
+		"""
+		if self.__downloadStrategy != bMirrors.kChunkedDownload:
+			return False
+		mirrors= [server]
+		for mirror in self.__scoreboard.order(self.__serversWith(identifier)):
+			if mirror not in mirrors:
+				mirrors.append(mirror)
+		if len(mirrors) < 2:
+			return False
+		try:
+			received= os.path.getsize(partialPath)
+		except OSError:
+			received= 0
+		urls= [mirror.rsplit('/',1)[0]+'/'+identifier.filename() for mirror in mirrors]
+		try:
+			bMirrors.downloadChunks(urls, partialPath, received, self.__opener)
+		except KeyboardInterrupt,e:
+			raise e
+		except Exception: # whatever did arrive will be resumed from server
+			#bArchive.reportException()
+			return False
+		return True
 	def __download(self, identifier, server):
+		""" downloads into a .partial file that is renamed once the hash matches
+			if the transfer fails, the next attempt asks only for the rest of the file
+		"""
 		#print "__download(",identifier,",",server,")"
 		url= server.rsplit('/',1)[0]+'/'+identifier.filename()
 		localPath= os.path.join(self.__exportDir, identifier.filename())
+		partialPath= localPath + bConstants.kPartialDownloadExtension
 		#print "\t","localPath",localPath,url
-		source= urllib2.urlopen(url)
-		#print "\t","Downloading"
-		destination= open(localPath, 'w')
-		#print "\t","Saving"
-		hash= bArchive.transferAndHash( input= source, output= destination,
-			hashers= bArchive.kMD5Hash, blockTransferSize= bConstants.kReadBlockSize,
-			detextText= False, changeLineEndingsTo= None
-		)[1][0][1] # 1 = hashes (instead of number of lines), 0 = 1st, 1 = digest (instead of algorithm or is text)
-		destination.close()
-		source.close()
-		hashMatch= hash.lower() == identifier.hash().lower()
-		#print "\t","hashMatch",hashMatch,"hash",hash,"identifier.hash()",identifier.hash()
-		idMatch= False
-		if hashMatch:
-			#print "\t","Looks good so far"
-			exportZip= zipfile.ZipFile(localPath, 'r')
-			package= bPackage.Package(exportZip.read(bConstants.kPackageFileName))
-			idMatch= package.asID().equals(identifier)
-			exportZip.close()
-			if idMatch:
-				#print "\t","Still looking good"
-				identifier.merge(package.asID())
-				identifier.merge(bID.ID(localPath))
-				identifier.merge(bID.ID(url))
-				self.addExport(identifier.filename())
-				return identifier
+		if self.__downloadChunks(identifier, server, partialPath):
+			self.__forgetPartialDownload(partialPath)
+			(received, hasher)= self.__partialDownload(partialPath) # chunks arrived out of order, hash it all
+			source= None
+		else:
+			(received, hasher)= self.__partialDownload(partialPath)
+			(source, start)= self.__openRange(url, received)
+			if start != received:
+				(received, hasher)= (0, bArchive.kMD5Hash[0][1].copy())
+		if source:
+			#print "\t","Downloading"
+			destination= HashingWriter(open(partialPath, received and 'ab' or 'wb'), hasher, received)
+			try:
+				size= source.info().getheader('Content-Length')
+				if size:
+					size= long(size)
+				bArchive.transferAndHash( input= source, output= destination, hashers= None,
+					blockTransferSize= bArchive.adaptiveBlockSize(size, bConstants.kReadBlockSize),
+					detectText= False, changeLineEndingsTo= None
+				)
+				if size and destination.written() < received + size: # connection closed early
+					raise IOError("Only got %d of %d bytes of %s"%(destination.written() - received, size, url))
+			finally:
+				destination.close()
+				source.close()
+				# if the transfer failed, the next attempt picks up where this one stopped
+				self.__lock.acquire()
+				try:
+					self.__partialDownloads[partialPath]= (destination.written(), hasher.copy())
+				finally:
+					self.__lock.release()
+		self.__forgetPartialDownload(partialPath)
+		hashMatch= hasher.hexdigest().lower() == identifier.hash().lower()
+		#print "\t","hashMatch",hashMatch,"hash",hasher.hexdigest(),"identifier.hash()",identifier.hash()
+		if not hashMatch:
+			#print "\t","bummer, we failed"
+			os.remove(partialPath)
+			return None
+		os.rename(partialPath, localPath)
+		#print "\t","Looks good so far"
+		exportZip= zipfile.ZipFile(localPath, 'r')
+		package= bPackage.Package(exportZip.read(bConstants.kPackageFileName))
+		idMatch= package.asID().equals(identifier)
+		exportZip.close()
+		if idMatch:
+			#print "\t","Still looking good"
+			identifier.merge(package.asID())
+			identifier.merge(bID.ID(localPath))
+			identifier.merge(bID.ID(url))
+			self.addExport(identifier.filename())
+			return identifier
 		#print "\t","bummer, we failed"
 		os.remove(localPath)
 		return None
@@ -230,7 +539,7 @@ class Store:
 					found= [foundInCache]
 		if not found:
 			exportListPath= os.path.join(self.__exportDir, bConstants.kExportsFile)
-			localServers= list(bConstants.kBootStrapServers)
+			localServers= list(self.__servers)
 			if os.path.isfile(exportListPath):
 				exportListFile= open(exportListPath, 'r')
 				(reported, localServers)= self.__findInStream(exportListFile, localServers, identifier, upgrade, listAll= True)
@@ -238,31 +547,40 @@ class Store:
 				if reported:
 					pass # we report to have things we don't have
 			serversToSearch= list(localServers)
-			serversToSearch.sort(lambda x,y: random.randrange(-1, 2, 2)) # shuffle servers
-			index= 0
-			while index < len(serversToSearch) and time.time() - start < timeoutInSeconds:
-				try:
-					#print "Getting publicized Exports from",serversToSearch[index]
-					server= urllib2.urlopen(serversToSearch[index])
-					(foundOnServer, servers)= self.__findInStream(server, serversToSearch, identifier, upgrade, listAll= True, onServer= serversToSearch[index])
-					#print "\t","foundOnServer:",foundOnServer,servers
-					server.close()
-					if foundOnServer:
-						found= []
-						for item in foundOnServer:
-							downloaded= self.__download(item, serversToSearch[index])
-							if downloaded:
-								found.append(downloaded)
-						if found:
-							break # don't search every server if we find something suitable
-				except:
-					#bArchive.reportException()
-					pass # ignore bad URLs, servers down, etc
-				index+= 1
+			searched= 0
+			foundOnServers= []
+			while searched < len(serversToSearch) and time.time() - start < timeoutInSeconds:
+				batch= serversToSearch[searched:] # servers found in the last batch are searched next
+				searched= len(serversToSearch)
+				batch= self.__scoreboard.order(batch) # skip servers that have been failing
+				#print "Getting publicized Exports from",batch
+				for report in bMirrors.queryServers(batch, timeoutInSeconds - (time.time() - start), self.__opener,
+														self.__serverLists):
+					self.__scoreboard.record(report)
+					if report.healthy():
+						(foundOnServer, servers)= self.__findInStream(report.entries(),
+							serversToSearch, identifier, upgrade, listAll= True, onServer= report.url()
+						)
+						#print "\t","foundOnServer:",foundOnServer,report
+						if foundOnServer:
+							foundOnServers.append( (report, foundOnServer) )
+			fastestFirst= bMirrors.rankServers([item[0] for item in foundOnServers])
+			foundOnServers.sort(lambda x,y: fastestFirst.index(x[0]) - fastestFirst.index(y[0]))
+			for (report, foundOnServer) in foundOnServers:
+				for item in foundOnServer:
+					try:
+						downloaded= self.__download(item, report.url())
+						if downloaded:
+							found.append(downloaded)
+					except KeyboardInterrupt,e:
+						raise e
+					except Exception,e: # server went away, try the next fastest
+						#bArchive.reportException()
+						self.__scoreboard.recordFailure(report.url(), e)
+				if found:
+					break # don't download from every server if we got something suitable
+			self.__scoreboard.save()
+			self.__serverLists.save()
 			if len(localServers) < len(serversToSearch): # we found some new servers, add them to our list
-				exportListFile= open(exportListPath, 'a')
-				for server in serversToSearch:
-					if server not in localServers:
-						exportListFile.write(server+"\n")
-				exportListFile.close()
+				self.__addToExportList([server for server in serversToSearch if server not in localServers])
 		return found
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+__all__ = [ 			# exported symbols from this module
+	"Client",			# HTTP client that keeps connections to each host open between requests
+	"sharedClient",		# the Client export traffic goes through unless told otherwise
+	"urlopen",			# urllib2.urlopen work-alike on the shared client
+]
+
+import socket
+import urllib
+import httplib
+import urllib2
+import urlparse
+import cStringIO
+import threading
+
+# requests to one host that may be in progress at once (more wait for one to finish)
+kMaximumConnectionsPerHost= 4
+
+# redirects followed before giving up
+kMaximumRedirects= 10
+
+# statuses that send us somewhere else
+kRedirectStatuses= [301, 302, 303, 307]
+
+class Response:
+	""" What Client.open returns, used like what urllib2.urlopen returns
+		the connection goes back to its pool when the response is closed,
+		if the whole body was read (otherwise the connection is closed)
+		it closes itself once the body has been read to the end, or reading it failed
+			so a caller that never closes it does not hold on to its host's connection slot
+	"""
+	def __init__(self, url, response, release):
+		""" release(reusable) is called once, when the response is closed
+		"""
+		self.__url= url
+		self.__response= response
+		self.__release= release
+		self.code= response.status
+		self.msg= response.reason
+	def geturl(self):
+		return self.__url
+	def getcode(self):
+		return self.code
+	def info(self):
+		return self.__response.msg
+	def delimited(self):
+		""" True if the end of the body is marked (reading it all won't wait for the server to close)
+		"""
+		return self.__response.isclosed() or None != self.__response.length or self.__response.chunked
+	def read(self, size= None):
+		try:
+			if None == size or size < 0:
+				data= self.__response.read()
+			else:
+				data= self.__response.read(size)
+		except:
+			self.close() # the connection can't be used again
+			raise
+		if self.__response.isclosed(): # the whole body was read
+			self.close()
+		return data
+	def close(self):
+		if not self.__release:
+			return
+		reusable= self.__response.isclosed() and not self.__response.will_close
+		if not reusable:
+			self.__response.close()
+		release= self.__release
+		self.__release= None
+		release(reusable)
+
+class Client:
+	""" Keeps the connections to each host open between requests
+		so a list and then the exports in it come over one connection (one TCP/TLS handshake)
+		http:// and https:// are handled here
+		anything else, or anything going through a proxy, is handed to urllib2
+	"""
+	def __init__(self, maximumConnectionsPerHost= kMaximumConnectionsPerHost):
+		self.__maximumConnectionsPerHost= maximumConnectionsPerHost
+		self.__lock= threading.Lock()
+		self.__idle= {} # (scheme, host) -> [connection, ...]
+		self.__slots= {} # (scheme, host) -> semaphore limiting the requests in progress
+		self.__proxies= urllib.getproxies()
+		self.__opened= 0
+		self.__reused= 0
+	def statistics(self):
+		""" dictionary of description -> value about the connections made
+		"""
+		self.__lock.acquire()
+		try:
+			return {
+				'connections opened': self.__opened,
+				'connections reused': self.__reused,
+			}
+		finally:
+			self.__lock.release()
+	def close(self):
+		""" closes the idle connections
+		"""
+		self.__lock.acquire()
+		try:
+			for connections in self.__idle.values():
+				for connection in connections:
+					connection.close()
+			self.__idle= {}
+		finally:
+			self.__lock.release()
+	def __slot(self, key):
+		self.__lock.acquire()
+		try:
+			if not self.__slots.has_key(key):
+				self.__slots[key]= threading.BoundedSemaphore(self.__maximumConnectionsPerHost)
+			return self.__slots[key]
+		finally:
+			self.__lock.release()
+	def __connection(self, key, timeout):
+		""" returns (connection, True if it was kept open from an earlier request)
+		"""
+		self.__lock.acquire()
+		try:
+			idle= self.__idle.get(key)
+			if idle:
+				self.__reused+= 1
+				connection= idle.pop()
+				connection.timeout= timeout
+				if connection.sock:
+					connection.sock.settimeout(None if timeout == socket._GLOBAL_DEFAULT_TIMEOUT else timeout)
+				return (connection, True)
+			self.__opened+= 1
+		finally:
+			self.__lock.release()
+		if key[0] == 'https':
+			return (httplib.HTTPSConnection(key[1], timeout= timeout), False)
+		return (httplib.HTTPConnection(key[1], timeout= timeout), False)
+	def __releaser(self, key, connection, slot):
+		def release(reusable):
+			if reusable:
+				self.__lock.acquire()
+				self.__idle.setdefault(key, []).append(connection)
+				self.__lock.release()
+			else:
+				connection.close()
+			slot.release()
+		return release
+	def __request(self, request, timeout):
+		key= (request.get_type(), request.get_host())
+		headers= dict(request.header_items())
+		slot= self.__slot(key)
+		slot.acquire()
+		try:
+			while True:
+				(connection, reused)= self.__connection(key, timeout)
+				try:
+					connection.request(request.get_method(), request.get_selector(), request.get_data(), headers)
+					response= connection.getresponse()
+					break
+				except (httplib.HTTPException, socket.error),e:
+					connection.close()
+					if not reused: # a kept connection may have been closed by the server, try a new one
+						raise urllib2.URLError(e)
+			return Response(request.get_full_url(), response, self.__releaser(key, connection, slot))
+		except:
+			slot.release()
+			raise
+	def open(self, url, timeout= socket._GLOBAL_DEFAULT_TIMEOUT):
+		""" url is a url or a urllib2.Request
+			returns a Response (close it when done so the connection can be used again)
+			raises urllib2.HTTPError for error statuses (and 304 Not Modified) like urllib2.urlopen
+				and urllib2.URLError if the host could not be reached
+		"""
+		if isinstance(url, urllib2.Request):
+			request= url
+		else:
+			request= urllib2.Request(url)
+		if request.get_type() not in ('http', 'https') or self.__proxies.has_key(request.get_type()):
+			return urllib2.urlopen(request, timeout= timeout)
+		for redirect in range(kMaximumRedirects):
+			response= self.__request(request, timeout)
+			if response.getcode() < 300:
+				return response
+			location= response.info().getheader('Location')
+			body= ""
+			if response.delimited(): # read it so the connection can be used again
+				body= response.read()
+			response.close()
+			if response.getcode() in kRedirectStatuses and location:
+				request= urllib2.Request(urlparse.urljoin(request.get_full_url(), location),
+											headers= dict(request.header_items()))
+				continue
+			raise urllib2.HTTPError(request.get_full_url(), response.getcode(), response.msg, response.info(),
+										cStringIO.StringIO(body))
+		raise urllib2.HTTPError(request.get_full_url(), response.getcode(), "Too many redirects", response.info(),
+									cStringIO.StringIO(body))
+
+global gSharedClient
+gSharedClient= None
+gSharedClientLock= threading.Lock()
+
+def sharedClient():
+	""" the Client for everything that isn't given one, created the first time it is needed
+	"""
+	global gSharedClient
+	gSharedClientLock.acquire()
+	try:
+		if not gSharedClient:
+			gSharedClient= Client()
+		return gSharedClient
+	finally:
+		gSharedClientLock.release()
+
+def urlopen(url, timeout= socket._GLOBAL_DEFAULT_TIMEOUT):
+	""" urllib2.urlopen that keeps connections open (see Client.open)
+	"""
+	return sharedClient().open(url, timeout)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+__all__ = [ 		# exported symbols from this module
+	"HashCache",	# on-disk cache of file hashes, keyed on path, size, mtime and inode
+]
+
+import os
+import time
+import cPickle
+
+# bump this if the layout of what is pickled changes
+kHashCacheFormat= 1
+
+# files modified this recently may still be changing within the mtime resolution
+kUnstableSeconds= 2.0
+
+class HashCache:
+	def __init__(self, path, configuration, maximumEntries= 100000):
+		""" path is the file the cache is kept in (None to only cache in memory)
+			configuration is anything that changes what would be hashed
+				(hasher names, text detection, filters)
+				if it does not match what was saved, the saved cache is discarded
+			maximumEntries bounds the number of files remembered,
+				the entries used least recently are dropped first
+		"""
+		self.__path= path
+		self.__configuration= configuration
+		self.__maximum= maximumEntries
+		self.__entries= {}
+		self.__generation= 0
+		self.__hits= 0
+		self.__misses= 0
+		self.__bytesAvoided= 0
+		self.__changed= False
+		if path and os.path.isfile(path):
+			try:
+				cacheFile= open(path, 'rb')
+				try:
+					(format, configuration, generation, entries)= cPickle.load(cacheFile)
+				finally:
+					cacheFile.close()
+				if format == kHashCacheFormat and configuration == self.__configuration:
+					self.__generation= generation + 1
+					self.__entries= entries
+				else:
+					self.__changed= True # filters or hashers changed, start over
+			except KeyboardInterrupt,e:
+				raise e
+			except: # corrupt or unreadable cache, start over
+				self.__changed= True
+	def __key(self, stats):
+		return (stats.st_size, stats.st_mtime, stats.st_ino)
+	def lookup(self, relativePath, stats):
+		""" returns what store() was given for this file, or None if it may have changed
+		"""
+		entry= self.__entries.get(relativePath)
+		if entry and entry[0] == self.__key(stats):
+			self.__entries[relativePath]= (entry[0], entry[1], self.__generation)
+			self.__hits+= 1
+			self.__bytesAvoided+= stats.st_size
+			return entry[1]
+		self.__misses+= 1
+		return None
+	def store(self, relativePath, stats, value):
+		""" value is what to return from lookup() while the file is unchanged
+			( (numberOfLines, hashes) from bArchive.transferAndHash )
+		"""
+		if time.time() - stats.st_mtime < kUnstableSeconds:
+			return # could change again without the mtime changing
+		self.__entries[relativePath]= (self.__key(stats), value, self.__generation)
+		self.__changed= True
+	def hits(self):
+		return self.__hits
+	def misses(self):
+		return self.__misses
+	def bytesAvoided(self):
+		return self.__bytesAvoided
+	def save(self):
+		if not self.__path or not self.__changed:
+			return
+		if len(self.__entries) > self.__maximum:
+			byAge= self.__entries.items()
+			byAge.sort(lambda x,y: y[1][2] - x[1][2]) # most recently used first
+			self.__entries= dict(byAge[:self.__maximum])
+		directory= os.path.split(self.__path)[0]
+		if directory and not os.path.isdir(directory):
+			os.makedirs(directory)
+		temporaryPath= self.__path+".%x"%(os.getpid())
+		cacheFile= open(temporaryPath, 'wb')
+		try:
+			cPickle.dump(
+				(kHashCacheFormat, self.__configuration, self.__generation, self.__entries),
+				cacheFile, cPickle.HIGHEST_PROTOCOL
+			)
+		finally:
+			cacheFile.close()
+		os.rename(temporaryPath, self.__path)
+		self.__changed= False
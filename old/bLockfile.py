@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+__all__ = [ 		# exported symbols from this module
+	"Lockfile",		# the dependencies a package resolved to, so they need not be resolved again
+]
+
+import os
+import stat
+import cPickle
+import bArchive
+import bSnapshot
+import bConstants
+
+# bump this if the layout of what is pickled changes
+kLockfileFormat= 3
+
+def fileState(path):
+	""" (size, modification time) of path (None if there is nothing there)
+	"""
+	try:
+		stats= os.stat(path)
+	except OSError:
+		return None
+	return (stats.st_size, stats.st_mtime)
+
+def directoryStates(path):
+	""" relative path -> modification time of path ("") and every directory under it
+		None if path is not a directory that can be scanned
+	"""
+	try:
+		entries= bSnapshot.scan(path)
+	except OSError:
+		return None
+	states= {"": fileState(path)[1]}
+	for relativePath in entries:
+		if stat.S_ISDIR(entries[relativePath][2]):
+			states[relativePath]= entries[relativePath][1]
+	return states
+
+def directoriesUnchanged(path, states):
+	""" True if path and the directories under it still have the modification times in states
+		only the directories are looked at, nothing is listed
+	"""
+	for relativePath in states:
+		state= fileState(os.path.join(path, relativePath))
+		if None == state or state[1] != states[relativePath]:
+			return False
+	return True
+
+class Lockfile:
+	""" What a package's dependencies (and theirs) were resolved to and where they were restored
+		it is current while package.xml, the build package, the exports and the restored directories
+			are as they were when it was written, so startup can skip resolving and validating
+		checking it only stats files and directories, it does not read or list them:
+			files added, removed or renamed in a restored directory change a directory's modification time
+			every restore retakes the directory's snapshot (see bSnapshot and bExport.Store.pathTo)
+			files changed in place are not noticed, validating the dependencies again finds those
+		for each dependency:
+			fullName, filename (the export, its ID), export (state of the export file),
+			path (where it was restored), snapshot (state of its snapshot file),
+			directories (modification time of path and every directory in it)
+	"""
+	def __init__(self, path, packagePath, exportDirectory, dependencyDirectory, build= None):
+		""" path is the file the lockfile is kept in
+			packagePath is the package.xml the dependencies are for
+			exportDirectory is where the exports are
+			dependencyDirectory is where they are restored (and their snapshots are kept)
+			build is the filename of the build package's ID, a different build is not current
+		"""
+		self.__path= path
+		self.__packagePath= packagePath
+		self.__exportDirectory= exportDirectory
+		self.__dependencyDirectory= dependencyDirectory
+		self.__build= build
+		self.__packageDigest= None
+	def __packageHash(self):
+		if None == self.__packageDigest:
+			self.__packageDigest= bArchive.hashFile(self.__packagePath, bArchive.kMD5Hash)[0][1]
+		return self.__packageDigest
+	def __snapshotPath(self, filename):
+		return os.path.join(self.__dependencyDirectory, bConstants.kSnapshotDirectoryName, filename)
+	def __load(self):
+		if not os.path.isfile(self.__path):
+			return None
+		try:
+			lockFile= open(self.__path, 'rb')
+			try:
+				(format, packagePath, packageDigest, build, dependencies)= cPickle.load(lockFile)
+			finally:
+				lockFile.close()
+		except KeyboardInterrupt,e:
+			raise e
+		except: # corrupt or unreadable, resolve again
+			return None
+		if format != kLockfileFormat or packagePath != os.path.realpath(self.__packagePath):
+			return None
+		if packageDigest != self.__packageHash():
+			return None # package.xml changed
+		if build != self.__build:
+			return None # the build package changed
+		return dependencies
+	def current(self):
+		""" full name -> path restored to for every dependency
+			None if package.xml, the build package, an export or a restored directory changed since lock()
+		"""
+		dependencies= self.__load()
+		if None == dependencies:
+			return None
+		paths= {}
+		for dependency in dependencies:
+			exportPath= os.path.join(self.__exportDirectory, dependency['filename'])
+			if fileState(exportPath) != dependency['export']:
+				return None
+			snapshot= fileState(self.__snapshotPath(dependency['filename']))
+			if None == snapshot or snapshot != dependency['snapshot']:
+				return None # restored or validated again since (or being restored)
+			if None == dependency['directories']:
+				return None
+			if not directoriesUnchanged(dependency['path'], dependency['directories']):
+				return None
+			paths[dependency['fullName']]= dependency['path']
+		return paths
+	def lock(self, graph):
+		""" records the dependencies of a bDependencies.DependencyGraph that has been restored
+		"""
+		dependencies= []
+		for name in graph.names():
+			dependency= graph.dependency(name)
+			identifier= dependency.identifier()
+			exportPath= os.path.join(self.__exportDirectory, identifier.filename())
+			dependencies.append({
+				'fullName': name,
+				'filename': identifier.filename(),
+				'export': fileState(exportPath),
+				'path': dependency.path(),
+				'snapshot': fileState(self.__snapshotPath(identifier.filename())),
+				'directories': directoryStates(dependency.path()),
+			})
+		directory= os.path.split(self.__path)[0]
+		if directory and not os.path.isdir(directory):
+			os.makedirs(directory)
+		temporaryPath= self.__path+".%x"%(os.getpid())
+		lockFile= open(temporaryPath, 'wb')
+		try:
+			cPickle.dump(
+				(kLockfileFormat, os.path.realpath(self.__packagePath), self.__packageHash(), self.__build,
+					dependencies),
+				lockFile, cPickle.HIGHEST_PROTOCOL
+			)
+		finally:
+			lockFile.close()
+		os.rename(temporaryPath, self.__path)
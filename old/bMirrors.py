@@ -0,0 +1,559 @@
+#!/usr/bin/env python
+
+__all__ = [ 			# exported symbols from this module
+	"ServerReport",		# what asking one server for its exports list found, and how fast
+	"queryServers",		# ask many servers for their exports lists at once
+	"rankServers",		# order servers fastest first
+	"ServerScoreboard",	# what we remember about servers between runs, with backoff for dead ones
+	"ServerListCache",	# exports lists we have already read, so they are only read again when they change
+	"kDownloadStrategies",	# the ways an export can be downloaded
+	"downloadChunks",	# download a file in ranges from many mirrors at once
+]
+
+import os
+import re
+import time
+import cPickle
+import bHTTP
+import urllib2
+import threading
+
+# rank servers by how long they would take to send this much
+kRankingTransferSize= 1024 * 1024
+
+def listEntries(contents):
+	""" the lines of an exports list (server urls and export names), without blank lines
+	"""
+	entries= []
+	for line in contents.splitlines():
+		line= line.strip()
+		if line:
+			entries.append(line)
+	return entries
+
+class ServerReport:
+	def __init__(self, url, contents= None, latency= None, throughput= None, error= None,
+					entries= None, validators= None, notModified= False, cached= False):
+		""" url the exports list that was requested
+			contents the exports list (None if it could not be read)
+			latency seconds until the server responded
+			throughput bytes per second the list was sent at
+			error why the server could not be read (None if it was)
+			entries the lines of the list, if they have already been split out of contents
+			validators (ETag, Last-Modified) the server sent with the list
+			notModified the server said the list has not changed since we last read it
+			cached the list came from the ServerListCache without asking the server
+		"""
+		self.__url= url
+		self.__contents= contents
+		self.__latency= latency
+		self.__throughput= throughput
+		self.__error= error
+		self.__entries= entries
+		self.__validators= validators
+		self.__notModified= notModified
+		self.__cached= cached
+	def __repr__(self):
+		return "ServerReport(url=%s,latency=%s,throughput=%s,error=%s,cached=%s)"%(
+			self.__url, self.__latency, self.__throughput, self.__error, self.__cached
+		)
+	def url(self):
+		return self.__url
+	def contents(self):
+		return self.__contents
+	def entries(self):
+		""" the lines of the exports list (None if it could not be read)
+		"""
+		if None == self.__entries and None != self.__contents:
+			self.__entries= listEntries(self.__contents)
+		return self.__entries
+	def validators(self):
+		return self.__validators
+	def notModified(self):
+		return self.__notModified
+	def cached(self):
+		return self.__cached
+	def latency(self):
+		return self.__latency
+	def throughput(self):
+		return self.__throughput
+	def error(self):
+		return self.__error
+	def healthy(self):
+		return None == self.__error
+	def transferTime(self, size= kRankingTransferSize):
+		""" estimated seconds to get size bytes from this server
+		"""
+		return self.__latency + float(size) / max(self.__throughput, 1.0)
+
+def fetchServer(url, timeout, opener= None, validators= None):
+	""" Runs on a discovery thread, reads url and measures how fast the server is
+		opener( url, timeout= seconds ) -> stream ( .read() .close() ), bHTTP.urlopen by default
+			url is a urllib2.Request
+		validators (ETag, Last-Modified) of the copy we have, the list is only sent if it changed
+	"""
+	if not opener:
+		opener= bHTTP.urlopen
+	request= urllib2.Request(url)
+	if validators and validators[0]:
+		request.add_header('If-None-Match', validators[0])
+	if validators and validators[1]:
+		request.add_header('If-Modified-Since', validators[1])
+	start= time.time()
+	try:
+		connection= opener(request, timeout= timeout)
+		latency= time.time() - start
+		try:
+			contents= connection.read()
+			headers= connection.info()
+		finally:
+			connection.close()
+	except KeyboardInterrupt,e:
+		raise e
+	except urllib2.HTTPError,e:
+		if validators and e.code == 304: # Not Modified
+			return ServerReport(url, latency= time.time() - start, validators= validators, notModified= True)
+		return ServerReport(url, error= e)
+	except Exception,e: # bad URLs, servers down, etc
+		return ServerReport(url, error= e)
+	transferTime= max(time.time() - start - latency, 0.001)
+	return ServerReport(url, contents, latency, len(contents) / transferTime,
+		validators= (headers.getheader('ETag'), headers.getheader('Last-Modified'))
+	)
+
+class ServerQuery(threading.Thread):
+	def __init__(self, url, timeout, opener, validators):
+		threading.Thread.__init__(self)
+		self.setDaemon(True) # a server that ignores the timeout does not keep us from exiting
+		self.__url= url
+		self.__timeout= timeout
+		self.__opener= opener
+		self.__validators= validators
+		self.report= ServerReport(url, error= "No response in %0.3f seconds"%(timeout))
+	def run(self):
+		self.report= fetchServer(self.__url, self.__timeout, self.__opener, self.__validators)
+
+def queryServers(servers, timeout, opener= None, cache= None):
+	""" reads the exports lists of all the servers at once, each on its own thread
+		timeout the seconds to wait for all of them
+			servers that take longer are reported as errors (their threads are abandoned)
+		cache a ServerListCache
+			lists read within its time to live are not read again
+			other lists are only sent by the server if they changed
+		returns a ServerReport for each server, in the order of servers
+	"""
+	queries= []
+	cachedReports= {}
+	for server in servers:
+		if cache and cache.fresh(server):
+			cachedReports[server]= cache.report(server)
+			continue
+		validators= None
+		if cache:
+			validators= cache.validators(server)
+		query= ServerQuery(server, timeout, opener, validators)
+		query.start()
+		queries.append(query)
+	deadline= time.time() + timeout
+	queriedReports= {}
+	for query in queries:
+		query.join(max(deadline - time.time(), 0.0))
+		report= query.report
+		if cache:
+			report= cache.update(report)
+		queriedReports[report.url()]= report
+	reports= []
+	for server in servers:
+		if cachedReports.has_key(server):
+			reports.append(cachedReports[server])
+		else:
+			reports.append(queriedReports[server])
+	return reports
+
+def rankServers(reports):
+	""" the healthy servers in reports, fastest first
+	"""
+	healthy= [report for report in reports if report.healthy()]
+	healthy.sort(lambda x,y: cmp(x.transferTime(), y.transferTime()))
+	return healthy
+
+# bump this if the layout of what is pickled changes
+kServerScoreboardFormat= 1
+
+# how many of the latest latencies and throughputs to take the median of
+kServerSamples= 9
+
+# a server that fails is not asked again for this long, doubling each time it fails again
+kFirstBackoffInSeconds= 60.0
+kLongestBackoffInSeconds= 24 * 60 * 60.0
+
+def median(values):
+	ordered= sorted(values)
+	return ordered[len(ordered) / 2]
+
+class ServerScoreboard:
+	def __init__(self, path):
+		""" path is the file the scoreboard is kept in (None to only remember while running)
+			url -> {successes, failures, latencies, throughputs, lastFailure, backoff, retryAfter}
+		"""
+		self.__path= path
+		self.__servers= {}
+		self.__changed= False
+		self.__lock= threading.Lock() # servers may be searched on many threads at once
+		if path and os.path.isfile(path):
+			try:
+				scoreboardFile= open(path, 'rb')
+				try:
+					(format, servers)= cPickle.load(scoreboardFile)
+				finally:
+					scoreboardFile.close()
+				if format == kServerScoreboardFormat:
+					self.__servers= servers
+			except KeyboardInterrupt,e:
+				raise e
+			except: # corrupt or unreadable, start over
+				pass
+	def __score(self, url):
+		if not self.__servers.has_key(url):
+			self.__servers[url]= {
+				'successes': 0, 'failures': 0, 'latencies': [], 'throughputs': [],
+				'lastFailure': None, 'backoff': 0.0, 'retryAfter': 0.0,
+			}
+		return self.__servers[url]
+	def record(self, report, now= None):
+		""" remembers how a ServerReport went
+			(reports from the ServerListCache say nothing about the server, they are ignored)
+		"""
+		if report.cached():
+			return
+		if None == now:
+			now= time.time()
+		self.__lock.acquire()
+		try:
+			self.__record(report, now)
+		finally:
+			self.__lock.release()
+	def __record(self, report, now):
+		score= self.__score(report.url())
+		if report.healthy():
+			score['successes']+= 1
+			score['latencies']= (score['latencies'] + [report.latency()])[-kServerSamples:]
+			score['throughputs']= (score['throughputs'] + [report.throughput()])[-kServerSamples:]
+			score['backoff']= 0.0
+			score['retryAfter']= 0.0
+		else:
+			score['failures']+= 1
+			score['lastFailure']= (now, str(report.error()))
+			score['backoff']= min(max(2.0 * score['backoff'], kFirstBackoffInSeconds), kLongestBackoffInSeconds)
+			score['retryAfter']= now + score['backoff']
+		self.__changed= True
+	def recordFailure(self, url, error, now= None):
+		self.record(ServerReport(url, error= error), now)
+	def available(self, url, now= None):
+		""" False while a server that failed is backing off
+		"""
+		if None == now:
+			now= time.time()
+		return not self.__servers.has_key(url) or now >= self.__servers[url]['retryAfter']
+	def successRate(self, url):
+		""" fraction of requests that worked (None if we never asked)
+		"""
+		if not self.__servers.has_key(url):
+			return None
+		score= self.__servers[url]
+		attempts= score['successes'] + score['failures']
+		if not attempts:
+			return None
+		return float(score['successes']) / attempts
+	def latency(self, url):
+		""" median seconds the server took to respond (None if it never has)
+		"""
+		if not self.__servers.has_key(url) or not self.__servers[url]['latencies']:
+			return None
+		return median(self.__servers[url]['latencies'])
+	def throughput(self, url):
+		""" median bytes per second (None if it never sent anything)
+		"""
+		if not self.__servers.has_key(url) or not self.__servers[url]['throughputs']:
+			return None
+		return median(self.__servers[url]['throughputs'])
+	def lastFailure(self, url):
+		""" (time, error) of the last failure (None if it never failed)
+		"""
+		if not self.__servers.has_key(url):
+			return None
+		return self.__servers[url]['lastFailure']
+	def order(self, servers, now= None):
+		""" the servers that are not backing off, the ones we expect to be fastest first
+			servers we know nothing about go after the ones that have worked, in the order given
+		"""
+		known= []
+		unknown= []
+		for url in servers:
+			if not self.available(url, now):
+				continue
+			if None == self.latency(url):
+				unknown.append(url)
+			else:
+				expected= ServerReport(url, "", self.latency(url), self.throughput(url)).transferTime()
+				known.append( (expected / self.successRate(url), url) )
+		known.sort()
+		return [item[1] for item in known] + unknown
+	def save(self):
+		if not self.__path or not self.__changed:
+			return
+		directory= os.path.split(self.__path)[0]
+		if directory and not os.path.isdir(directory):
+			os.makedirs(directory)
+		temporaryPath= self.__path+".%x-%x"%(os.getpid(), id(threading.currentThread()))
+		scoreboardFile= open(temporaryPath, 'wb')
+		self.__lock.acquire()
+		try:
+			cPickle.dump( (kServerScoreboardFormat, self.__servers), scoreboardFile, cPickle.HIGHEST_PROTOCOL)
+			self.__changed= False
+		finally:
+			self.__lock.release()
+			scoreboardFile.close()
+		os.rename(temporaryPath, self.__path)
+
+""" How Store downloads an export
+	single - from one server at a time, resuming where the last one stopped
+	chunked - in ranges from every server that has it at once (single if only one server has it)
+"""
+kSingleDownload= 'single'
+kChunkedDownload= 'chunked'
+kDownloadStrategies= [kSingleDownload, kChunkedDownload]
+
+# exports are split into ranges this big to download from many mirrors at once
+kDownloadChunkSize= 1024 * 1024
+
+# Content-Range: bytes first-last/size
+kContentRangePattern= re.compile(r"^\s*bytes\s+([0-9]+)-([0-9]+)/([0-9]+)\s*$")
+
+def openRange(url, start, end, opener):
+	""" opens url for bytes start through end - 1
+		returns (stream, total size of the file)
+		raises IOError if the server does not send the range that was asked for
+	"""
+	request= urllib2.Request(url)
+	request.add_header('Range', 'bytes=%d-%d'%(start, end - 1))
+	stream= opener(request)
+	contentRange= kContentRangePattern.match(stream.info().getheader('Content-Range') or "")
+	if not contentRange or long(contentRange.group(1)) != start:
+		stream.close()
+		raise IOError("%s did not send bytes %d-%d"%(url, start, end - 1))
+	return (stream, long(contentRange.group(3)))
+
+def readRange(stream, output, start, end):
+	""" copies bytes start through end - 1 from stream to output at start
+	"""
+	output.seek(start)
+	while start < end:
+		block= stream.read(min(end - start, kDownloadChunkSize))
+		if not block:
+			raise IOError("connection closed %d bytes early"%(end - start))
+		output.write(block)
+		start+= len(block)
+
+class ChunkDownloader(threading.Thread):
+	""" Downloads chunks from one mirror until there are none left or the mirror fails
+	"""
+	def __init__(self, url, path, chunks, finished, lock, opener):
+		""" chunks is the list of (start, end) still to be downloaded, shared by all the mirrors
+			finished is the list of (start, end) downloaded, shared by all the mirrors
+		"""
+		threading.Thread.__init__(self)
+		self.__url= url
+		self.__path= path
+		self.__chunks= chunks
+		self.__finished= finished
+		self.__lock= lock
+		self.__opener= opener
+		self.error= None
+	def __next(self):
+		self.__lock.acquire()
+		try:
+			if not self.__chunks:
+				return None
+			return self.__chunks.pop(0)
+		finally:
+			self.__lock.release()
+	def run(self):
+		output= open(self.__path, 'r+b')
+		try:
+			while True:
+				chunk= self.__next()
+				if not chunk:
+					break
+				try:
+					(stream, size)= openRange(self.__url, chunk[0], chunk[1], self.__opener)
+					try:
+						readRange(stream, output, chunk[0], chunk[1])
+					finally:
+						stream.close()
+				except KeyboardInterrupt,e:
+					raise e
+				except Exception,e: # give the chunk back for the other mirrors, and stop using this one
+					self.__lock.acquire()
+					self.__chunks.insert(0, chunk)
+					self.__lock.release()
+					self.error= e
+					break
+				self.__lock.acquire()
+				self.__finished.append(chunk)
+				self.__lock.release()
+		finally:
+			output.close()
+
+def downloadChunks(urls, path, start= 0, opener= None, chunkSize= kDownloadChunkSize):
+	""" downloads the file at urls (all the same file on different mirrors) to path
+			in chunkSize ranges, one connection to each mirror at a time
+		start is how much of the file is already at the start of path
+		returns the size of the file
+		if some of the file could not be downloaded, path is truncated to what was downloaded
+			from the start (so it can be resumed) and IOError is raised
+	"""
+	if not opener:
+		opener= bHTTP.urlopen
+	if not os.path.isfile(path):
+		open(path, 'wb').close()
+	output= open(path, 'r+b')
+	working= list(urls) # mirrors that fail the first chunk aren't asked for the rest
+	try:
+		output.truncate(start) # in case it holds chunks from a download that didn't finish
+		for url in urls: # the first chunk tells us the size, get it from the first mirror that works
+			try:
+				(stream, size)= openRange(url, start, start + chunkSize, opener)
+				try:
+					readRange(stream, output, start, min(start + chunkSize, size))
+				finally:
+					stream.close()
+				break
+			except KeyboardInterrupt,e:
+				raise e
+			except Exception,e:
+				if url == urls[-1]:
+					raise e
+				output.truncate(start)
+				working.remove(url)
+	finally:
+		output.close()
+	chunks= []
+	for chunkStart in range(start + chunkSize, size, chunkSize):
+		chunks.append( (chunkStart, min(chunkStart + chunkSize, size)) )
+	finished= [ (0, min(start + chunkSize, size)) ]
+	lock= threading.Lock()
+	downloaders= []
+	for url in working[:max(len(chunks), 1)]:
+		downloader= ChunkDownloader(url, path, chunks, finished, lock, opener)
+		downloader.start()
+		downloaders.append(downloader)
+	for downloader in downloaders:
+		downloader.join()
+	if chunks: # every mirror failed before we got it all
+		finished.sort()
+		complete= 0
+		for (chunkStart, chunkEnd) in finished:
+			if chunkStart > complete:
+				break
+			complete= max(complete, chunkEnd)
+		output= open(path, 'r+b')
+		output.truncate(complete)
+		output.close()
+		raise IOError("Unable to download %d of %d bytes: %s"%(
+			size - complete, size, ", ".join([str(d.error) for d in downloaders if d.error])
+		))
+	return size
+
+# bump this if the layout of what is pickled changes
+kServerListCacheFormat= 1
+
+# exports lists read this recently are used without asking the server if they changed
+kServerListTimeToLive= 5 * 60.0
+
+class ServerListCache:
+	def __init__(self, path, timeToLive= kServerListTimeToLive):
+		""" path is the file the lists are kept in (None to only remember while running)
+			url -> {fetched, validators, entries, latency, throughput}
+		"""
+		self.__path= path
+		self.__timeToLive= timeToLive
+		self.__lists= {}
+		self.__changed= False
+		self.__lock= threading.Lock() # servers may be searched on many threads at once
+		if path and os.path.isfile(path):
+			try:
+				cacheFile= open(path, 'rb')
+				try:
+					(format, lists)= cPickle.load(cacheFile)
+				finally:
+					cacheFile.close()
+				if format == kServerListCacheFormat:
+					self.__lists= lists
+			except KeyboardInterrupt,e:
+				raise e
+			except: # corrupt or unreadable, start over
+				pass
+	def fresh(self, url, now= None):
+		""" True if the list for url was read within the time to live
+		"""
+		if None == now:
+			now= time.time()
+		return self.__lists.has_key(url) and 0 <= now - self.__lists[url]['fetched'] < self.__timeToLive
+	def validators(self, url):
+		""" (ETag, Last-Modified) of the list we have for url (None if we don't have it)
+		"""
+		if not self.__lists.has_key(url):
+			return None
+		return self.__lists[url]['validators']
+	def report(self, url):
+		""" a ServerReport for the list we have for url, as the server last sent it
+		"""
+		cached= self.__lists[url]
+		return ServerReport(url, None, cached['latency'], cached['throughput'],
+			entries= cached['entries'], validators= cached['validators'], cached= True
+		)
+	def update(self, report, now= None):
+		""" remembers the list in report
+			returns report, or if the server said the list did not change a report with the list we have
+		"""
+		if None == now:
+			now= time.time()
+		self.__lock.acquire()
+		try:
+			return self.__update(report, now)
+		finally:
+			self.__lock.release()
+	def __update(self, report, now):
+		url= report.url()
+		if report.notModified() and self.__lists.has_key(url):
+			cached= self.__lists[url]
+			cached['fetched']= now
+			cached['latency']= report.latency()
+			self.__changed= True
+			return ServerReport(url, None, report.latency(), cached['throughput'],
+				entries= cached['entries'], validators= cached['validators']
+			)
+		if report.healthy() and not report.notModified():
+			self.__lists[url]= {
+				'fetched': now, 'validators': report.validators(), 'entries': report.entries(),
+				'latency': report.latency(), 'throughput': report.throughput(),
+			}
+			self.__changed= True
+		return report
+	def save(self):
+		if not self.__path or not self.__changed:
+			return
+		directory= os.path.split(self.__path)[0]
+		if directory and not os.path.isdir(directory):
+			os.makedirs(directory)
+		temporaryPath= self.__path+".%x-%x"%(os.getpid(), id(threading.currentThread()))
+		cacheFile= open(temporaryPath, 'wb')
+		self.__lock.acquire()
+		try:
+			cPickle.dump( (kServerListCacheFormat, self.__lists), cacheFile, cPickle.HIGHEST_PROTOCOL)
+			self.__changed= False
+		finally:
+			self.__lock.release()
+			cacheFile.close()
+		os.rename(temporaryPath, self.__path)
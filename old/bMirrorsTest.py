@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+""" Tests chunked downloads (bMirrors.downloadChunks and bExport.Store) against local HTTP mirrors
+	run it with: python bMirrorsTest.py
+"""
+import os
+import bID
+import bRSA
+import shutil
+import socket
+import bExport
+import bPackage
+import bMirrors
+import tempfile
+import unittest
+import threading
+import SocketServer
+import BaseHTTPServer
+
+class Mirror(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	""" Serves files from memory on 127.0.0.1, honoring Range requests
+		mode is how it serves files:
+			ok - like a server should
+			fail - 503 for every file
+			norange - ignores Range and sends the whole file
+			dies - sends half of each range and closes the connection
+			corrupt - sends every byte of each range inverted
+			limit - serves budget ranges, then fails like fail
+		files is name -> contents, served at /name
+		ranges is the Range header of every request for a file (None if there was none)
+	"""
+	daemon_threads= True
+	def __init__(self, files, mode= 'ok', budget= 0):
+		BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), MirrorHandler)
+		self.files= files
+		self.mode= mode
+		self.budget= budget
+		self.ranges= []
+		self.connections= []
+		self.lock= threading.Lock()
+		self.thread= threading.Thread(target= self.serve_forever)
+		self.thread.setDaemon(True)
+		self.thread.start()
+	def url(self, name):
+		return "http://127.0.0.1:%d/%s"%(self.server_address[1], name)
+	def process_request(self, request, address):
+		self.lock.acquire()
+		self.connections.append(request)
+		self.lock.release()
+		SocketServer.ThreadingMixIn.process_request(self, request, address)
+	def stop(self):
+		self.shutdown()
+		for connection in self.connections: # kept open by clients, their threads wait on them
+			try:
+				connection.shutdown(socket.SHUT_RDWR)
+			except socket.error:
+				pass
+		self.server_close()
+	def handle_error(self, request, address):
+		pass # clients hang up on mirrors that misbehave
+
+class MirrorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version= "HTTP/1.1" # keep connections open, like real mirrors
+	def log_message(self, format, *arguments):
+		pass
+	def __send(self, status, body, headers= None):
+		self.send_response(status)
+		for (name, value) in (headers or []):
+			self.send_header(name, value)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+	def do_GET(self):
+		mirror= self.server
+		name= self.path.lstrip('/')
+		if not mirror.files.has_key(name):
+			return self.__send(404, "Not Found")
+		contents= mirror.files[name]
+		if name.endswith(".txt"): # exports lists are always served
+			return self.__send(200, contents)
+		requested= self.headers.getheader('Range')
+		mirror.lock.acquire()
+		try:
+			mirror.ranges.append(requested)
+			mode= mirror.mode
+			if mode == 'limit':
+				if mirror.budget <= 0:
+					mode= 'fail'
+				mirror.budget-= 1
+		finally:
+			mirror.lock.release()
+		if mode == 'fail':
+			return self.__send(503, "Service Unavailable")
+		if not requested or mode == 'norange':
+			return self.__send(200, contents)
+		(start, end)= requested.split('=', 1)[1].split('-')
+		start= long(start)
+		if end:
+			end= min(long(end) + 1, len(contents))
+		else:
+			end= len(contents)
+		if start >= len(contents):
+			return self.__send(416, "Requested Range Not Satisfiable")
+		body= contents[start:end]
+		if mode == 'corrupt':
+			body= "".join([chr(255 - ord(byte)) for byte in body])
+		headers= [('Content-Range', "bytes %d-%d/%d"%(start, end - 1, len(contents)))]
+		if mode == 'dies':
+			self.send_response(206)
+			for (header, value) in headers:
+				self.send_header(header, value)
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body[:len(body) / 2])
+			self.close_connection= 1
+			return
+		self.__send(206, body, headers)
+
+kChunkSize= 64 * 1024
+
+class DownloadChunksTest(unittest.TestCase):
+	""" bMirrors.downloadChunks with mirrors that work, fail, ignore ranges and drop connections
+	"""
+	def setUp(self):
+		self.directory= tempfile.mkdtemp()
+		self.path= os.path.join(self.directory, "download.partial")
+		self.contents= os.urandom(10 * kChunkSize + 1234)
+		self.mirrors= []
+	def tearDown(self):
+		for mirror in self.mirrors:
+			mirror.stop()
+		shutil.rmtree(self.directory, True)
+	def mirror(self, mode= 'ok', budget= 0):
+		mirror= Mirror({"export.zip": self.contents}, mode, budget)
+		self.mirrors.append(mirror)
+		return mirror
+	def download(self, mirrors, start= 0):
+		return bMirrors.downloadChunks([mirror.url("export.zip") for mirror in mirrors], self.path, start,
+										chunkSize= kChunkSize)
+	def downloaded(self):
+		downloadedFile= open(self.path, 'rb')
+		try:
+			return downloadedFile.read()
+		finally:
+			downloadedFile.close()
+	def testEveryMirrorIsUsed(self):
+		mirrors= [self.mirror(), self.mirror(), self.mirror()]
+		self.assertEqual(self.download(mirrors), len(self.contents))
+		self.assertEqual(self.downloaded(), self.contents)
+		self.assertEqual(sum([len(mirror.ranges) for mirror in mirrors]), 11)
+		for mirror in mirrors:
+			self.assert_(mirror.ranges, "a mirror was not used")
+	def testFailingMirror(self):
+		failing= self.mirror('fail')
+		self.assertEqual(self.download([self.mirror(), failing, self.mirror()]), len(self.contents))
+		self.assertEqual(self.downloaded(), self.contents)
+		self.assert_(len(failing.ranges) <= 1, "a mirror kept being asked after it failed")
+	def testMirrorIgnoringRanges(self):
+		ignoring= self.mirror('norange')
+		self.assertEqual(self.download([ignoring, self.mirror()]), len(self.contents))
+		self.assertEqual(self.downloaded(), self.contents)
+		self.assertEqual(len(ignoring.ranges), 1, "a mirror that ignored the range was asked again")
+	def testMirrorDroppingConnections(self):
+		self.assertEqual(self.download([self.mirror(), self.mirror('dies')]), len(self.contents))
+		self.assertEqual(self.downloaded(), self.contents)
+	def testResume(self):
+		self.assertRaises(IOError, self.download, [self.mirror('limit', budget= 4)])
+		partial= self.downloaded()
+		self.assertEqual(len(partial) % kChunkSize, 0)
+		self.assert_(0 < len(partial) < len(self.contents))
+		self.assertEqual(partial, self.contents[:len(partial)])
+		resumed= self.mirror()
+		self.assertEqual(self.download([resumed], len(partial)), len(self.contents))
+		self.assertEqual(self.downloaded(), self.contents)
+		self.assertEqual(resumed.ranges[0], "bytes=%d-%d"%(len(partial), len(partial) + kChunkSize - 1))
+	def testNoMirrorWorks(self):
+		self.assertRaises(Exception, self.download, [self.mirror('fail'), self.mirror('norange')])
+
+class StoreDownloadTest(unittest.TestCase):
+	""" bExport.Store downloading an export in chunks from the mirrors that list it
+		the export is checked against the md5 in its name (bID.ID.hash)
+	"""
+	def setUp(self):
+		self.directory= tempfile.mkdtemp()
+		self.mirrors= []
+		source= os.path.join(self.directory, "source")
+		os.makedirs(os.path.join(source, "package"))
+		packageDirectory= os.path.join(source, "package")
+		packageFile= open(os.path.join(packageDirectory, "package.xml"), 'w')
+		packageFile.write("""<?xml version='1.0' ?><package><name>mirrored</name><domain>com_test</domain>
+			<version>1.0.0d1</version><changes>changes.html</changes><changepat>&lt;!--v--&gt;</changepat>
+			</package>""")
+		packageFile.close()
+		changesFile= open(os.path.join(packageDirectory, "changes.html"), 'w')
+		changesFile.write("<!--v-->")
+		changesFile.close()
+		dataFile= open(os.path.join(packageDirectory, "data.bin"), 'wb')
+		dataFile.write(os.urandom(3 * bMirrors.kDownloadChunkSize + 4321)) # several chunks
+		dataFile.close()
+		exportDirectory= os.path.join(source, "exports")
+		os.makedirs(exportDirectory)
+		preferences= {'exports': exportDirectory, 'key': bRSA.Key(-512), 'scratch': None,
+						'base_url': "http://127.0.0.1"}
+		store= bExport.Store(exportDirectory, os.path.join(source, "dependencies"), servers= [])
+		(exportPath, url)= store.create(bPackage.Package(os.path.join(packageDirectory, "package.xml")), preferences)
+		self.filename= os.path.split(exportPath)[1]
+		exportFile= open(exportPath, 'rb')
+		self.contents= exportFile.read()
+		exportFile.close()
+		self.exports= os.path.join(self.directory, "exports")
+		os.makedirs(self.exports)
+	def tearDown(self):
+		for mirror in self.mirrors:
+			mirror.stop()
+		shutil.rmtree(self.directory, True)
+	def mirror(self, mode= 'ok'):
+		mirror= Mirror({"exports.txt": self.filename + "\n", self.filename: self.contents}, mode)
+		self.mirrors.append(mirror)
+		return mirror
+	def get(self, download= bMirrors.kChunkedDownload):
+		store= bExport.Store(self.exports, os.path.join(self.directory, "dependencies"),
+								servers= [mirror.url("exports.txt") for mirror in self.mirrors], download= download)
+		return store.get(bID.ID(self.filename))
+	def testChunked(self):
+		mirrors= [self.mirror(), self.mirror('fail'), self.mirror('norange'), self.mirror()]
+		found= self.get()
+		self.assertEqual(len(found), 1)
+		downloadedFile= open(os.path.join(self.exports, self.filename), 'rb')
+		downloaded= downloadedFile.read()
+		downloadedFile.close()
+		self.assertEqual(downloaded, self.contents)
+		self.assertEqual(found[0].hash(), bID.ID(self.filename).hash())
+		used= [mirror for mirror in mirrors if [item for item in mirror.ranges if item]]
+		self.assert_(len(used) > 1, "the export was not downloaded from several mirrors")
+		self.assertEqual(os.listdir(self.exports).count(self.filename + ".partial"), 0)
+	def testCorruptMirror(self):
+		self.mirror()
+		self.mirror('corrupt')
+		self.assertEqual(self.get(), [])
+		self.assertFalse([name for name in os.listdir(self.exports) if name.startswith(self.filename)])
+	def testSingle(self):
+		mirrors= [self.mirror(), self.mirror()]
+		self.assertEqual(len(self.get(bMirrors.kSingleDownload)), 1)
+		self.assertEqual(sum([len(mirror.ranges) for mirror in mirrors]), 1)
+
+if __name__ == "__main__":
+	unittest.main()
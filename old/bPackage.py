@@ -8,6 +8,7 @@ __all__ = [ 					# exported symbols from this module
 import bID
 import bDOM
 import os.path
+import bArchive
 import bConstants
 
 def parseXMLListOfExports(xml, pathToList, itemName, itemList, warningList):
@@ -20,6 +21,7 @@ def parseXMLListOfExports(xml, pathToList, itemName, itemList, warningList):
 class Package:
 	def __init__(self, contents):
 		self.__path= None
+		self.__skipFilter= None
 		if os.path.isfile(contents):
 			self.__path= contents
 		packageXML= bDOM.link(contents)
@@ -33,9 +35,12 @@ class Package:
 			'changes': bDOM.extractTagTextByPath(packageXML, "changes"),
 			'todo': bDOM.extractTagTextByPath(packageXML, "todo"),
 			'changepat': bDOM.extractTagTextByPath(packageXML, "changepat"),
+			'hashProfile': bDOM.extractTagTextByPath(packageXML, "hashprofile"), # None = default
+			'binaryManifest': (bDOM.extractTagTextByPath(packageXML, "binarymanifest") or "f")[:1].lower() == 't',
 			'filterExtensions': [],
 			'filterPaths': [],
 			'filterNames': [],
+			'compress': [], # (extension or None, method, level or None) see bCompression
 			'errors': [],
 			'warnings': [],
 			'dependencies': [],
@@ -57,6 +62,15 @@ class Package:
 			name= filter.getAttribute('name')
 			if name:
 				self.__contents['filterNames'].append(name)
+		for compress in packageXML.getElementsByTagName('compress'):
+			level= compress.getAttribute('level')
+			if level:
+				level= int(level)
+			else:
+				level= None
+			self.__contents['compress'].append(
+				(compress.getAttribute('extension') or None, compress.getAttribute('method') or 'deflate', level)
+			)
 		packageXML.unlink()
 	def __repr__(self):
 		return "Packge(path="+str(self.__path)+",contents="+str(self.__contents)+")"
@@ -64,6 +78,14 @@ class Package:
 		return self.__contents[key]
 	def directory(self):
 		return os.path.split(self.__path)[0]
+	def skipFilter(self):
+		""" the bArchive.SkipFilter for the package's filters (compiled once, shared by everything using it)
+		"""
+		if not self.__skipFilter:
+			self.__skipFilter= bArchive.SkipFilter(
+				self.__contents['filterPaths'], self.__contents['filterExtensions'], self.__contents['filterNames']
+			)
+		return self.__skipFilter
 	def upgrade(self, dependency, upgraded):
 		#print "Upgrading from ",dependency,"to",upgraded
 		packageXML= bDOM.link(self.__path)
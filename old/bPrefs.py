@@ -19,6 +19,8 @@ def load(preferencesPath):
 		'company': bDOM.extractTagTextByPath(prefXML, "company"),
 		'untitled': bDOM.extractTagTextByPath(prefXML, "untitled"),
 		'base_url': bDOM.extractTagTextByPath(prefXML, "base_url"),
+		'download': bDOM.extractTagTextByPath(prefXML, "download"),
+		'connections': bDOM.extractTagTextByPath(prefXML, "connections"),
 	}
 	keyText= bDOM.extractTagTextByPath(prefXML, "key")
 	if keyText:
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+__all__ = [ 		# exported symbols from this module
+	"Snapshot",		# what a restored directory looked like, to find what changed in it since
+	"scan",			# relative path -> (size, modification time, mode, inode) of everything in a directory
+	"treeDigest",	# digest of what scan returns
+]
+
+import os
+import bWalk
+import errno
+import cPickle
+import bArchive
+import threading
+
+# bump this if the layout of what is pickled changes
+kSnapshotFormat= 1
+
+def __raiseError(error):
+	raise error
+
+def scan(base):
+	""" relative path -> (size, modification time, mode, inode) of everything under base (not base itself)
+		symlinks are not followed
+		raises OSError if base, or any directory under it, is not a directory or cannot be listed
+	"""
+	if not os.path.isdir(base):
+		raise OSError(errno.ENOTDIR, "Not a directory", base)
+	entries= {}
+	for (relativePath, entry, stats) in bWalk.walk(base, onError= __raiseError):
+		entries[relativePath]= (stats.st_size, stats.st_mtime, stats.st_mode, stats.st_ino)
+	return entries
+
+def treeDigest(entries):
+	""" hex md5 of everything scan returned, the same for the same tree
+	"""
+	hasher= bArchive.kMD5Hash[0][1].copy()
+	for relativePath in sorted(entries.keys()):
+		hasher.update("%s\0%r\n"%(relativePath, entries[relativePath]))
+	return hasher.hexdigest()
+
+class Snapshot:
+	""" The stats of everything in a directory after it was restored from an export
+		so a quick validate only has to list the directory, and check what changed since
+	"""
+	def __init__(self, path):
+		""" path is the file the snapshot is kept in
+		"""
+		self.__path= path
+	def __load(self):
+		if not os.path.isfile(self.__path):
+			return None
+		try:
+			snapshotFile= open(self.__path, 'rb')
+			try:
+				(format, export, digest, entries)= cPickle.load(snapshotFile)
+			finally:
+				snapshotFile.close()
+		except KeyboardInterrupt,e:
+			raise e
+		except: # corrupt or unreadable, validate the long way
+			return None
+		if format != kSnapshotFormat:
+			return None
+		return (export, digest, entries)
+	def changed(self, base, export):
+		""" set of relative paths added, removed or changed in base since take()
+			None if there is no snapshot of base restored from export (everything has to be checked)
+		"""
+		snapshot= self.__load()
+		if not snapshot or snapshot[0] != export:
+			return None
+		try:
+			entries= scan(base)
+		except OSError:
+			return None
+		if treeDigest(entries) == snapshot[1]:
+			return set()
+		previous= snapshot[2]
+		changed= set([path for path in entries if previous.get(path) != entries[path]])
+		changed.update([path for path in previous if not entries.has_key(path)])
+		return changed
+	def take(self, base, export):
+		""" records what base, just restored from export (the export's filename), looks like
+			returns the tree digest
+		"""
+		entries= scan(base)
+		digest= treeDigest(entries)
+		directory= os.path.split(self.__path)[0]
+		if directory and not os.path.isdir(directory):
+			try:
+				os.makedirs(directory)
+			except OSError:
+				if not os.path.isdir(directory): # another restore may have just created it
+					raise
+		temporaryPath= self.__path+".%x-%x"%(os.getpid(), id(threading.currentThread()))
+		snapshotFile= open(temporaryPath, 'wb')
+		try:
+			cPickle.dump( (kSnapshotFormat, export, digest, entries), snapshotFile, cPickle.HIGHEST_PROTOCOL)
+		finally:
+			snapshotFile.close()
+		os.rename(temporaryPath, self.__path)
+		return digest
+	def remove(self):
+		""" forgets the snapshot (while the directory is being changed)
+		"""
+		if os.path.exists(self.__path):
+			os.remove(self.__path)
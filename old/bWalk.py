@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+__all__ = [ 				# exported symbols from this module
+	"walk",					# (relative path, DirEntry, lstat) for everything in a directory tree
+	"listDirectory",		# [(DirEntry, lstat), ...] for everything in a directory
+	"kScandirAvailable",	# True if directories are listed with scandir
+]
+
+import os
+import stat
+import bWorkers
+try:
+	from os import scandir # Python 3.5 and later
+	kScandirAvailable= True
+except:
+	try:
+		from scandir import scandir # the backport
+		kScandirAvailable= True
+	except:
+		kScandirAvailable= False
+
+# directory listings prefetched per prefetch thread
+kPrefetchPerThread= 4
+
+class ListedEntry:
+	""" The parts of scandir's DirEntry we use, for Pythons without scandir (from os.listdir and os.lstat)
+	"""
+	def __init__(self, directory, name):
+		self.name= name
+		self.path= os.path.join(directory, name)
+		self.__stats= os.lstat(self.path)
+	def stat(self, follow_symlinks= True):
+		if follow_symlinks and self.is_symlink():
+			return os.stat(self.path)
+		return self.__stats
+	def is_symlink(self):
+		return stat.S_ISLNK(self.__stats.st_mode)
+	def is_dir(self, follow_symlinks= True):
+		if follow_symlinks and self.is_symlink():
+			return os.path.isdir(self.path)
+		return stat.S_ISDIR(self.__stats.st_mode)
+	def is_file(self, follow_symlinks= True):
+		if follow_symlinks and self.is_symlink():
+			return os.path.isfile(self.path)
+		return stat.S_ISREG(self.__stats.st_mode)
+
+if kScandirAvailable:
+	def listDirectory(path):
+		""" [(DirEntry, lstat of it), ...] for everything in path
+			scandir gets the stats with the names where the platform can (Windows)
+		"""
+		return [(entry, entry.stat(follow_symlinks= False)) for entry in scandir(path)]
+else:
+	def listDirectory(path):
+		""" [(ListedEntry, lstat of it), ...] for everything in path
+		"""
+		listing= []
+		for name in os.listdir(path):
+			entry= ListedEntry(path, name)
+			listing.append( (entry, entry.stat(follow_symlinks= False)) )
+		return listing
+
+def walk(base, skipFilter= None, sort= False, prefetch= 0, descend= None, onError= None):
+	""" walks the tree under base (not base itself) in the order os.walk(topdown= True) does
+		yields (relative path, DirEntry, lstat result) for everything in it
+			a directory's directories come before its files, then what is in each of its directories
+			symlinks to directories are listed with the directories, but not walked
+			directories that cannot be listed are left out, like os.walk (unless onError raises)
+		skipFilter a bArchive.SkipFilter, what it skips is left out (and skipped directories aren't walked)
+		sort if True, each directory's entries are in name order (otherwise the order the system lists them)
+		prefetch the number of threads to list directories before the walk gets to them
+			for network filesystems, less than 2 lists each directory when the walk gets to it
+		descend( relative path ) -> False to not walk a directory, asked after it is yielded
+			None walks them all
+		onError( OSError ) is called for each directory that cannot be listed, like os.walk's onerror
+			it can raise the error to stop the walk, None leaves those directories out
+	"""
+	pool= None
+	if prefetch > 1:
+		pool= bWorkers.Pool(prefetch, processes= False)
+	pending= {} # relative path of a directory -> result of listing it
+	stack= [("", skipFilter and skipFilter.root())] # (relative path, skip filter node), next is last
+	try:
+		while stack:
+			(relativeDirectory, node)= stack.pop()
+			try:
+				if pending.has_key(relativeDirectory):
+					listing= pending.pop(relativeDirectory).get()
+				else:
+					listing= listDirectory(os.path.join(base, relativeDirectory))
+			except OSError,e:
+				if onError:
+					onError(e)
+				continue
+			if sort:
+				listing.sort(lambda x,y: cmp(x[0].name, y[0].name))
+			directories= []
+			files= []
+			for (entry, stats) in listing:
+				if skipFilter and skipFilter.skipped(entry.name, node):
+					continue
+				if stat.S_ISDIR(stats.st_mode) or (stat.S_ISLNK(stats.st_mode) and entry.is_dir()):
+					directories.append( (entry, stats) )
+				else:
+					files.append( (entry, stats) )
+			subdirectories= []
+			for (entry, stats) in directories + files:
+				relativePath= os.path.join(relativeDirectory, entry.name)
+				yield (relativePath, entry, stats)
+				if stat.S_ISDIR(stats.st_mode) and (not descend or descend(relativePath)):
+					subdirectories.append( (relativePath, skipFilter and skipFilter.within(node, entry.name)) )
+			subdirectories.reverse()
+			stack.extend(subdirectories)
+			if pool: # list the next few directories the walk will get to
+				for (upcoming, upcomingNode) in reversed(stack):
+					if len(pending) >= kPrefetchPerThread * pool.workers():
+						break
+					if not pending.has_key(upcoming):
+						pending[upcoming]= pool.submit(listDirectory, (os.path.join(base, upcoming),))
+	finally:
+		if pool:
+			pool.close()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+__all__ = [ 				# exported symbols from this module
+	"kWorkersAvailable",	# True if worker pools can be created on this Python
+	"cpuCount",				# number of processors on this machine
+	"Pool",					# a pool of worker processes or threads
+	"ImmediateResult",		# result of a call run on the calling thread
+	"CompletedResult",		# result that is already known
+	"OrderedResults",		# bounded, in-order queue of results from a Pool
+]
+
+import sys
+
+""" Python 2.6 introduced multiprocessing, older Pythons run everything
+	on the calling thread (a Pool of 1 worker)
+"""
+try:
+	import multiprocessing
+	import multiprocessing.pool
+	kWorkersAvailable= True
+except:
+	kWorkersAvailable= False
+
+def cpuCount():
+	if kWorkersAvailable:
+		try:
+			return multiprocessing.cpu_count()
+		except NotImplementedError:
+			pass
+	return 1
+
+class ImmediateResult:
+	""" Result of a call that was run on the calling thread
+		(looks like multiprocessing.pool.AsyncResult)
+	"""
+	def __init__(self, function, args):
+		self.__value= None
+		self.__exception= None # sys.exc_info() of what function raised
+		try:
+			self.__value= function(*args)
+		except KeyboardInterrupt,e:
+			raise e
+		except Exception,e:
+			self.__exception= sys.exc_info()
+	def ready(self):
+		return True
+	def get(self, timeout= None):
+		if self.__exception:
+			raise self.__exception[0], self.__exception[1], self.__exception[2]
+		return self.__value
+
+class CompletedResult:
+	""" A value that is already known (looks like multiprocessing.pool.AsyncResult)
+	"""
+	def __init__(self, value):
+		self.__value= value
+	def ready(self):
+		return True
+	def get(self, timeout= None):
+		return self.__value
+
+class Pool:
+	def __init__(self, workers, processes= True):
+		""" workers is the number of processes or threads to use
+				0 or None means one per processor
+				1 means run everything on the calling thread
+			processes if True, use processes (CPU bound work)
+				otherwise use threads (I/O or work that releases the GIL)
+				functions and arguments sent to processes must be picklable
+		"""
+		if not workers:
+			workers= cpuCount()
+		if not kWorkersAvailable:
+			workers= 1
+		self.__workers= workers
+		self.__pool= None
+		if workers > 1:
+			if processes:
+				self.__pool= multiprocessing.Pool(workers)
+			else:
+				self.__pool= multiprocessing.pool.ThreadPool(workers)
+	def workers(self):
+		return self.__workers
+	def submit(self, function, args):
+		""" returns an object with .get() to retrieve the result (or raise the exception)
+		"""
+		if self.__pool:
+			return self.__pool.apply_async(function, args)
+		return ImmediateResult(function, args)
+	def close(self):
+		if self.__pool:
+			self.__pool.close()
+			self.__pool.join()
+			self.__pool= None
+	def terminate(self):
+		if self.__pool:
+			self.__pool.terminate()
+			self.__pool.join()
+			self.__pool= None
+
+class OrderedResults:
+	def __init__(self, handler, maximumInFlight):
+		""" handler( payload, value ) is called for each item, in the order appended
+			maximumInFlight is the most items to hold before waiting on the oldest
+		"""
+		self.__handler= handler
+		self.__maximum= maximumInFlight
+		self.__pending= []
+	def append(self, payload, result= None):
+		""" result is from Pool.submit or None if there is nothing to wait on
+		"""
+		self.__pending.append( (payload, result) )
+		while len(self.__pending) > self.__maximum:
+			self.__handleOldest()
+	def drain(self):
+		while self.__pending:
+			self.__handleOldest()
+	def __handleOldest(self):
+		(payload, result)= self.__pending.pop(0)
+		if result:
+			value= result.get()
+		else:
+			value= None
+		self.__handler(payload, value)
@@ -8,14 +8,18 @@ if True: # Exports
 	import bRSA
 	import stat
 	import time
+	import bHTTP
 	import bPrefs
 	import random
 	import shutil
 	import bExport
 	import bArchive
 	import bPackage
+	import bWorkers
+	import bLockfile
 	import cStringIO
 	import bConstants
+	import bDependencies
 	import bPythonCompress
 
 def makeExecutable(path):
@@ -97,14 +101,38 @@ def todoValidate(package):
 	return True
 
 def validateBuildDep(package, buildPackage, exports):
+	""" returns False if the build dependency was updated
+	"""
 	needToRerun= False
 	for dependency in package['dependencies']:
 		if dependency.fullName() == buildPackage.asID().fullName():
 			if not exports.has(buildPackage.asID()):
 				needToRerun= True
-		location= exports.pathTo(dependency, ensure= False)
 	return not needToRerun
 
+def restoreDependencies(package, exports):
+	""" restores all the dependencies (and theirs) the package needs
+		returns the bDependencies.DependencyGraph
+	"""
+	dependencies= bDependencies.DependencyGraph(package, exports)
+	for (name, used, requests) in dependencies.conflicts():
+		print "WARNING: using",used.filename(),"but",name,"was asked for as:"
+		for (requiredBy, identifier) in requests:
+			print "\t",identifier.version(),"by",requiredBy or package['full_name']
+	dependencies.restore(ensure= False)
+	return dependencies
+
+def printDependencies(dependencies):
+	for name in dependencies.names():
+		dependency= dependencies.dependency(name)
+		print dependency.identifier().filename()
+		print "\t","fetch %0.3f seconds, restore %0.3f seconds"%(dependency.fetchTime(), dependency.restoreTime())
+		print "\t",dependency.path()
+	(seconds, chain)= dependencies.criticalPath()
+	print "Critical path (%0.3f seconds):"%(seconds)
+	for dependency in chain:
+		print "\t",dependency.fullName(),"%0.3f seconds"%(dependency.setupTime())
+
 def changesValidate(package):
 	if not os.path.isfile(package.changesFilePath()):
 		changesTemplatePath= os.path.join(buildBasePath, bConstants.kChangesTemplate)
@@ -127,8 +155,11 @@ def changesValidate(package):
 	return True
 
 def upgrade(package, exports):
-	for dependency in package['dependencies']:
-		upgrades= exports.get(dependency, upgrade= True)
+	pool= bWorkers.Pool(bDependencies.kDefaultWorkers, processes= False)
+	allUpgrades= [pool.submit(exports.get, (dependency, True)) for dependency in package['dependencies']]
+	pool.close()
+	for (dependency, upgrades) in zip(package['dependencies'], allUpgrades):
+		upgrades= upgrades.get()
 		#print "upgrades",upgrades
 		if not upgrades:
 			print "No updated dependencies found"
@@ -183,7 +214,10 @@ if not buildScriptValidate(__file__, sourceScript):
 
 buildPackage= bPackage.Package(os.path.join(buildBasePath, bConstants.kPackageFileName))
 preferences= bPrefs.load(preferencesPath)
-exports= bExport.Store(preferences['exports'], preferences['dependencies'])
+opener= None
+if preferences['connections']: # the most requests to one server at once
+	opener= bHTTP.Client(int(preferences['connections'])).open
+exports= bExport.Store(preferences['exports'], preferences['dependencies'], opener= opener, download= preferences['download'])
 packagePath= os.path.join(__build__, bConstants.kPackageFileName)
 
 if not packageValidate(packagePath, os.path.join(buildBasePath, bConstants.kPackageFileTemplatePath), buildPackage):
@@ -191,15 +225,34 @@ if not packageValidate(packagePath, os.path.join(buildBasePath, bConstants.kPack
 	sys.exit(1)
 
 package= bPackage.Package(packagePath)
+lockfile= bLockfile.Lockfile(
+	os.path.join(preferences['dependencies'], bConstants.kLockfileDirectoryName, package['full_name']),
+	packagePath, preferences['exports'], preferences['dependencies'], build= buildPackage.asID().filename()
+)
 if not validateBuildDep(package, buildPackage, exports):
 	print "Your build version was updated. Please rerun",__file__
 	sys.exit(1)
+dependencies= None
+if None == lockfile.current() or (len(sys.argv) == 2 and sys.argv[1] == "dependencies"):
+	dependencies= restoreDependencies(package, exports)
+	lockfile.lock(dependencies)
 changesValidate(package)
 todoValidate(package)
 
 if ((len(sys.argv) == 2) or (len(sys.argv) == 3)) and sys.argv[1] == 'export':
-	(path, url)= exports.create(package, preferences)
+	deltaFrom= None
+	if len(sys.argv) == 3 and sys.argv[2] == 'delta' and package['previous']:
+		deltaFrom= package['previous'][-1] # only export what changed since the last export
+	(path, url)= exports.create(package, preferences, deltaFrom= deltaFrom)
 	print "Export created:",url
 	print "\t",path
+	statistics= exports.exportStatistics()
+	for description in sorted(statistics.keys()):
+		print "\t",description+":",statistics[description]
 elif len(sys.argv) == 2 and sys.argv[1] == "upgrade":
 	upgrade(package, exports)
+elif len(sys.argv) == 2 and sys.argv[1] == "dependencies":
+	printDependencies(dependencies)
+elif len(sys.argv) == 2 and sys.argv[1] == "clean":
+	(removed, freed)= exports.collectGarbage()
+	print "Removed",removed,"unused dependency files,",freed,"bytes"